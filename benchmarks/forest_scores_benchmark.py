@@ -0,0 +1,51 @@
+import time
+import numpy as np
+
+from sklearn.ensemble import RandomForestClassifier
+
+from utils import forest_scores
+from utils import split_jobs
+
+"""Compares the per-tree scoring loop of imRF.RandomForest against the
+batched forest_scores for forests of 100 to 200 trees, grown by 10 trees
+at a time as in the iterative process, after checking that split_jobs
+never hands out more cores than the budget. Run from the repository root
+with:
+python -m benchmarks.forest_scores_benchmark"""
+
+if __name__ == '__main__':
+
+    # The cores split among the three resolutions never exceed the budget
+    for n_jobs in range(1, 33):
+        for widths in ([192, 96, 48], [1000, 1, 1], [1, 1, 1], [5, 3, 1]):
+            shares = split_jobs(n_jobs, widths)
+            assert min(shares) >= 1 and sum(shares) <= max(n_jobs, len(widths)), (n_jobs, widths, shares)
+
+    # High resolution windows: 32 data points of 6 variables
+    rng = np.random.default_rng(0)
+    X_train = rng.random((5000, 192))
+    y_train = (X_train[:, :6].mean(axis=1) + 0.1 * rng.random(5000) > 0.55).astype(float)
+    X = rng.random((20000, 192))
+
+    model = RandomForestClassifier(n_estimators=100, random_state=0, n_jobs=-1)
+    model.fit(X_train, y_train)
+
+    while model.n_estimators <= 200:
+
+        t = time.perf_counter()
+        score_loop = np.mean([tree.predict(X) for tree in model.estimators_], axis=0)
+        t_loop = time.perf_counter() - t
+
+        t = time.perf_counter()
+        score_batched = forest_scores(model, X, n_jobs=-1)
+        t_batched = time.perf_counter() - t
+
+        # Check that both give the same scores
+        assert np.array_equal(score_loop, score_batched)
+
+        print(f'{model.n_estimators} trees: per-tree loop {t_loop:.2f} s | batched {t_batched:.2f} s')
+
+        # Grow the forest as imRF.RandomForest does
+        model.n_estimators += 10
+        model.warm_start = True
+        model.fit(X_train, y_train)
@@ -0,0 +1,63 @@
+import time
+import numpy as np
+
+from utils import multiresolution_windower
+
+"""Compares the strided multiresolution windower against the original
+recursive imRF.windower. Run from the repository root with:
+python -m benchmarks.windower_benchmark"""
+
+def recursive_windower(data, num_variables, window_size, stride):
+
+    """Original implementation of imRF.windower, kept here as reference.
+    The instance state is replaced by arguments so it can be called alone."""
+
+    windows = []
+    if window_size > 4:
+
+        for i in data:
+
+            # Get the number of windows
+            num_windows = (len(i) - window_size * num_variables) // (stride * num_variables) + 1
+
+            # Create the windows
+            for j in range(0, num_windows, stride):
+                window = i[j * num_variables: (j * num_variables) + (window_size * num_variables)]
+                windows.append(window)
+
+        return [windows] + recursive_windower(data, num_variables, window_size // 2, stride)
+
+    else:
+
+        return []
+
+if __name__ == '__main__':
+
+    num_variables, window_size = 6, 32
+
+    # Two years of 15 min data split in events of random length
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(32, 2000, size=70)
+    data = [rng.random(length * num_variables) for length in lengths]
+    print(f'{len(data)} events, {lengths.sum()} rows')
+
+    for stride in [1, 2]:
+
+        t = time.perf_counter()
+        windows_recursive = recursive_windower(data, num_variables, window_size, stride)
+        t_recursive = time.perf_counter() - t
+
+        t = time.perf_counter()
+        windows_strided = multiresolution_windower(data, num_variables, window_size, stride)
+        t_strided = time.perf_counter() - t
+
+        t = time.perf_counter()
+        multiresolution_windower(data, num_variables, window_size, stride, copy=False)
+        t_view = time.perf_counter() - t
+
+        # Check that both implementations give the same windows
+        for recursive, strided in zip(windows_recursive, windows_strided):
+            assert np.array_equal(np.array(recursive), strided)
+        assert len(windows_recursive) == len(windows_strided)
+
+        print(f'stride {stride}: recursive {t_recursive:.3f} s | strided copy {t_strided:.3f} s | strided view {t_view:.4f} s')
@@ -0,0 +1,110 @@
+import sys
+import time
+import runpy
+import logging
+import argparse
+import importlib
+
+"""This file contains the command line entry point of imRF:
+
+python cli.py train [--station 901] [--iterations 10]
+python cli.py predict --iteration 9 [--station 901]
+python cli.py explain
+python cli.py plot
+python cli.py preprocess
+
+Each subcommand imports the modules it needs only when it runs, and logs how
+long the imports took. Training and prediction never load seaborn,
+matplotlib or shap. The explanation and plotting scripts are run once as
+__main__, loading them on their way, and the time of the whole run is
+logged."""
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def _import(name):
+
+    """Imports a module and logs the time it took."""
+
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    logging.info('Imported %s in %.2f s', name, time.perf_counter() - start)
+
+    return module
+
+def _model(main, args):
+
+    """Creates the imRF instance with the settings of main.py."""
+
+    return main.imRF(station=args.station, trim_percentage=0, ratio_init=12, ratio=2, num_variables=6,
+                     window_size=32, stride=1, seed=0, n_jobs=args.n_jobs, checkpoint=args.checkpoint)
+
+def train(args):
+
+    """Runs the iterative learning process, the test and the prediction."""
+
+    main = _import('main')
+    main.run(_model(main, args), iterations=args.iterations)
+
+def predict(args):
+
+    """Tests the models of an iteration and predicts on the saved
+    background set, reading the datasets and models from disk."""
+
+    main = _import('main')
+    model = _model(main, args)
+    model.iteration = args.iteration
+
+    model.test_RandomForest()
+    model.pred_RandomForest()
+    model.session.flush()
+
+def _script(name):
+
+    """Returns the subcommand that runs one of the scripts as __main__.
+    The script is not imported first, so its top-level code runs once."""
+
+    def command(args):
+        start = time.perf_counter()
+        runpy.run_module(name, run_name='__main__')
+        logging.info('Ran %s in %.2f s', name, time.perf_counter() - start)
+
+    return command
+
+def preprocess(args):
+
+    """Runs preprocessing.py, which reads raw_data/ when it is loaded."""
+
+    for name in ('preprocessors.checkGaps', 'preprocessors.filler', 'preprocessors.joiner',
+                 'preprocessors.labeler', 'preprocessors.filterer', 'preprocessors.smoother'):
+        _import(name)
+    runpy.run_path('preprocessing.py', run_name='__main__')
+
+def parser():
+
+    """Builds the argument parser of the subcommands."""
+
+    parser = argparse.ArgumentParser(prog='imRF', description='Iterative multiresolution Random Forest.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name, function, help in (('train', train, 'train, test and predict with imRF'),
+                                 ('predict', predict, 'test and predict with the models of an iteration')):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument('--station', type=int, default=901)
+        subparser.add_argument('--n-jobs', type=int, default=-1)
+        subparser.add_argument('--checkpoint', choices=['sync', 'async', 'end'], default='async')
+        subparser.set_defaults(function=function)
+
+    subparsers.choices['train'].add_argument('--iterations', type=int, default=10)
+    subparsers.choices['predict'].add_argument('--iteration', type=int, required=True)
+
+    subparsers.add_parser('explain', help='run results_parallel.py').set_defaults(function=_script('results_parallel'))
+    subparsers.add_parser('plot', help='run results.py').set_defaults(function=_script('results'))
+    subparsers.add_parser('preprocess', help='run preprocessing.py').set_defaults(function=preprocess)
+
+    return parser
+
+if __name__ == '__main__':
+
+    args = parser().parse_args(sys.argv[1:])
+    args.function(args)
@@ -0,0 +1,312 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+"""This file contains the station data layer. The labeled and smoothed
+CSV of each station is converted once to a columnar binary format (one
+memory-mapped .npy file per column plus a metadata file) and kept in memory,
+so every caller in the same process shares a single parsed DataFrame.
+It also stores the windowed datasets as one contiguous .npy file per
+resolution, so they can be opened memory-mapped, together with the
+station rows each event was extracted from."""
+
+# In-process cache of the loaded stations: {station: (signature, data)}
+_stations = {}
+
+# In-process cache of the variables of each station as one row-major matrix: {station: (data, values)}
+_values = {}
+
+def _signature(source, check):
+
+    """Returns the signature used to know if the source CSV has changed.
+    ---------
+    Arguments:
+    source: The path of the source CSV file.
+    check: 'mtime' to use modification time and size or 'hash' to use
+    the SHA-1 of the contents.
+
+    Returns:
+    signature (dict): The signature of the source file."""
+
+    stat = os.stat(source)
+    signature = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+    if check == 'hash':
+        sha1 = hashlib.sha1()
+        with open(source, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha1.update(block)
+        signature = {'sha1': sha1.hexdigest(), 'size': stat.st_size}
+
+    return signature
+
+def _convert(source, cache_dir, signature):
+
+    """Parses the source CSV and writes one .npy file per column.
+    The metadata file is written last, so an interrupted conversion
+    is never taken as valid."""
+
+    import pandas as pd
+
+    data = pd.read_csv(source, sep=',', encoding='utf-8', parse_dates=['date'])
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    columns = []
+    for i, column in enumerate(data.columns):
+        values = data[column].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(os.path.join(cache_dir, f'{i}.npy'), values, allow_pickle=False)
+        columns.append(column)
+
+    meta = {'source': os.path.basename(source), 'signature': signature, 'columns': columns}
+    with open(os.path.join(cache_dir, 'meta.json.tmp'), 'w') as file:
+        json.dump(meta, file)
+    os.replace(os.path.join(cache_dir, 'meta.json.tmp'), os.path.join(cache_dir, 'meta.json'))
+
+    return data
+
+def _read(cache_dir, columns):
+
+    """Builds the DataFrame from the memory-mapped columns."""
+
+    import pandas as pd
+
+    return pd.DataFrame({column: np.load(os.path.join(cache_dir, f'{i}.npy'), mmap_mode='r') for i, column in enumerate(columns)})
+
+def load_station(station, check='mtime'):
+
+    """Returns the labeled and smoothed data of a station with the same
+    columns read_csv(f'data/labeled_{station}_smo.csv', parse_dates=['date'])
+    gives. The CSV is only parsed when the columnar copy in data/cache is
+    missing or the source has changed, and the result is cached in memory.
+    The returned DataFrame is shared, so it must not be modified in place.
+    ---------
+    Arguments:
+    station: The station number.
+    check: 'mtime' (default) or 'hash', how to detect source changes.
+
+    Returns:
+    data (Pandas DataFrame): The station data."""
+
+    source = f'data/labeled_{station}_smo.csv'
+    cache_dir = f'data/cache/labeled_{station}_smo'
+
+    signature = _signature(source, check)
+
+    # Reuse the in-process copy if the source did not change
+    if station in _stations and _stations[station][0] == signature:
+        return _stations[station][1]
+
+    # Reuse the columnar copy on disk if it was made from the same source
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    data = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as file:
+            meta = json.load(file)
+        if meta['signature'] == signature:
+            data = _read(cache_dir, meta['columns'])
+
+    if data is None:
+        # Release the stale copy first, its columns may be mapped from the files being replaced
+        _stations.pop(station, None)
+        data = _convert(source, cache_dir, signature)
+
+    _stations[station] = (signature, data)
+
+    return data
+
+def station_dates(station):
+
+    """Returns the dates of a station as a datetime64 array aligned with
+    the rows of load_station, so the dates of any rows can be taken by
+    indexing it instead of searching the data.
+    ---------
+    Arguments:
+    station: The station number.
+
+    Returns:
+    dates (ndarray): The date of each row."""
+
+    return load_station(station)['date'].to_numpy()
+
+def station_values(station):
+
+    """Returns the six variables of a station as one row-major
+    (rows x variables) array, the same values imRF extracts with
+    data.iloc[:, 1:-2], so the series of any contiguous rows is a
+    zero-copy slice of it. The array is built once per loaded station
+    and must not be modified in place.
+    ---------
+    Arguments:
+    station: The station number.
+
+    Returns:
+    values (ndarray): The variables of each row."""
+
+    data = load_station(station)
+
+    # Rebuild the matrix only if the station was reloaded
+    if station not in _values or _values[station][0] is not data:
+        _values[station] = (data, np.ascontiguousarray(data.iloc[:, 1:-2].to_numpy()))
+
+    return _values[station][1]
+
+def clear_cache():
+
+    """Drops the in-process copies of the stations."""
+
+    _stations.clear()
+    _values.clear()
+
+def save_windows(path, windows, lengths, num_variables, rows=None):
+
+    """Saves a windowed dataset, [[high, med, low], lengths] as built by
+    imRF, to the directory path: one contiguous {resolution}.npy file per
+    resolution, the event lengths and the offsets of the first window of
+    each event in every resolution. The lengths are written last, so an
+    interrupted save is never taken as valid.
+    ---------
+    Arguments:
+    path: The directory of the dataset, e.g. 'pickels/anomaly_data_pred'.
+    windows: The list of window arrays of each resolution.
+    lengths: The length of each event.
+    num_variables: The number of variables of the windows.
+    rows: The station rows (positions in load_station) each event was
+    extracted from, one array per event. Saved with the index when given.
+
+    Returns:
+    None."""
+
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, 'lengths.npy')):
+        os.remove(os.path.join(path, 'lengths.npy'))
+
+    window_sizes = []
+    for resolution, resolution_windows in enumerate(windows):
+        resolution_windows = np.ascontiguousarray(resolution_windows)
+        np.save(os.path.join(path, f'{resolution}.npy'), resolution_windows, allow_pickle=False)
+        window_sizes.append(resolution_windows.shape[1] // num_variables)
+
+    EventIndex.from_lengths(lengths, window_sizes, rows=rows).save(path)
+    np.save(os.path.join(path, 'lengths.npy'), np.asarray(lengths, dtype=np.int64), allow_pickle=False)
+
+def load_windows(path, mmap_mode='r'):
+
+    """Loads a windowed dataset saved with save_windows in the same
+    [[high, med, low], lengths] layout as the pickled datasets. The
+    windows are memory-mapped, so only the events used are read from disk.
+    ---------
+    Arguments:
+    path: The directory of the dataset.
+    mmap_mode: The mmap_mode of np.load, None reads the windows to memory.
+
+    Returns:
+    windows (list): The windows of each resolution and the event lengths."""
+
+    lengths = np.load(os.path.join(path, 'lengths.npy'))
+    num_resolutions = len(np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r'))
+
+    windows = [np.load(os.path.join(path, f'{resolution}.npy'), mmap_mode=mmap_mode) for resolution in range(num_resolutions)]
+
+    return [windows, lengths.tolist()]
+
+class EventIndex():
+
+    """Index of the windows of each event in a windowed dataset. The
+    windows of event e at resolution r are offsets[r, e]:offsets[r, e + 1].
+    Indexing it gives the [[start, end], ...] list of each resolution that
+    the explanation functions take as starts_ends. When the provenance is
+    known, the station rows of event e are rows[row_offsets[e]:row_offsets[e + 1]]."""
+
+    def __init__(self, offsets, rows=None, row_offsets=None) -> None:
+
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+        self.row_offsets = None if row_offsets is None else np.asarray(row_offsets, dtype=np.int64)
+
+    @classmethod
+    def from_lengths(cls, lengths, window_sizes, rows=None):
+
+        """Builds the index from the event lengths. Each event of length l
+        spans l + 1 rows and yields l + 2 - window_size windows. rows is
+        the list with the station rows of each event, if known."""
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        offsets = [np.concatenate(([0], np.cumsum(lengths + 2 - window_size))) for window_size in window_sizes]
+
+        row_offsets = None
+        if rows is not None:
+            row_offsets = np.concatenate(([0], np.cumsum([len(event_rows) for event_rows in rows])))
+            rows = np.concatenate(rows) if len(rows) else np.empty(0, dtype=np.int64)
+
+        return cls(offsets, rows, row_offsets)
+
+    @classmethod
+    def load(cls, path):
+
+        """Loads the index saved with a windowed dataset."""
+
+        rows, row_offsets = None, None
+        if os.path.exists(os.path.join(path, 'rows.npy')):
+            rows = np.load(os.path.join(path, 'rows.npy'))
+            row_offsets = np.load(os.path.join(path, 'row_offsets.npy'))
+
+        return cls(np.load(os.path.join(path, 'offsets.npy')), rows, row_offsets)
+
+    def save(self, path):
+
+        """Saves the index in the directory of a windowed dataset."""
+
+        # Remove the provenance of a previous save so it is never mixed with these offsets
+        for name in ('rows.npy', 'row_offsets.npy'):
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets, allow_pickle=False)
+        if self.rows is not None:
+            np.save(os.path.join(path, 'row_offsets.npy'), self.row_offsets, allow_pickle=False)
+            np.save(os.path.join(path, 'rows.npy'), self.rows, allow_pickle=False)
+
+    def __len__(self):
+
+        return self.offsets.shape[1] - 1
+
+    def __getitem__(self, event_number):
+
+        if not -len(self) <= event_number < len(self):
+            raise IndexError(f'event {event_number} out of range for {len(self)} events')
+        event_number = event_number % len(self)
+
+        return [[int(starts[event_number]), int(starts[event_number + 1])] for starts in self.offsets]
+
+    def __iter__(self):
+
+        return (self[event_number] for event_number in range(len(self)))
+
+    def event_of(self, windows, resolution=0):
+
+        """Returns the event of each window index of a resolution."""
+
+        return np.searchsorted(self.offsets[resolution], windows, side='right') - 1
+
+    def event_rows(self, event_number):
+
+        """Returns the station rows of an event as a view of rows."""
+
+        if self.rows is None:
+            raise ValueError('the index has no provenance, save the dataset with rows')
+
+        return self.rows[self.row_offsets[event_number]:self.row_offsets[event_number + 1]]
+
+    def window_rows(self, window, window_size, resolution=0, stride=1):
+
+        """Returns the station rows covered by a window of a resolution,
+        window being its index in that resolution's array."""
+
+        event_number = int(self.event_of(window, resolution))
+        start = (window - self.offsets[resolution, event_number]) * stride
+
+        return self.event_rows(event_number)[start:start + window_size]
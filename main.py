@@ -1,19 +1,21 @@
 import random
-import pickle
-import shap
-shap.initjs()
 import logging
 import numpy as np
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-plt.style.use('ggplot')
-
-from sklearn.ensemble import RandomForestClassifier
 
 from tictoc import tictoc
 from utils import dater
 from utils import summarizer
+from utils import multiresolution_windower
+from utils import forest_scores
+from utils import multiresolution_vote
+from utils import fit_resolutions
+from utils import SegmentIndex
+from utils import forest_structure
+from utils import shuffle_classes
+from utils import WindowBuffer
+from datastore import load_station
+from datastore import save_windows
+from session import Session
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,7 +25,7 @@ iterative multiresolution Random Forest."""
 
 class imRF():
     
-    def __init__(self, station, trim_percentage, ratio_init, ratio, num_variables, window_size, stride, seed) -> None:
+    def __init__(self, station, trim_percentage, ratio_init, ratio, num_variables, window_size, stride, seed, n_jobs=-1, checkpoint='sync') -> None:
         
         self.station = station
         self.trim_percentage = trim_percentage
@@ -33,75 +35,108 @@ class imRF():
         self.window_size = window_size
         self.stride = stride
         self.seed = seed
+        self.n_jobs = n_jobs # Number of cores used to train and score the forests, -1 uses all of them
 
         self.window_size_med = self.window_size // 2
         self.window_size_low = self.window_size_med // 2
         
         self.iteration = None
+        self.background_occupancy = None # SegmentIndex with the rows already used as background
+        self.window_buffers = {} # Growable WindowBuffers of the anomalies and background windows of each resolution
+        self.session = Session(checkpoint) # Windows and models kept in memory between iterations, checkpointed to pickels/ and models/
     
-    def windower(self, data):
-        
+    def windower(self, data, copy=True):
+
         """
-        Takes a 2D list of NumPy arrays with multivariate 
-        time series data and creates multiresolution sliding 
-        windows. The size of the slinding windows gets halved 
-        each time. The resulting windows store different 
-        variables in a consecutive manner. E.g. [first 6 variables, 
+        Takes a 2D list of NumPy arrays with multivariate
+        time series data and creates multiresolution sliding
+        windows. The size of the slinding windows gets halved
+        each time. The resulting windows store different
+        variables in a consecutive manner. E.g. [first 6 variables,
         next 6 variables, and so on].
+        The windows are built with strided views, so neither
+        recursion nor changes to self.window_size are needed.
         ----------
         Arguments:
-        data (pickle): file with the time-series data to turn 
+        data (pickle): file with the time-series data to turn
         into windows.
-        num_variables (int): the number of variables in the data.
-        window_size (int): the size of the biggest window.
-        stride (int): the stride of the windows.
-        
+        copy (bool): return one contiguous 2D array per resolution
+        (True) or a list of read-only strided views per event (False).
+
         Returns:
         windows (list): time series data grouped in windows"""
-        
-        windows = []
-        if self.window_size > 4: # This way the maximum window would be 8 data points
-            
-            for i in data:
-                
-                # Get the number of windows
-                num_windows = (len(i) - self.window_size * self.num_variables) // (self.stride * self.num_variables) + 1
-                
-                # Create the windows
-                for j in range(0, num_windows, self.stride):
-                    window = i[j * self.num_variables: (j * self.num_variables) + (self.window_size * self.num_variables)]
-                    windows.append(window)
-            
-            self.window_size = self.window_size // 2 # Halve window size
-            
-            return [windows] + self.windower(data)  # Recursive call
-        
-        else:
-            
-            # Restore the window size after recursion
-            self.window_size = window_size
-            
-            return []
+
+        return multiresolution_windower(data, num_variables=self.num_variables, window_size=self.window_size,
+                                        stride=self.stride, copy=copy)
     
     def averaged_vote(self, *args):
         total = sum(args)
         return total / len(args)
     
-    def majority_vote(self, high, med, low):
-        vote_high = high
-        vote_med = sum(med) / len(med)
-        vote_low = sum(low) / len(low)
-        return 1/3 * vote_high + 1/3 * vote_med + 1/3 * vote_low
-    
-    def abs_majority_vote(self, high, med, low):
-        vote_high = high
-        vote_med = sum(med) / len(med)
-        vote_low = sum(low) / len(low)
-        # I use 0.5 here because it is the same threshold that the individual models use
-        if (1/3 * vote_high + 1/3 * vote_med + 1/3 * vote_low) >= 0.5:
-            return 1
-        else:
-            return 0
+    def draw_background(self, len_anomalies, num_rows, background_indexes):
+
+        """Draws one new background segment 'ratio' times longer than
+        each anomaly. The segments are sampled from the free gaps of the
+        occupancy index, so they never overlap the previously extracted
+        background nor each other. Anomalies that no longer fit in the
+        remaining background are skipped.
+        ----------
+        Arguments:
+        self.
+        len_anomalies (list): the length of each anomaly.
+        num_rows (int): the number of background rows available.
+        background_indexes (list): start and end indexes of the previously
+        extracted background data. It is updated with the new segments.
+
+        Returns:
+        new_background_indexes (list): start and end indexes of the new segments.
+        """
+
+        # Rebuild the occupancy index if it does not match the given indexes
+        if self.background_occupancy is None or self.background_occupancy.num_segments != len(background_indexes):
+            self.background_occupancy = SegmentIndex(background_indexes)
+
+        new_background_indexes = []
+        for anomaly_length in len_anomalies:
+            if anomaly_length != 0:
+                segment = self.background_occupancy.sample(anomaly_length * self.ratio, num_rows, random)
+
+                if segment is None:
+                    logging.warning('No free background left for a segment of %d rows', anomaly_length * self.ratio)
+                    continue
+
+                # Append the nonoverlaping indexes to the new list and the old one
+                new_background_indexes.append(segment)
+                background_indexes.append(segment)
+
+        return new_background_indexes
+
+    def grow_windows(self, name, prev_windows, add_windows):
+
+        """Appends the new windows of each resolution to the previous ones.
+        The windows are kept in a WindowBuffer per resolution, so only the new
+        windows are copied. The buffers are rebuilt from prev_windows when they
+        do not hold them, e.g. in the first iteration.
+        ----------
+        Arguments:
+        self.
+        name (str): 'anomalies' or 'background'.
+        prev_windows (list): the previous windows of each resolution.
+        add_windows (list): the new windows of each resolution.
+
+        Returns:
+        windows (list): views of the updated windows of each resolution.
+        """
+
+        buffers = self.window_buffers.get(name)
+        if buffers is None or not all(buffer.holds(windows) for buffer, windows in zip(buffers, prev_windows)):
+            buffers = [WindowBuffer(windows) for windows in prev_windows]
+            self.window_buffers[name] = buffers
+
+        for buffer, windows in zip(buffers, add_windows):
+            buffer.append(windows)
+
+        return [buffer.windows for buffer in buffers]
 
     def anomalies(self):
         
@@ -125,7 +160,7 @@ class imRF():
         """
         
         # Load the data
-        data = pd.read_csv(f'data/labeled_{self.station}_smo.csv', sep=',', encoding='utf-8', parse_dates=['date'])
+        data = load_station(self.station)
         data_copy = data.copy()
 
         # Create a new column 'group' that increments by 1 each time the 'label' value changes
@@ -150,15 +185,18 @@ class imRF():
                 trimmed_end = end - trim_amount
                 trimmed_anomalies_indexes.append((trimmed_start, trimmed_end))
         
-        # Extract the data
+        # Extract the data and the station rows it comes from
         anomaly_data = []
+        anomaly_rows = []
         for start, end in trimmed_anomalies_indexes:
             subset_rows = data.iloc[start:end + 1, 1:-2].values.flatten()  # Extract rows within the subset
             anomaly_data.append(subset_rows)
+            anomaly_rows.append(np.asarray(data.index[start:end + 1]))
         
         # Separate 20% of the anomalies for testing (this is not used in the iterative learning process)
         anomaly_data = anomaly_data[len(anomaly_data) // 5:]
         anomaly_lengths = anomaly_lengths[len(anomaly_lengths) // 5:]
+        anomaly_rows = anomaly_rows[len(anomaly_rows) // 5:]
         
         anomaly_data_test = anomaly_data[:len(anomaly_data) // 5]
         anomaly_lengths_test = anomaly_lengths[:len(anomaly_lengths) // 5]
@@ -172,17 +210,17 @@ class imRF():
 
         anomaly_data_test = [anomaly_data_test] + [anomaly_lengths_test]
         
-        # Save anomaly_data to disk as pickle object
-        with open('pickels/anomaly_data_0.pkl', 'wb') as file:
-            pickle.dump(anomaly_data, file)
+        # Keep anomaly_data in the session and save it to disk as pickle object
+        self.session.put('pickels/anomaly_data_0.pkl', anomaly_data)
+
+        # Keep anomaly_data in the session and save it to disk as pickle object
+        self.session.put('pickels/anomaly_data_pred.pkl', anomaly_data)
 
-        # Save anomaly_data to disk as pickle object
-        with open('pickels/anomaly_data_pred.pkl', 'wb') as file:
-            pickle.dump(anomaly_data, file)
+        # Save a memory-mappable copy for the results scripts
+        save_windows('pickels/anomaly_data_pred', anomaly_data[0], anomaly_data[-1], self.num_variables, rows=anomaly_rows)
         
-        # Save anomaly_data to disk as pickle object
-        with open('pickels/anomaly_data_test.pkl', 'wb') as file:
-            pickle.dump(anomaly_data_test, file)
+        # Keep anomaly_data_test in the session and save it to disk as pickle object
+        self.session.put('pickels/anomaly_data_test.pkl', anomaly_data_test)
         
         return trimmed_anomalies_indexes
     
@@ -211,7 +249,7 @@ class imRF():
         random.seed(self.seed)
         
         # Load the DataFrame from your dataset
-        data = pd.read_csv(f'data/labeled_{self.station}_smo.csv', sep=',', encoding='utf-8', parse_dates=['date'])
+        data = load_station(self.station)
         
         # Filter the data to select only rows where the label column has a value of 0
         data_background = data[data["label"] == 0]
@@ -238,6 +276,9 @@ class imRF():
                 background_indexes.append((start, end))
                 background_lengths.append(end - start)
         
+        # Keep track of the extracted rows for the following iterations
+        self.background_occupancy = SegmentIndex(background_indexes)
+        
         # Extract the data
         background_data = []
         for start, end in background_indexes:
@@ -249,9 +290,8 @@ class imRF():
 
         background_data = [background_data] + [background_lengths]
         
-        # Save background_data to disk as numpy object
-        with open(f'pickels/background_data_0.pkl', 'wb') as file:
-            pickle.dump(background_data, file)
+        # Keep background_data in the session and save it to disk as pickle object
+        self.session.put('pickels/background_data_0.pkl', background_data)
             
         return background_indexes
     
@@ -284,7 +324,7 @@ class imRF():
         random.seed(self.seed)
     
         # Load the DataFrame from your dataset
-        data = pd.read_csv(f'data/labeled_{self.station}_smo.csv', sep=',', encoding='utf-8', parse_dates=['date'])
+        data = load_station(self.station)
         
         # Filter the data to select only rows where the label column has a value of 0
         data_background = data[data["label"] == 0]
@@ -292,33 +332,9 @@ class imRF():
         # Extract the length of the anomalies
         len_anomalies = [end - start for start, end in anomalies_indexes]
 
-        # Define new background data indexes
-        new_background_indexes = []
-        background_lengths = []
-        for anomaly_length in len_anomalies:
-            if anomaly_length != 0:
-                new_start = random.randint(0, len(data_background) - 1)
-                new_end = new_start + (anomaly_length * self.ratio)
-                
-                # Check for overlap
-                overlaps = any(start <= new_end and end >= new_start for start, end in background_indexes)
-                
-                # If there is an overlap, generate a new index
-                max_retries = 10  # Set a maximum number of retries
-                retry_count = 0
-                while overlaps:
-                    new_start = random.randint(0, len(data_background) - 1)
-                    new_end = new_start + (anomaly_length * self.ratio)
-                    overlaps = any(start <= new_end and end >= new_start for start, end in background_indexes)
-                    retry_count += 1
-                
-                    if retry_count == max_retries:
-                        break
-                
-                # Append the nonoverlaping indexes to the new list and the old one
-                new_background_indexes.append((new_start, new_end))
-                background_lengths.append(new_end - new_start)
-                background_indexes.append((new_start, new_end))
+        # Define new background data indexes, drawn from the rows that have not been extracted yet
+        new_background_indexes = self.draw_background(len_anomalies, len(data_background), background_indexes)
+        background_lengths = [end - start for start, end in new_background_indexes]
         
         # Extract the data
         background_data = []
@@ -332,9 +348,8 @@ class imRF():
 
         background_data = [background_data] + [background_lengths]
         
-        # Save background_data to disk as pickle object
-        with open(f'pickels/background_data_{self.iteration}.pkl', 'wb') as file:
-            pickle.dump(background_data, file)
+        # Keep background_data in the session and save it to disk as pickle object
+        self.session.put(f'pickels/background_data_{self.iteration}.pkl', background_data)
             
         return background_indexes
     
@@ -366,7 +381,7 @@ class imRF():
         random.seed(self.seed)
     
         # Load the DataFrame from your dataset
-        data = pd.read_csv(f'data/labeled_{self.station}_smo.csv', sep=',', encoding='utf-8', parse_dates=['date'])
+        data = load_station(self.station)
         
         # Filter the data to select only rows where the label column has a value of 0
         data_background = data[data["label"] == 0]
@@ -374,49 +389,29 @@ class imRF():
         # Extract the length of the anomalies
         len_anomalies = [end - start for start, end in anomalies_indexes]
 
-        # Define new background data indexes
-        new_background_indexes = []
-        background_lengths = []
-        for anomaly_length in len_anomalies:
-            if anomaly_length != 0:
-                new_start = random.randint(0, len(data_background) - 1)
-                new_end = new_start + (anomaly_length * self.ratio)
-                
-                # Check for overlap
-                overlaps = any(start <= new_end and end >= new_start for start, end in background_indexes)
-                
-                # If there is an overlap, generate a new index
-                max_retries = 10  # Set a maximum number of retries
-                retry_count = 0
-                while overlaps:
-                    new_start = random.randint(0, len(data_background) - 1)
-                    new_end = new_start + (anomaly_length * self.ratio)
-                    overlaps = any(start <= new_end and end >= new_start for start, end in background_indexes)
-                    retry_count += 1
-                
-                    if retry_count == max_retries:
-                        break
-                
-                # Append the nonoverlaping indexes to the new list and the old one
-                new_background_indexes.append((new_start, new_end))
-                background_lengths.append(new_end - new_start)
-                background_indexes.append((new_start, new_end))
+        # Define new background data indexes, drawn from the rows that have not been extracted yet
+        new_background_indexes = self.draw_background(len_anomalies, len(data_background), background_indexes)
+        background_lengths = [end - start for start, end in new_background_indexes]
         
-        # Extract the data
+        # Extract the data and the station rows it comes from (the filtered rows keep their original index)
         background_data = []
+        background_rows = []
         for start, end in new_background_indexes:
             
             subset_rows = data_background.iloc[start:end + 1, 1:-2].values.flatten() # Extarct rows withing the subset
             background_data.append(subset_rows)
+            background_rows.append(np.asarray(data_background.index[start:end + 1]))
         
         # Group data into windows before saving
         background_data = self.windower(background_data)
 
         background_data = [background_data] + [background_lengths]
         
-        # Save background_data to disk as pickle object
-        with open(f'pickels/background_data_pred.pkl', 'wb') as file:
-            pickle.dump(background_data, file)
+        # Keep background_data in the session and save it to disk as pickle object
+        self.session.put('pickels/background_data_pred.pkl', background_data)
+
+        # Save a memory-mappable copy for the results scripts
+        save_windows('pickels/background_data_pred', background_data[0], background_data[-1], self.num_variables, rows=background_rows)
             
         return background_indexes
 
@@ -438,50 +433,24 @@ class imRF():
         """
         
         # Read the windowed anomalous data
-        file_anomalies = open('pickels/anomaly_data_0.pkl', 'rb')
-        anomalies_windows = pickle.load(file_anomalies)
-        file_anomalies.close()
+        anomalies_windows = self.session.get('pickels/anomaly_data_0.pkl')
 
         # Read the windowed background data
-        file_background = open('pickels/background_data_0.pkl', 'rb')
-        background_windows = pickle.load(file_background)
-        file_background.close()
+        background_windows = self.session.get('pickels/background_data_0.pkl')
 
         # Separate windows and lengths, although legths will not be used in this method
         anomalies_windows, anomalies_lengths = anomalies_windows[0], anomalies_windows[-1]
         background_windows, background_lengths = background_windows[0], background_windows[-1]
         
-        # Generate labels for each window
-        anomalies_labels = []
-        for i in range(len(anomalies_windows)):
-            anomalies_labels.append(np.array([1 for j in anomalies_windows[i]]))
-        
-        background_labels = []
-        for i in range(len(background_windows)):
-            background_labels.append(np.array([0 for j in background_windows[i]]))
-        
-        # Concatenate array
-        X = []
+        # Label (1 anomalies, 0 background) and shuffle the windows of each resolution
+        X, y = [], []
         for i in range(len(anomalies_windows)):
-            X.append(np.concatenate((anomalies_windows[i], background_windows[i])))
-        
-        y = []
-        for i in range(len(anomalies_windows)):
-            y.append(np.concatenate((anomalies_labels[i], background_labels[i])))
-        
-        # Shuffle data
-        randomized = []
-        for i in range(len(anomalies_windows)):
-            combined = np.column_stack((X[i], y[i]))
-            np.random.seed(self.seed)
-            np.random.shuffle(combined)
-            randomized.append(combined)
-            
-        # Split the shuffled array back into data and labels
-        for i in range(len(anomalies_windows)):    
-            X[i], y[i] = randomized[i][:, :-1], randomized[i][:, -1]
+            X_resolution, y_resolution = shuffle_classes(anomalies_windows[i], background_windows[i], self.seed)
+            X.append(X_resolution)
+            y.append(y_resolution)
         
         # Train the Random Forest classifiers
+        from sklearn.ensemble import RandomForestClassifier
         model_high = RandomForestClassifier(random_state=self.seed)
         model_med = RandomForestClassifier(random_state=self.seed)
         model_low = RandomForestClassifier(random_state=self.seed)
@@ -494,10 +463,8 @@ class imRF():
             X_test.append(X[i][int(len(X[i]) * 0.80):])
             y_test.append(y[i][int(len(X[i]) * 0.80):])
 
-        # Fit the model to the training data
-        model_high.fit(X_train[0], y_train[0]) # Long length data windows
-        model_med.fit(X_train[1], y_train[1]) # Medium legth data windows
-        model_low.fit(X_train[2], y_train[2]) # Short length data windows
+        # Fit the models to the training data at the same time: long, medium and short length data windows
+        fit_resolutions([model_high, model_med, model_low], X_train, y_train, n_jobs=self.n_jobs)
 
         from sklearn.metrics import confusion_matrix as cm
         confusion_matrix_high = cm(y_test[0], model_high.predict(X_test[0]))
@@ -511,13 +478,10 @@ class imRF():
         num_anomalies_high, num_anomalies_med, num_anomalies_low = len([i for i in y_test[0] if i==1]), len([i for i in y_test[1] if i==1]), len([i for i in y_test[2] if i==1])
         print('Number of anomalies in iterative test set [high, med , low]:', num_anomalies_high, num_anomalies_med, num_anomalies_low)
         
-        # Save the model to disk
-        filename = 'models/rf_model_high_0.sav'
-        pickle.dump(model_high, open(filename, 'wb'))
-        filename = 'models/rf_model_med_0.sav'
-        pickle.dump(model_med, open(filename, 'wb'))
-        filename = 'models/rf_model_low_0.sav'
-        pickle.dump(model_low, open(filename, 'wb'))
+        # Keep the models in the session and save them to disk, with their flattened structure next to them
+        self.session.put('models/rf_model_high_0.sav', model_high, on_write=forest_structure)
+        self.session.put('models/rf_model_med_0.sav', model_med, on_write=forest_structure)
+        self.session.put('models/rf_model_low_0.sav', model_low, on_write=forest_structure)
     
     @tictoc
     def RandomForest(self, num_anomalies_med):
@@ -540,12 +504,10 @@ class imRF():
         """
         
         # Read the current windowed background
-        file_background = open(f'pickels/background_data_{self.iteration}.pkl', 'rb')
-        background_windows = pickle.load(file_background)
-        file_background.close()
+        background_windows = self.session.get(f'pickels/background_data_{self.iteration}.pkl')
         
         # Variable name change to follow best practives in ML and extract lengths
-        X = background_windows[0]
+        X = [np.asarray(windows) for windows in background_windows[0]]
         lengths = background_windows[-1]
 
         # Extract the number of windows of each anomaly for indexing purposes (knowing when an anomaly end)
@@ -558,28 +520,15 @@ class imRF():
         #     np.random.shuffle(background_windows[i])
         #     X.append(background_windows[i])
         
-        # Load the previous models
-        filename = f'models/rf_model_high_{self.iteration - 1}.sav'
-        loaded_model_high = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_med_{self.iteration - 1}.sav'
-        loaded_model_med = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_low_{self.iteration - 1}.sav'
-        loaded_model_low = pickle.load(open(filename, 'rb'))
-        
-        # Load the estimators (trees) of each model
-        trees_high = loaded_model_high.estimators_
-        trees_med = loaded_model_med.estimators_
-        trees_low = loaded_model_low.estimators_
-
-        # Get the results from each tree
-        tree_classifications_high = [tree.predict(X[0]) for tree in trees_high]
-        tree_classifications_med = [tree.predict(X[1]) for tree in trees_med]
-        tree_classifications_low = [tree.predict(X[2]) for tree in trees_low]
-
-        # Get the average score for each window across all estimators
-        score_Xs_high = np.mean(tree_classifications_high, axis=0)
-        score_Xs_med = np.mean(tree_classifications_med, axis=0)
-        score_Xs_low = np.mean(tree_classifications_low, axis=0)
+        # Get the previous models
+        loaded_model_high = self.session.get(f'models/rf_model_high_{self.iteration - 1}.sav')
+        loaded_model_med = self.session.get(f'models/rf_model_med_{self.iteration - 1}.sav')
+        loaded_model_low = self.session.get(f'models/rf_model_low_{self.iteration - 1}.sav')
+        
+        # Get the average score for each window across all estimators (trees) in one batched pass per model
+        score_Xs_high = forest_scores(loaded_model_high, X[0], n_jobs=self.n_jobs)
+        score_Xs_med = forest_scores(loaded_model_med, X[1], n_jobs=self.n_jobs)
+        score_Xs_low = forest_scores(loaded_model_low, X[2], n_jobs=self.n_jobs)
 
         variables = [(score_Xs_high, 'score_Xs_high'), (score_Xs_med, 'score_Xs_med'), (score_Xs_low, 'score_Xs_low')]
 
@@ -600,144 +549,70 @@ class imRF():
         med_subwindow_span = self.window_size - self.window_size_med
         low_subwindow_span = self.window_size - self.window_size_low
 
-        # Set up the indexes
-        index_high = 0
-        start_index_med, end_index_med = 0, med_subwindow_span 
-        start_index_low, end_index_low = 0, low_subwindow_span
-
-        counter_number_windows = 0 # Used to access the length
-        current_window_number = 0 # Keeps track of the number of windows analyzed within each anomaly
-        indexes_anomalies_windows_high, indexes_background_windows_high = [], []
-        indexes_anomalies_windows_med, indexes_background_windows_med = [], []
-        indexes_anomalies_windows_low, indexes_background_windows_low = [], []
-        for i in range(len(score_Xs_high)):
-    
-            scores_high = score_Xs_high[index_high]
-            scores_med = score_Xs_med[start_index_med:end_index_med + 1]
-            scores_low = score_Xs_low[start_index_low:end_index_low + 1]
-            
-            # Combine the float result with the majority voting of the lists
-            # multiresolution_vote = self.averaged_vote(scores_high, *scores_med, *scores_low)
-            multiresolution_vote = self.majority_vote(scores_high, scores_med, scores_low)
-            if multiresolution_vote >= 0.90:
-                indexes_anomalies_windows_high.append(index_high)
-                indexes_anomalies_windows_med.append((start_index_med, end_index_med + 1))
-                indexes_anomalies_windows_low.append((start_index_low, end_index_low + 1))
-
-            elif multiresolution_vote <= 0.10:
-                indexes_background_windows_high.append(index_high)
-                indexes_background_windows_med.append((start_index_med, end_index_med + 1))
-                indexes_background_windows_low.append((start_index_low, end_index_low + 1))
-            
-            # Update the index values
-            if current_window_number == number_windows[counter_number_windows]:
-                index_high = index_high + self.stride
-                start_index_med, end_index_med = end_index_med + 1, end_index_med + med_subwindow_span + 1
-                start_index_low, end_index_low = end_index_low + 1, end_index_low + low_subwindow_span + 1
-                counter_number_windows += 1
-                current_window_number = 0
-            else:
-                index_high = index_high + self.stride
-                start_index_med, end_index_med = start_index_med + self.stride, end_index_med + self.stride
-                start_index_low, end_index_low = start_index_low + self.stride, end_index_low + self.stride
-                current_window_number += 1
-        
-        # Extract those new anomaly, background windows and lengths
-        add_anomalies_windows_high = [X[0][i] for i in indexes_anomalies_windows_high]
-        add_background_windows_high = [X[0][i] for i in indexes_background_windows_high]
+        # Get the multiresolution vote of every high resolution window: 1 anomaly, 0 background, -1 undecided
+        votes, starts_high, starts_med, starts_low = multiresolution_vote(score_Xs_high, score_Xs_med, score_Xs_low,
+                                                                          med_subwindow_span, low_subwindow_span,
+                                                                          number_windows=number_windows, stride=self.stride)
+        anomalies_votes, background_votes = votes == 1, votes == 0
 
-        # add_anomalies_windows_med = [X[1][start:end] for (start, end) in indexes_anomalies_windows_med]
-        add_anomalies_windows_med = []
-        [add_anomalies_windows_med.extend(X[1][start:end]) for start, end in indexes_anomalies_windows_med]
+        # Extract those new anomaly, background windows and lengths
+        add_anomalies_windows_high = X[0][starts_high[anomalies_votes]]
+        add_background_windows_high = X[0][starts_high[background_votes]]
 
-        # add_background_windows_med = [X[1][start:end] for (start, end) in indexes_background_windows_med]
-        add_background_windows_med = []
-        [add_background_windows_med.extend(X[1][start:end]) for start, end in indexes_background_windows_med]
+        # Each vote adds all the medium and low resolution windows contained in the high resolution one
+        offsets_med = np.arange(med_subwindow_span + 1)
+        add_anomalies_windows_med = X[1][(starts_med[anomalies_votes, np.newaxis] + offsets_med).ravel()]
+        add_background_windows_med = X[1][(starts_med[background_votes, np.newaxis] + offsets_med).ravel()]
 
-        # add_anomalies_windows_low = [X[2][start:end] for (start, end) in indexes_anomalies_windows_low]
-        add_anomalies_windows_low = []
-        [add_anomalies_windows_low.extend(X[2][start:end]) for start, end in indexes_anomalies_windows_low]
-        
-        # add_background_windows_low = [X[2][start:end] for (start, end) in indexes_background_windows_low]
-        add_background_windows_low = []
-        [add_background_windows_low.extend(X[2][start:end]) for start, end in indexes_background_windows_low]
+        offsets_low = np.arange(low_subwindow_span + 1)
+        add_anomalies_windows_low = X[2][(starts_low[anomalies_votes, np.newaxis] + offsets_low).ravel()]
+        add_background_windows_low = X[2][(starts_low[background_votes, np.newaxis] + offsets_low).ravel()]
         # print(f'Percentage of anomalies {round(len(add_anomalies_windows) / len(background_windows) * 100, 2)}%')
 
-        # Read the previous windowed anomalous data
-        file_anomalies = open(f'pickels/anomaly_data_{self.iteration - 1}.pkl', 'rb')
-        prev_anomalies_windows = pickle.load(file_anomalies)
-        file_anomalies.close()
+        # Take the previous windowed anomalous data out of the session, it is superseded below
+        prev_anomalies_windows = self.session.release(f'pickels/anomaly_data_{self.iteration - 1}.pkl')
 
-        # Read the previous windows background
-        file_background = open(f'pickels/background_data_{self.iteration - 1}.pkl', 'rb')
-        prev_background_windows = pickle.load(file_background)
-        file_background.close()
+        # Get the previous windows background, the first ones are kept for test_RandomForest
+        if self.iteration - 1 == 0:
+            prev_background_windows = self.session.get(f'pickels/background_data_{self.iteration - 1}.pkl')
+        else:
+            prev_background_windows = self.session.release(f'pickels/background_data_{self.iteration - 1}.pkl')
 
         if self.iteration - 1 == 0:
             # Separate windows and lengths before contatenating
             prev_anomalies_windows, prev_anomalies_lengths = prev_anomalies_windows[0], prev_anomalies_windows[-1]
             prev_background_windows, prev_background_lengths = prev_background_windows[0], prev_background_windows[-1]
         
-        # Conactenate new data with old data if there is any
-        if add_anomalies_windows_high and add_anomalies_windows_med and add_anomalies_windows_low:
-            anomalies_windows = [np.vstack((prev_anomalies_windows[0], add_anomalies_windows_high)),
-                                np.vstack((prev_anomalies_windows[1], add_anomalies_windows_med)),
-                                np.vstack((prev_anomalies_windows[2], add_anomalies_windows_low))]
+        # Append new data to old data if there is any
+        if len(add_anomalies_windows_high) and len(add_anomalies_windows_med) and len(add_anomalies_windows_low):
+            anomalies_windows = self.grow_windows('anomalies', prev_anomalies_windows,
+                                                  [add_anomalies_windows_high, add_anomalies_windows_med, add_anomalies_windows_low])
         else:
             anomalies_windows = prev_anomalies_windows
         
-        if add_background_windows_high and add_background_windows_med and add_background_windows_low:
-            background_windows = [np.vstack((prev_background_windows[0], add_background_windows_high)),
-                                np.vstack((prev_background_windows[1], add_background_windows_med)),
-                                np.vstack((prev_background_windows[2], add_background_windows_low))]
+        if len(add_background_windows_high) and len(add_background_windows_med) and len(add_background_windows_low):
+            background_windows = self.grow_windows('background', prev_background_windows,
+                                                   [add_background_windows_high, add_background_windows_med, add_background_windows_low])
         else:
             background_windows = prev_background_windows
 
-        # Save anomalies_data to disk as pickle object
-        with open(f'pickels/anomaly_data_{self.iteration}.pkl', 'wb') as file:
-            pickle.dump(anomalies_windows, file)
+        # Keep anomalies_data in the session and save it to disk as pickle object
+        self.session.put(f'pickels/anomaly_data_{self.iteration}.pkl', anomalies_windows)
         
-        # Save background data as a pickle object
-        with open(f'pickels/background_data_{self.iteration}.pkl', 'wb') as file:
-            pickle.dump(background_windows, file)
+        # Keep background data in the session and save it as a pickle object
+        self.session.put(f'pickels/background_data_{self.iteration}.pkl', background_windows)
 
-        # Retrain the model with the updated anomaly and background data
-        anomalies_labels = []
-        for i in range(len(anomalies_windows)):
-            anomalies_labels.append(np.array([1 for j in anomalies_windows[i]]))
-        
-        background_labels = []
-        for i in range(len(background_windows)):
-            background_labels.append(np.array([0 for j in background_windows[i]]))
-        
-        # Concatenate array
-        X = []
-        for i in range(len(anomalies_windows)):
-            X.append(np.concatenate((anomalies_windows[i], background_windows[i])))
-        
-        y = []
+        # Retrain the model with the updated anomaly and background data, labeled and shuffled by resolution
+        X, y = [], []
         for i in range(len(anomalies_windows)):
-            y.append(np.concatenate((anomalies_labels[i], background_labels[i])))
+            X_resolution, y_resolution = shuffle_classes(anomalies_windows[i], background_windows[i], self.seed)
+            X.append(X_resolution)
+            y.append(y_resolution)
 
-        # Shuffle data
-        randomized = []
-        for i in range(len(anomalies_windows)):
-            combined = np.column_stack((X[i], y[i]))
-            np.random.seed(self.seed)
-            np.random.shuffle(combined)
-            randomized.append(combined)
-            
-        # Split the shuffled array back into data and labels
-        for i in range(len(anomalies_windows)):    
-            X[i], y[i] = randomized[i][:, :-1], randomized[i][:, -1]
-
-        # Load the models
-        filename = f'models/rf_model_high_{self.iteration - 1}.sav'
-        model_high = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_med_{self.iteration - 1}.sav'
-        model_med = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_low_{self.iteration - 1}.sav'
-        model_low = pickle.load(open(filename, 'rb'))
+        # Take the previous models out of the session, they are updated in place below
+        model_high = self.session.release(f'models/rf_model_high_{self.iteration - 1}.sav')
+        model_med = self.session.release(f'models/rf_model_med_{self.iteration - 1}.sav')
+        model_low = self.session.release(f'models/rf_model_low_{self.iteration - 1}.sav')
 
         # Increase estimators and set warm_start to True
         model_high.n_estimators += 10
@@ -755,10 +630,8 @@ class imRF():
             X_test.append(X[i][int(len(X[i]) * 0.80):])
             y_test.append(y[i][int(len(X[i]) * 0.80):])
 
-        # Fit the model to the training data
-        model_high.fit(X_train[0], y_train[0]) # Long length data windows
-        model_med.fit(X_train[1], y_train[1]) # Medium legth data windows
-        model_low.fit(X_train[2], y_train[2]) # Short length data windows
+        # Fit the models to the training data at the same time: long, medium and short length data windows
+        fit_resolutions([model_high, model_med, model_low], X_train, y_train, n_jobs=self.n_jobs)
 
         from sklearn.metrics import confusion_matrix as cm
         confusion_matrix_high = cm(y_test[0], model_high.predict(X_test[0]))
@@ -770,46 +643,14 @@ class imRF():
 
         ##################################################################
         # Get the voting ground truth
-        y_truth = []
-        
-        # Set up the indexes
-        index_high = 0
-        start_index_med, end_index_med = 0, med_subwindow_span 
-        start_index_low, end_index_low = 0, low_subwindow_span
-        
-        for i in range(len(y_test[0])):
-    
-            scores_high = y_test[0][index_high]
-            scores_med = y_test[1][start_index_med:end_index_med + 1]
-            scores_low = y_test[2][start_index_low:end_index_low + 1]
-            
-            y_truth.append(self.abs_majority_vote(scores_high, scores_med, scores_low))
-
-            # Update indixes
-            index_high = index_high + self.stride
-            start_index_med, end_index_med = start_index_med + self.stride, end_index_med + self.stride
-            start_index_low, end_index_low = start_index_low + self.stride, end_index_low + self.stride
+        y_truth, _, _, _ = multiresolution_vote(y_test[0], y_test[1], y_test[2], med_subwindow_span, low_subwindow_span,
+                                                stride=self.stride, mode='hard')
 
         # Get the voting predictions
         y_hat_high, y_hat_med, y_hat_low = model_high.predict(X_test[0]), model_med.predict(X_test[1]), model_low.predict(X_test[2])
 
-        y_hat = []
-        # Set up the indexes
-        index_high = 0
-        start_index_med, end_index_med = 0, med_subwindow_span 
-        start_index_low, end_index_low = 0, low_subwindow_span
-        for i in range(len(y_hat_high)):
-    
-            scores_high = y_hat_high[index_high]
-            scores_med = y_hat_med[start_index_med:end_index_med + 1]
-            scores_low = y_hat_low[start_index_low:end_index_low + 1]
-            
-            y_hat.append(self.abs_majority_vote(scores_high, scores_med, scores_low))
-
-            # Update indixes
-            index_high = index_high + self.stride
-            start_index_med, end_index_med = start_index_med + self.stride, end_index_med + self.stride
-            start_index_low, end_index_low = start_index_low + self.stride, end_index_low + self.stride
+        y_hat, _, _, _ = multiresolution_vote(y_hat_high, y_hat_med, y_hat_low, med_subwindow_span, low_subwindow_span,
+                                              stride=self.stride, mode='hard')
         
         # Get the confusion matrix
         confusion_matrix = cm(y_truth, y_hat)
@@ -821,13 +662,10 @@ class imRF():
         num_anomalies_high, num_anomalies_med, num_anomalies_low = len([i for i in y_test[0] if i==1]), len([i for i in y_test[1] if i==1]), len([i for i in y_test[2] if i==1])
         print('Number of anomalies in iterative test set [high, med , low]:', num_anomalies_high, num_anomalies_med, num_anomalies_low)
         
-        # Save the model to disk
-        filename = f'models/rf_model_high_{self.iteration}.sav'
-        pickle.dump(model_high, open(filename, 'wb'))
-        filename = f'models/rf_model_med_{self.iteration}.sav'
-        pickle.dump(model_med, open(filename, 'wb'))
-        filename = f'models/rf_model_low_{self.iteration}.sav'
-        pickle.dump(model_low, open(filename, 'wb'))
+        # Keep the models in the session and save them to disk, with their flattened structure next to them
+        self.session.put(f'models/rf_model_high_{self.iteration}.sav', model_high, on_write=forest_structure)
+        self.session.put(f'models/rf_model_med_{self.iteration}.sav', model_med, on_write=forest_structure)
+        self.session.put(f'models/rf_model_low_{self.iteration}.sav', model_low, on_write=forest_structure)
         
         # Define stop criteria
         difference = num_anomalies_med / prev_num_anomalies_med
@@ -852,56 +690,26 @@ class imRF():
         """
 
         # Read the testing windowed anomalous data
-        file_anomalies = open('pickels/anomaly_data_test.pkl', 'rb')
-        anomalies_windows = pickle.load(file_anomalies)
-        file_anomalies.close()
+        anomalies_windows = self.session.get('pickels/anomaly_data_test.pkl')
 
         # Read the testing windowed background
-        file_background = open(f'pickels/background_data_0.pkl', 'rb')
-        background_windows = pickle.load(file_background)
-        file_background.close()
+        background_windows = self.session.get('pickels/background_data_0.pkl')
 
         # Separate anomalies and background windows and lengths, although legths will not be used in this method
         anomalies_windows, anomalies_lengths = anomalies_windows[0], anomalies_windows[-1]
         background_windows, background_lengths = background_windows[0], background_windows[-1]
 
-        # Generate labels for each window
-        anomalies_labels = []
+        # Label (1 anomalies, 0 background) and shuffle the windows of each resolution
+        X, y = [], []
         for i in range(len(anomalies_windows)):
-            anomalies_labels.append(np.array([1 for j in anomalies_windows[i]]))
-        
-        background_labels = []
-        for i in range(len(background_windows)):
-            background_labels.append(np.array([0 for j in background_windows[i]]))
+            X_resolution, y_resolution = shuffle_classes(anomalies_windows[i], background_windows[i], self.seed)
+            X.append(X_resolution)
+            y.append(y_resolution)
         
-        # Concatenate array
-        X = []
-        for i in range(len(anomalies_windows)):
-            X.append(np.concatenate((anomalies_windows[i], background_windows[i])))
-        
-        y = []
-        for i in range(len(anomalies_windows)):
-            y.append(np.concatenate((anomalies_labels[i], background_labels[i])))
-        
-        # Shuffle data
-        randomized = []
-        for i in range(len(anomalies_windows)):
-            combined = np.column_stack((X[i], y[i]))
-            np.random.seed(self.seed)
-            np.random.shuffle(combined)
-            randomized.append(combined)
-            
-        # Split the shuffled array back into data and labels
-        for i in range(len(anomalies_windows)):    
-            X[i], y[i] = randomized[i][:, :-1], randomized[i][:, -1]
-        
-        # Load the previous models
-        filename = f'models/rf_model_high_{self.iteration}.sav'
-        loaded_model_high = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_med_{self.iteration}.sav'
-        loaded_model_med = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_low_{self.iteration}.sav'
-        loaded_model_low = pickle.load(open(filename, 'rb'))
+        # Get the last models
+        loaded_model_high = self.session.get(f'models/rf_model_high_{self.iteration}.sav')
+        loaded_model_med = self.session.get(f'models/rf_model_med_{self.iteration}.sav')
+        loaded_model_low = self.session.get(f'models/rf_model_low_{self.iteration}.sav')
 
         from sklearn.metrics import confusion_matrix as cm
         confusion_matrix_high = cm(y[0], loaded_model_high.predict(X[0]))
@@ -933,35 +741,26 @@ class imRF():
         """
         
         # Read the testing windowed anomalous data
-        file_anomalies = open('pickels/anomaly_data_pred.pkl', 'rb')
-        anomalies_windows = pickle.load(file_anomalies)
-        file_anomalies.close()
+        anomalies_windows = self.session.get('pickels/anomaly_data_pred.pkl')
 
         # Read the testing windowed background
-        file_background = open(f'pickels/background_data_pred.pkl', 'rb')
-        background_windows = pickle.load(file_background)
-        file_background.close()
+        background_windows = self.session.get('pickels/background_data_pred.pkl')
 
         # Separate windows and lengths, although legths will not be used in this method
         anomalies_windows, anomalies_lengths = anomalies_windows[0], anomalies_windows[-1]
         background_windows, background_lengths = background_windows[0], background_windows[-1]
         
         # Generate labels for each window
-        anomalies_labels = []
-        for i in range(len(anomalies_windows)):
-            anomalies_labels.append(np.array([1 for j in anomalies_windows[i]]))
+        anomalies_labels = [np.ones(len(windows)) for windows in anomalies_windows]
 
         # Rename the variables for convention
         X_test = anomalies_windows
         y_test = anomalies_labels
         
-        # Load the previous models
-        filename = f'models/rf_model_high_{self.iteration}.sav'
-        loaded_model_high = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_med_{self.iteration}.sav'
-        loaded_model_med = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_low_{self.iteration}.sav'
-        loaded_model_low = pickle.load(open(filename, 'rb'))
+        # Get the last models
+        loaded_model_high = self.session.get(f'models/rf_model_high_{self.iteration}.sav')
+        loaded_model_med = self.session.get(f'models/rf_model_med_{self.iteration}.sav')
+        loaded_model_low = self.session.get(f'models/rf_model_low_{self.iteration}.sav')
         
         from sklearn.metrics import confusion_matrix as cm
         confusion_matrix_high = cm(y_test[0], loaded_model_high.predict(X_test[0]))
@@ -1011,56 +810,30 @@ class imRF():
         """
 
         # Read the testing windowed anomalous data
-        file_anomalies = open('pickels/anomaly_data_pred.pkl', 'rb')
-        anomalies_windows = pickle.load(file_anomalies)
-        file_anomalies.close()
+        anomalies_windows = self.session.get('pickels/anomaly_data_pred.pkl')
 
         # Read the testing windowed background
-        file_background = open(f'pickels/background_data_0.pkl', 'rb')
-        background_windows = pickle.load(file_background)
-        file_background.close()
+        background_windows = self.session.get('pickels/background_data_0.pkl')
 
         # Separate windows and lengths, although legths will not be used in this method
         anomalies_windows, anomalies_lengths = anomalies_windows[0], anomalies_windows[-1]
         background_windows, background_lengths = background_windows[0], background_windows[-1]
         
-        # Generate labels for each window
-        anomalies_labels = []
-        for i in range(len(anomalies_windows)):
-            anomalies_labels.append(np.array([1 for j in anomalies_windows[i]]))
-        
-        background_labels = []
-        for i in range(len(background_windows)):
-            background_labels.append(np.array([0 for j in background_windows[i]]))
-        
-        # Concatenate array
-        X = []
-        for i in range(len(anomalies_windows)):
-            X.append(np.concatenate((anomalies_windows[i], background_windows[i])))
-        
-        y = []
+        # Label (1 anomalies, 0 background) and shuffle the windows of each resolution
+        X, y = [], []
         for i in range(len(anomalies_windows)):
-            y.append(np.concatenate((anomalies_labels[i], background_labels[i])))
+            X_resolution, y_resolution = shuffle_classes(anomalies_windows[i], background_windows[i], self.seed)
+            X.append(X_resolution)
+            y.append(y_resolution)
         
-        # Shuffle data
-        randomized = []
-        for i in range(len(anomalies_windows)):
-            combined = np.column_stack((X[i], y[i]))
-            np.random.seed(self.seed)
-            np.random.shuffle(combined)
-            randomized.append(combined)
-            
-        # Split the shuffled array back into data and labels
-        for i in range(len(anomalies_windows)):    
-            X[i], y[i] = randomized[i][:, :-1], randomized[i][:, -1]
-        
-        # Load the previous models
-        filename = f'models/rf_model_high_{self.iteration}.sav'
-        loaded_model_high = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_med_{self.iteration}.sav'
-        loaded_model_med = pickle.load(open(filename, 'rb'))
-        filename = f'models/rf_model_low_{self.iteration}.sav'
-        loaded_model_low = pickle.load(open(filename, 'rb'))
+        # Get the last models
+        loaded_model_high = self.session.get(f'models/rf_model_high_{self.iteration}.sav')
+        loaded_model_med = self.session.get(f'models/rf_model_med_{self.iteration}.sav')
+        loaded_model_low = self.session.get(f'models/rf_model_low_{self.iteration}.sav')
+
+        # shap is only loaded here, it is slow to import and the rest of imRF does not need it
+        import shap
+        shap.initjs()
 
         # Define the explainer object
         GPU = False
@@ -1110,39 +883,46 @@ class imRF():
         #                 matplotlib=True
         #                 )
 
-if __name__ == '__main__':
+def run(model, iterations=10):
+
+    """Runs the iterative learning process of an imRF instance until the
+    difference falls to 1.125 or the iterations run out, then tests the
+    last models and predicts on a new background set.
+    ----------
+    Arguments:
+    model (imRF): the instance to train.
+    iterations (int): the maximum number of iterations.
+
+    Returns:
+    None.
+    """
 
-    # Create an instance of the model
-    window_size = 32
-    imRF = imRF(station=901, trim_percentage=0, ratio_init=12, ratio=2, num_variables=6, 
-                window_size=window_size, stride=1, seed=0)
-    
     # Start number of anomalies_med
     num_anomalies_med = 1 # Set to 1 to avoid division by zero
     
     # Implement iterative process
-    for i in range(0, 10): # 10
+    for i in range(0, iterations): # 10
         
         # Update iteration value
-        imRF.iteration = i
+        model.iteration = i
         
         if i == 0:
             logging.info('Iteration %d', i)
             # Extract the anomalies and first batch of background
-            anomalies_indexes = imRF.anomalies()
+            anomalies_indexes = model.anomalies()
             
-            background_indexes = imRF.init_background(anomalies_indexes)
+            background_indexes = model.init_background(anomalies_indexes)
             
             # Train the first version of the model
-            imRF.init_RandomForest()
+            model.init_RandomForest()
 
         else:
             logging.info('Iteration %d', i)
             # Extract new background data
-            background_indexes = imRF.background(anomalies_indexes, background_indexes)
+            background_indexes = model.background(anomalies_indexes, background_indexes)
             
             # Iteratively predict on the new background data and update the model
-            num_anomalies_med, difference = imRF.RandomForest(num_anomalies_med)
+            num_anomalies_med, difference = model.RandomForest(num_anomalies_med)
             
             print('Difference:', difference)
 
@@ -1151,15 +931,28 @@ if __name__ == '__main__':
     
     logging.info('Testing')
     # Extract new background data for testing
-    background_indexes = imRF.pred_background(anomalies_indexes, background_indexes)
+    background_indexes = model.pred_background(anomalies_indexes, background_indexes)
 
     # Test the model
-    imRF.test_RandomForest()
+    model.test_RandomForest()
 
     logging.info('Prediction')
     # Get the results
-    imRF.pred_RandomForest()
+    model.pred_RandomForest()
 
     logging.info('SHAP plots')
     # # Get the SHAP plots
-    # imRF.shap_RandomForest()
+    # model.shap_RandomForest()
+
+    # Wait for the checkpoints still being written
+    model.session.flush()
+
+if __name__ == '__main__':
+
+    # Create an instance of the model
+    window_size = 32
+    imRF = imRF(station=901, trim_percentage=0, ratio_init=12, ratio=2, num_variables=6, 
+                window_size=window_size, stride=1, seed=0, checkpoint='async')
+    
+    # Train, test and predict
+    run(imRF)
@@ -15,37 +15,18 @@ from utils import dater
 from utils import plotter
 from utils import dp_plotter
 from utils import mean_plotter
+from utils import event_series
 
 def plotter_all(starts_ends, X, event_number, station):
 
-    event_start_high = starts_ends[event_number][0][0]
-    event_end_high = starts_ends[event_number][0][1]
-
-    event_data = X[0][event_start_high]
-    for i in range(event_start_high + 1, event_end_high):
-        
-        # Get the last row of the anomaly
-        last_row = X[0][i][-6:]
-        
-        # Add the last row to anomaly_data
-        event_data = np.concatenate((event_data, last_row), axis=0)
+    event_data = event_series(starts_ends, X, event_number, station=station)
 
     plotter(data=event_data, num_variables=6, station=station, legend=True, name=f'event_{event_number}')
 
 def get_results(starts_ends, X, event_number, station):
 
-    event_start_high = starts_ends[event_number][0][0]
-    event_end_high = starts_ends[event_number][0][1]
-
     # Plot the whole event using high resolution
-    event_data = X[0][event_start_high]
-    for i in range(event_start_high + 1, event_end_high):
-        
-        # Get the last row of the anomaly
-        last_row = X[0][i][-6:]
-        
-        # Add the last row to anomaly_data
-        event_data = np.concatenate((event_data, last_row), axis=0)
+    event_data = event_series(starts_ends, X, event_number, station=station)
 
     plotter(data=event_data, num_variables=6, station=station, legend=True, name=f'event_{event_number}')
 
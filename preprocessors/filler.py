@@ -22,6 +22,66 @@ def findMonday(Dataframe):
     
     return i
 
+def padMonths(df, varname, timestep):
+
+    """Adds the missing days to every month shorter than 31 days (30-day
+    months, Februaries of leap years and the other Februaries) in a single
+    reindex. A month is padded when its last day (30, 29 or 28) is followed
+    by the first day of the next month, so the first and last months of the
+    data are only padded if they are complete. The new rows have NaN values
+    and the same date strings, year, month, day (and hour, minute, second)
+    the day by day insertion used to give.
+    ---------
+    Arguments:
+    df: The data frame with the date, the variable and the calendar columns.
+    varname: The name of the variable column.
+    timestep: '15 min' or '1 day'.
+
+    Returns:
+    df (Pandas DataFrame): The padded data frame."""
+
+    rowsPerDay = 96 if timestep == '15 min' else 1
+
+    day = df['day'].to_numpy()
+    month = df['month'].to_numpy()
+
+    # Positions of the first day of the month that follows a short month
+    drop = day[:-1] - day[1:]
+    previousMonth = np.r_[month[:1], month[:-2]]
+    ends = np.flatnonzero((drop == 29) | ((drop == 28) & (previousMonth == 2)) | (drop == 27)) + 1
+    print('These are the last indexes of the months shorter than 31 days: ', ends.tolist())
+
+    if len(ends) == 0:
+        return df
+
+    # Build the missing days of every short month, one block per month
+    lastDay = day[ends - 1]
+    blockLength = (31 - lastDay) * rowsPerDay
+    block = np.repeat(np.arange(len(ends)), blockLength)
+    step = np.arange(len(block)) - np.repeat(np.cumsum(blockLength) - blockLength, blockLength)
+
+    new = pd.DataFrame({'year': df['year'].to_numpy()[ends - 1][block],
+                        'month': month[ends - 1][block],
+                        'day': lastDay[block] + 1 + step // rowsPerDay})
+
+    dates = new['year'].astype(str) + '-' + new['month'].astype(str) + '-' + new['day'].astype(str)
+    if timestep == '15 min':
+        new['hour'] = step % rowsPerDay // 4
+        new['minute'] = step % 4 * 15
+        new['second'] = 0
+        dates = dates + ' ' + np.where(step == 0, '00:00', new['hour'].astype(str) + ':' + new['minute'].astype(str)) + ':00'
+    else:
+        dates = dates + ' 00:00:00'
+
+    new.insert(0, 'date', dates)
+    new.insert(1, varname, np.nan)
+
+    # Place each block right before the first day of the next month
+    position = np.r_[np.arange(len(df)), ends[block] - 0.5]
+    df = pd.concat([df, new], ignore_index=True)
+
+    return df.iloc[np.argsort(position, kind='stable')].reset_index(drop=True)
+
 def filler(File, timeframe, timestep, varname):
 
     if timestep == '15 min':
@@ -53,129 +113,8 @@ def filler(File, timeframe, timestep, varname):
 
         if timeframe == 'a':
 
-            monthShort = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if (x - y) == 29]
-            print('These are the last indexes of the months with 30 days: ', monthShort)
-
-            while monthShort:
-
-                for i in monthShort:
-
-                    if df['day'][i-1] == 30:
-                        
-                        startDate =  df.iloc[monthShort[0]-1, 0] 
-                        yearInit, monthInit, dayInit, hourInit, minInit, secInit = startDate.year, startDate.month, startDate.day + 1, 0, 0, 0
-                        rows = [[f'{yearInit}-{monthInit}-{dayInit} 00:00:00', np.nan, yearInit, monthInit, dayInit, hourInit, minInit, secInit]]
-
-                        for j in range(95):
-
-                            minInit += 15
-
-                            if minInit > 45:
-
-                                minInit = 0
-                                hourInit += 1
-                            
-                            rows.append([f'{yearInit}-{monthInit}-{dayInit} {hourInit}:{minInit}:00', np.nan, yearInit, monthInit, dayInit, hourInit, minInit, secInit])
-
-                        df2concat = pd.DataFrame(rows, columns=['date', f'{varname}', 'year', 'month', 'day', 'hour', 'minute', 'second'])
-
-                        df = pd.concat([df.iloc[:i], df2concat, df.iloc[i:]], ignore_index=True)
-
-                        day = df['day']
-                        
-                        monthShort = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if (x - y) == 29]
-
-                        print('UPDATED indexes of months with 30 days: ', monthShort)
-
-            # Add the 30th and 31st days to those February(s) on leap years:
-            day = df['day']
-            leaps = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if ((x - y) == 28 and df['month'][i-1] == 2)]
-            print('These are the last indexes of the months with 29 days: ', leaps)
-
-            if leaps: # Check if there are any leap years
-
-                startDate =  df.iloc[leaps[0]-1, 0] 
-                yearInit, monthInit, dayInit, hourInit, minInit, secInit = startDate.year, startDate.month, startDate.day + 1, 0, 0, 0
-                rows = [[f'{yearInit}-{monthInit}-{dayInit} 00:00:00', np.nan, yearInit, monthInit, dayInit, hourInit, minInit, secInit]]
-
-                while leaps:
-                    
-                    for i in leaps:
-                        
-                        if df['day'][i-1] == 29:
-                            
-                            startDate =  df.iloc[leaps[0]-1, 0] 
-                            yearInit, monthInit, dayInit, hourInit, minInit, secInit = startDate.year, startDate.month, startDate.day + 1, 0, 0, 0
-                            rows = [[f'{yearInit}-{monthInit}-{dayInit} 00:00:00', np.nan, yearInit, monthInit, dayInit, hourInit, minInit, secInit]]
-                            
-                            for j in range(191):
-                                
-                                minInit += 15
-
-                                if hourInit == 23 and minInit > 45:
-                                    
-                                    minInit = 0
-                                    hourInit = 0
-                                    dayInit += 1
-
-                                if minInit > 45:
-
-                                    minInit = 0
-                                    hourInit += 1
-                                
-                                rows.append([f'{yearInit}-{monthInit}-{dayInit} {hourInit}:{minInit}:00', np.nan, yearInit, monthInit, dayInit, hourInit, minInit, secInit])
-                            
-                            df2concat = pd.DataFrame(rows, columns=['date', f'{varname}', 'year', 'month', 'day', 'hour', 'minute', 'second'])
-
-                            df = pd.concat([df.iloc[:i], df2concat, df.iloc[i:]], ignore_index=True)
-
-                            day = df['day']
-                            
-                            leaps = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if ((x - y) == 28 and df['month'][i-1] == 2)]
-                            
-                            print('UPDATED indexes of months with 29 days: ', leaps)
-
-            # Add the 29th, 30th, and 31st days to the February(s):
-            day = df['day']
-            febs = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if (x - y) == 27]
-            print('These are the last indexes of the months with 28 days: ', febs)
-
-            while febs:
-                
-                for i in febs:
-                    
-                    if df['day'][i-1] == 28:
-                        
-                        startDate =  df.iloc[febs[0]-1, 0] 
-                        yearInit, monthInit, dayInit, hourInit, minInit, secInit = startDate.year, startDate.month, startDate.day + 1, 0, 0, 0
-                        rows = [[f'{yearInit}-{monthInit}-{dayInit} 00:00:00', np.nan, yearInit, monthInit, dayInit, hourInit, minInit, secInit]]
-                        
-                        for j in range(287):
-                
-                            minInit += 15
-
-                            if hourInit == 23 and minInit > 45:
-                                
-                                minInit = 0
-                                hourInit = 0
-                                dayInit += 1
-                                
-                            if minInit > 45:
-
-                                minInit = 0
-                                hourInit += 1
-                            
-                            rows.append([f'{yearInit}-{monthInit}-{dayInit} {hourInit}:{minInit}:00', np.nan, yearInit, monthInit, dayInit, hourInit, minInit, secInit])
-                            
-                        df2concat = pd.DataFrame(rows, columns=['date', f'{varname}', 'year', 'month', 'day', 'hour', 'minute', 'second'])
-
-                        df = pd.concat([df.iloc[:i], df2concat, df.iloc[i:]], ignore_index=True)
-
-                        day = df['day']
-                        
-                        febs = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if (x - y) == 27]
-                        
-                        print('UPDATED indexes of the months with 28 days: ', febs)
+            # Add the 31st day to those months with 30, and the 29th, 30th and 31st to the Februaries
+            df = padMonths(df, varname, timestep)
 
         # Store the index of the first Monday
         mondayIndex = findMonday(df)
@@ -283,93 +222,8 @@ def filler(File, timeframe, timestep, varname):
         
         if timeframe == 'a':
 
-            monthShort = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if ((x - y) == 29)]
-            # monthShort = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if ((x - y) == 29 or (i == (len(day) - 2) and y == 30))]
-            print('These are the last indexes of the months with 30 days: ', monthShort)
-
-            while monthShort:
-                
-                for i in monthShort:
-                    
-                    if df['day'][i-1] == 30:
-
-                        startDate =  df.iloc[monthShort[0]-1, 0]
-                        yearInit, monthInit, dayInit = startDate.year, startDate.month, startDate.day + 1
-                        rows = [[f'{yearInit}-{monthInit}-{dayInit} 00:00:00', np.nan, yearInit, monthInit, dayInit]]
-                        
-                        df2concat = pd.DataFrame(rows, columns=['date', f'{varname}', 'year', 'month', 'day'])
-                        
-                        df = pd.concat([df.iloc[:i], df2concat, df.iloc[i:]], ignore_index=True)
-                        
-                        day = df['day']
-                        
-                        monthShort = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if ((x - y) == 29)]
-                        
-                        print('UPDATED indexes of months with 30 days: ', monthShort)
-            
-            # Add the 30th and 31st days to those February(s) on leap years:
-            day = df['day']
-            leaps = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if ((x - y) == 28 and df['month'][i-1] == 2)]
-            print('These are the last indexes of the months with 29 days: ', leaps)
-            
-            if leaps: # Check if there are any leap years
-                
-                startDate =  df.iloc[leaps[0]-1, 0] 
-                yearInit, monthInit, dayInit = startDate.year, startDate.month, startDate.day + 1
-                rows = [[f'{yearInit}-{monthInit}-{dayInit} 00:00:00', np.nan, yearInit, monthInit, dayInit]]
-                
-                while leaps:
-                    
-                    for i in leaps:
-                        
-                        if df['day'][i-1] == 29:
-                            
-                            startDate =  df.iloc[leaps[0]-1, 0] 
-                            yearInit, monthInit, dayInit = startDate.year, startDate.month, startDate.day + 1
-                            rows = [[f'{yearInit}-{monthInit}-{dayInit} 00:00:00', np.nan, yearInit, monthInit, dayInit]]
-                            
-                            for j in range(1):
-                                
-                                rows.append([f'{yearInit}-{monthInit}-{(dayInit + (j + 1))} 00:00:00', np.nan, yearInit, monthInit, (dayInit + (j + 1))])
-
-                            df2concat = pd.DataFrame(rows, columns=['date', f'{varname}', 'year', 'month', 'day'])
-                            
-                            df = pd.concat([df.iloc[:i], df2concat, df.iloc[i:]], ignore_index=True)
-
-                            day = df['day']
-                            
-                            leaps = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if ((x - y) == 28 and df['month'][i-1] == 2)]
-                            
-                            print('UPDATED indexes of months with 29 days: ', leaps)
-            
-            # Add the 29th, 30th, and 31st days to the February(s):
-            day = df['day']
-            febs = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if (x - y) == 27]
-            print('These are the last indexes of the months with 28 days: ', febs)
-            
-            while febs:
-                
-                for i in febs:
-                    
-                    if df['day'][i-1] == 28:
-                        
-                        startDate =  df.iloc[febs[0]-1, 0]
-                        yearInit, monthInit, dayInit = startDate.year, startDate.month, startDate.day + 1
-                        rows = [[f'{yearInit}-{monthInit}-{dayInit} 00:00:00', np.nan, yearInit, monthInit, dayInit]]
-                        
-                        for j in range(2):
-                            
-                            rows.append([f'{yearInit}-{monthInit}-{(dayInit + (j + 1))} 00:00:00', np.nan, yearInit, monthInit, (dayInit + (j + 1))])
-                        
-                        df2concat = pd.DataFrame(rows, columns=['date', f'{varname}', 'year', 'month', 'day'])
-
-                        df = pd.concat([df.iloc[:i], df2concat, df.iloc[i:]], ignore_index=True)
-
-                        day = df['day']
-                        
-                        febs = [i + 1 for (x, y, i) in zip(day, day[1:], range(len(day))) if (x - y) == 27]
-                        
-                        print('UPDATED indexes of the months with 28 days: ', febs)
+            # Add the 31st day to those months with 30, and the 29th, 30th and 31st to the Februaries
+            df = padMonths(df, varname, timestep)
 
         # Store the index of the first Monday
         mondayIndex = findMonday(df)
@@ -1,28 +1,159 @@
 
 import os
+import logging
+import numpy as np
 import pandas as pd
 
-"""This function deletes those time spans across several variables 
+"""This function deletes those time spans across several variables
 with too many empty values, and iterates on the rest"""
 
+def nan_runs(isnull, groups, num_groups):
+
+    """Returns the number of NaN and the longest run of consecutive NaN of
+    every column in each group of rows, in one pass over all the columns.
+    The rows of a group are taken in their order, and runs never continue
+    from one group into another.
+    ---------
+    Arguments:
+    isnull: 2D boolean array (rows x columns), True where the value is NaN.
+    groups: The group of each row, from 0 to num_groups - 1.
+    num_groups: The number of groups.
+
+    Returns:
+    numNaN (ndarray): The number of NaN, shape (num_groups, columns).
+    consecNaN (ndarray): The longest run of NaN, shape (num_groups, columns)."""
+
+    num_columns = isnull.shape[1]
+
+    # Put the rows of each group together, keeping their order
+    order = np.argsort(groups, kind='stable')
+    groups = groups[order]
+    isnull = isnull[order]
+
+    # Index of the (group, column) pair of every value
+    keys = groups[:, np.newaxis] * num_columns + np.arange(num_columns)
+
+    numNaN = np.bincount(keys[isnull], minlength=num_groups * num_columns)
+
+    # A run starts at a NaN that does not follow a NaN of the same group
+    starts = isnull.copy()
+    starts[1:] &= ~(isnull[:-1] & (groups[1:] == groups[:-1])[:, np.newaxis])
+
+    # Number the runs column by column and measure their lengths
+    isnull, starts, keys = isnull.T.ravel(), starts.T.ravel(), keys.T.ravel()
+    run_ids = np.cumsum(starts) - 1
+    run_lengths = np.bincount(run_ids[isnull], minlength=np.count_nonzero(starts))
+
+    # Keep the longest run of each (group, column) pair
+    consecNaN = np.zeros(num_groups * num_columns, dtype=np.int64)
+    np.maximum.at(consecNaN, keys[starts], run_lengths)
+
+    return numNaN.reshape(num_groups, num_columns), consecNaN.reshape(num_groups, num_columns)
+
+def fill_column(x, y, order, neighbours):
+
+    """Fills the NaN runs of a column that lie between two values with
+    the spline of the given order through the neighbours valid points on
+    each side of the run, as df.interpolate(method='polynomial', order=order)
+    does with every valid point of the column. Runs closer than
+    2 * neighbours valid points share one spline. Leading and trailing NaN
+    are kept. The spline is linear for order 1, so the values are the same;
+    for order 2 the influence of the far points fades by a constant factor
+    per point, so with 32 neighbours it is below float rounding (the values
+    matched exactly in the checks, while 16 neighbours left up to 6e-11).
+    ---------
+    Arguments:
+    x: The positions of the values (the index of the data frame).
+    y: The values of the column.
+    order: The order of the spline.
+    neighbours: The number of valid points used on each side of a run.
+
+    Returns:
+    y (ndarray): The filled values.
+    gap_lengths (list): The length of each filled run."""
+
+    from scipy.interpolate import make_interp_spline
+
+    y = np.array(y, dtype=float)
+    isnull = np.isnan(y)
+    valid = np.flatnonzero(~isnull)
+    if len(valid) <= order:
+        return y, []
+
+    # Runs of NaN after the first and before the last valid value
+    inner = isnull.copy()
+    inner[:valid[0]] = False
+    inner[valid[-1] + 1:] = False
+    starts = np.flatnonzero(inner & ~np.r_[False, inner[:-1]])
+    ends = np.flatnonzero(inner & ~np.r_[inner[1:], False]) + 1
+    if len(starts) == 0:
+        return y, []
+
+    # Number of valid points before each run, and the groups of runs whose neighbourhoods overlap
+    splits = np.searchsorted(valid, starts)
+    breaks = np.flatnonzero(np.diff(splits) >= 2 * neighbours) + 1
+    firsts = np.r_[0, breaks]
+    lasts = np.r_[breaks, len(starts)] - 1
+
+    for first_run, last_run in zip(firsts, lasts):
+
+        # Take the closest valid points on both sides, at least order + 1 of them
+        first = max(0, min(splits[first_run] - neighbours, len(valid) - order - 1))
+        points = valid[first:max(splits[last_run] + neighbours, first + order + 1)]
+
+        spline = make_interp_spline(x[points], y[points], k=order, check_finite=False)
+        gap = np.flatnonzero(isnull[starts[first_run]:ends[last_run]]) + starts[first_run]
+        y[gap] = spline(x[gap])
+
+    return y, (ends - starts).tolist()
+
+def interpolate_gaps(df, order, neighbours=None, n_jobs=-1):
+
+    """Interpolates the NaN runs of every numeric column of df with
+    fill_column, one column per process.
+    ---------
+    Arguments:
+    df: The data frame; its index gives the positions of the values.
+    order: The order of the spline.
+    neighbours: The number of valid points used on each side of a run,
+    16 * order if None.
+    n_jobs: The number of processes, -1 uses all the CPUs.
+
+    Returns:
+    df (Pandas DataFrame): The interpolated data frame.
+    gap_lengths (list): The length of each filled run."""
+
+    from joblib import effective_n_jobs
+
+    columns = [col for col in df.select_dtypes('number').columns if df[col].isnull().any()]
+    x = df.index.to_numpy(dtype=float)
+
+    if neighbours is None:
+        neighbours = 16 * order
+
+    n_jobs = effective_n_jobs(n_jobs)
+
+    if n_jobs > 1 and len(columns) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(columns))) as executor:
+            filled = list(executor.map(fill_column, [x] * len(columns), [df[col].to_numpy() for col in columns],
+                                       [order] * len(columns), [neighbours] * len(columns)))
+    else:
+        filled = [fill_column(x, df[col].to_numpy(), order, neighbours) for col in columns]
+
+    df = df.copy()
+    gap_lengths = []
+    for col, (values, lengths) in zip(columns, filled):
+        df[col] = values
+        gap_lengths.extend(lengths)
+
+    return df, gap_lengths
+
 def mfilterer(File, timeframe, timestep):
 
     fileName, fileExtension = os.path.splitext(File)
     df = pd.read_csv(f'data/{fileName}.csv', delimiter=',')
 
-    years = list(dict.fromkeys(df['year'].tolist()))
-
-    months = list(dict.fromkeys(df['month'].tolist()))
-    months.sort()
-
-    weeks = list(dict.fromkeys(df['week'].tolist()))
-    weekOrder = list(dict.fromkeys(df['weekOrder'].tolist()))
-
-    startDate = list(df['startDate'])
-    endDate = list(df['endDate'])
-
-    days = list(dict.fromkeys(df['day'].tolist()))
-
     cols = list(df.columns.values.tolist())[1:-11]
 
     if timestep == '15 min':
@@ -32,183 +163,70 @@ def mfilterer(File, timeframe, timestep):
         limit_consecNaN_b = 24
         limit_numNaN_c = 20
         limit_consecNaN_c = 12
-        lenMonth = 2976
-        lenWeek = 627
 
     elif timestep == '1 day':
         limit_numNaN_a = 7
         limit_consecNaN_a = 5
         limit_numNaN_b = 3
         limit_consecNaN_b = 2
-        lenMonth = 31
-        lenWeek = 7
 
     if timeframe == 'a':
+        # Months with too many NaN (or consecutive NaN) in three or more variables
+        group_columns, limit_numNaN, limit_consecNaN, min_variables = ['year', 'month'], limit_numNaN_a, limit_consecNaN_a, 3
 
-        indexInit, indexEnd = [], []
-        numNaN, consecNaN = [], []
-        for i in years:
-
-            df = df.loc[df['year'] == i]
-            
-            for j in months:
-                
-                df = df.loc[df['month'] == j]
-
-                if df.empty == True:
-                    pass
-                elif df.empty == False:
-
-                    # Get total number of NaN and the max consecutive NaNs
-                    for k in cols:
-
-                        numNaN.append(df[k].isnull().sum())
-                        consecNaN.append(max(df[k].isnull().astype(int).groupby(df[k].notnull().astype(int).cumsum()).sum()))
-
-                    # Count the number of NaN higher than 480 and the number of consecNaN higher than 192
-                    count_numNaN = sum(map(lambda x: x >= limit_numNaN_a, numNaN))
-                    count_consecNaN = sum(map(lambda x: x >= limit_consecNaN_a, consecNaN))
-                    
-                    # Get the first and last index of those months with too many empty (or consecutive) values 
-                    # in several variables (NaN in this case)
-                    if count_numNaN >= 3 or count_consecNaN >= 3:
-                        indexInit.append(df.index[0])
-                        indexEnd.append(df.index[-1])
-
-                    # Clean numNaN and consecNaN
-                    numNaN, consecNaN = [], []
-
-                    df = pd.read_csv(f'data/{fileName}.csv', delimiter=',')
-                    
-                    if j == 12:
-                        df = df.loc[df['year'] == (i+1)]
-                    else:
-                        df = df.loc[df['year'] == i]
-
-        # Delete those parts of the data frame between the appended indices
-        df = pd.read_csv(f'data/{fileName}.csv', delimiter=',')
-
-        counter = 0
-        # lenMonth = 2976
-        for i,j in zip(indexInit, indexEnd):
-
-            df = df.drop(df.index[int(i-counter*lenMonth):int(j-counter*lenMonth+1)], inplace=False)
-            counter += 1
-        
-        # Interpolate the remaining empty values
-        df = (df.interpolate(method='polynomial', order=1)).round(2)
-
-        # Delete the columns needed for preprocessing
-        df = df.drop(columns=['year', 'month', 'day', 'hour', 'minute', 'second', 'startDate', 'endDate', 'weekOrder'])
-        
-        # Save the data frame
-        cols = list(df.columns.values.tolist())
-        df.to_csv(f'data/{fileName}_pro.csv', sep=',', encoding='utf-8', index=False, header=cols)
+        # Polynomial order of the interpolation
+        order = 1
 
     elif timeframe == 'b':
-        
-        weeks = [i for i in weeks if i != 0] # Remove the 0s
-
-        indexInit, indexEnd = [], []
-        numNaN, consecNaN = [], []
-        for i in weeks:
-            
-            df = df.loc[df['week'] == i]
-
-            if df.empty == True:
-                pass
-            elif df.empty == False:
-            
-                # Get total number of NaN and the max consecutive NaNs
-                for k in cols:
-                    
-                    numNaN.append(df[k].isnull().sum())
-                    consecNaN.append(max(df[k].isnull().astype(int).groupby(df[k].notnull().astype(int).cumsum()).sum()))
-                
-                # Count the number of NaN higher than 192 and the number of consecNaN higher than 24
-                count_numNaN = sum(map(lambda x: x >= limit_numNaN_b, numNaN))
-                count_consecNaN = sum(map(lambda x: x >= limit_consecNaN_b, consecNaN))
-                
-                # Get the first and last index of those months with too many empty (or consecutive) values 
-                # in several variables (NaN in this case)
-                if count_numNaN >= 3 or count_consecNaN >= 3:
-                    indexInit.append(df.index[0])
-                    indexEnd.append(df.index[-1])
-                
-                # Clean numNaN and consecNaN
-                numNaN, consecNaN = [], []
-                
-                df = pd.read_csv(f'data/{fileName}.csv', delimiter=',')
-            
-        # Delete those parts of the data frame between the appended indices
-        df = pd.read_csv(f'data/{fileName}.csv', delimiter=',')
-        
-        counter = 0
-        lenWeek = 672
-        for i,j in zip(indexInit, indexEnd):
-            
-            df = df.drop(df.index[int(i-counter*lenWeek):int(j-counter*lenWeek+1)], inplace=False)
-            counter += 1
-        
-        # Interpolate the remaining empty values
-        df = (df.interpolate(method='polynomial', order=1)).round(2)
-        
-        # Delete the columns needed for preprocessing
-        df = df.drop(columns=['year', 'month', 'day', 'hour', 'minute', 'second', 'startDate', 'endDate', 'weekOrder'])
-
-        # Save the data frame
-        cols = list(df.columns.values.tolist())
-        df.to_csv(f'data/{fileName}_pro.csv', sep=',', encoding='utf-8', index=False, header=cols)
-        
-    elif timeframe == 'c':
+        # Weeks with too many NaN (or consecutive NaN) in three or more variables
+        group_columns, limit_numNaN, limit_consecNaN, min_variables = ['week'], limit_numNaN_b, limit_consecNaN_b, 3
+        order = 1
 
-        indexInit, indexEnd = [], []
-        numNaN, consecNaN = [], []
-        
-        for i in years:
-
-            for j in months:
-
-                for k in days:
-
-                    filtered_df = df.loc[(df['year'] == i) & (df['month'] == j) & (df['day'] == k)]
-
-                    if not filtered_df.empty:
-                    
-                        # Get total number of NaN and the max consecutive NaNs
-                        for l in cols:
-
-                            numNaN.append(filtered_df[l].isnull().sum())
-                            consecNaN.append(max(filtered_df[l].isnull().astype(int).groupby(filtered_df[l].notnull().astype(int).cumsum()).sum()))
-
-                        # Count the number of NaN higher than 24 and the number of consecNaN higher than 8
-                        count_numNaN = sum(map(lambda x: x >= limit_numNaN_c, numNaN))
-                        count_consecNaN = sum(map(lambda x: x >= limit_consecNaN_c, consecNaN))
-                        
-                        # Get the first and last index of those days with too many empty (or consecutive) values 
-                        # in one variable (NaN in this case)
-                        if count_numNaN >= 1 or count_consecNaN >= 1:
-                            # print('here')
-                            indexInit.append(filtered_df.index[0])
-                            indexEnd.append(filtered_df.index[-1])
-                        
-                        # Clean numNaN and consecNaN
-                        numNaN, consecNaN = [], []
-        
-        # Drop rows based on the filtered indices
-        rows_to_drop = []
-        for i, j in zip(indexInit, indexEnd):
-            rows_to_drop.extend(range(i, j + 1))
-
-        # Drop the rows using DataFrame.loc with inverse boolean indexing
-        df = df.drop(df.index[rows_to_drop])
-
-        # Interpolate the remaining empty values
-        df = (df.interpolate(method='polynomial', order=2)).round(2)
-
-        # Delete the columns needed for preprocessing
-        df = df.drop(columns=['year', 'month', 'day', 'hour', 'minute', 'second', 'startDate', 'endDate', 'weekOrder'])
-
-        # Save the data frame
-        cols = list(df.columns.values.tolist())
-        df.to_csv(f'data/{fileName}_pro.csv', sep=',', encoding='utf-8', index=False, header=cols)
+    elif timeframe == 'c':
+        # Days with too many NaN (or consecutive NaN) in one variable
+        group_columns, limit_numNaN, limit_consecNaN, min_variables = ['year', 'month', 'day'], limit_numNaN_c, limit_consecNaN_c, 1
+        order = 2
+
+    # Number the time spans, the rows out of week (week 0) do not belong to any
+    groups = df.groupby(group_columns, sort=False).ngroup().to_numpy().copy()
+    if timeframe == 'b':
+        groups[df['week'].to_numpy() == 0] = -1
+    in_span = groups >= 0
+    positions = np.flatnonzero(in_span)
+    groups = groups[in_span]
+    num_groups = groups.max() + 1 if len(groups) else 0
+
+    # Get total number of NaN and the max consecutive NaNs of every variable in every span
+    numNaN, consecNaN = nan_runs(df[cols].isnull().to_numpy()[in_span], groups, num_groups)
+
+    # Get the spans with too many empty (or consecutive) values in several variables (NaN in this case)
+    count_numNaN = (numNaN >= limit_numNaN).sum(axis=1)
+    count_consecNaN = (consecNaN >= limit_consecNaN).sum(axis=1)
+    offending = (count_numNaN >= min_variables) | (count_consecNaN >= min_variables)
+
+    # Get the first and last row of each span
+    indexInit = np.full(num_groups, len(df))
+    indexEnd = np.full(num_groups, -1)
+    np.minimum.at(indexInit, groups, positions)
+    np.maximum.at(indexEnd, groups, positions)
+
+    # Delete every row from the first to the last one of the offending spans with a single mask
+    bounds = np.zeros(len(df) + 1, dtype=np.int64)
+    np.add.at(bounds, indexInit[offending], 1)
+    np.add.at(bounds, indexEnd[offending] + 1, -1)
+    df = df[np.cumsum(bounds[:-1]) == 0]
+
+    # Interpolate the remaining empty values around each gap
+    df, gap_lengths = interpolate_gaps(df, order=order)
+    df = df.round(2)
+    if gap_lengths:
+        logging.info(f'mfilterer() {fileName} filled {len(gap_lengths)} gaps, mean length {np.mean(gap_lengths):.1f}, longest {max(gap_lengths)}')
+    else:
+        logging.info(f'mfilterer() {fileName} filled 0 gaps')
+
+    # Delete the columns needed for preprocessing
+    df = df.drop(columns=['year', 'month', 'day', 'hour', 'minute', 'second', 'startDate', 'endDate', 'weekOrder'])
+
+    # Save the data frame
+    cols = list(df.columns.values.tolist())
+    df.to_csv(f'data/{fileName}_pro.csv', sep=',', encoding='utf-8', index=False, header=cols)
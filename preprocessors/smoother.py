@@ -1,16 +1,52 @@
+import numpy as np
 import pandas as pd
 
 from tictoc import tictoc
 
-# Smooths a column of data using a moving average with specified window size and stride
-def smooth_column(column_data, window_size, stride):
-    smoothed_values = []
-    for i in range(0, len(column_data), stride):
-        window_start = max(0, i - window_size // 2)
-        window_end = min(len(column_data), i + window_size // 2 + 1)
-        window = column_data[window_start:window_end]
-        smoothed_values.append(window.mean())
-    return smoothed_values
+# Smooths every column of an array using a centered moving average with specified window size and stride
+def centered_mean(values, window_size, stride):
+
+    """Returns, for every stride-th row i, the mean of the rows
+    i - window_size // 2 to i + window_size // 2 of each column, clipped at
+    the ends of the array and skipping NaN values, as Series.mean() of those
+    rows does. The window is added one offset at a time over the whole array,
+    so the values are summed in the same order as the row by row mean and
+    are bit-identical to it for windows of up to 7 rows (window_size < 8,
+    e.g. the 4 used by smoother). Longer windows match to within float
+    rounding (a few 1e-16), as numpy sums 8 or more values in unrolled,
+    pairwise blocks.
+    ---------
+    Arguments:
+    values: 2D array (rows x variables) with the data to smooth.
+    window_size: The size of the moving average window.
+    stride: The step between the smoothed rows.
+
+    Returns:
+    smoothed_values (ndarray): The smoothed rows of each column."""
+
+    values = np.asarray(values, dtype=float)
+    half = window_size // 2
+    num_rows = len(values)
+
+    # Pad with zeros so the windows at the ends only add their existing rows
+    valid = ~np.isnan(values)
+    padded_values = np.zeros((num_rows + 2 * half,) + values.shape[1:])
+    padded_values[half:half + num_rows] = np.where(valid, values, 0)
+    padded_counts = np.zeros(padded_values.shape, dtype=np.int64)
+    padded_counts[half:half + num_rows] = valid
+
+    # Add the rows at each offset of the window
+    sums = padded_values[:num_rows].copy()
+    counts = padded_counts[:num_rows].copy()
+    for offset in range(1, 2 * half + 1):
+        sums += padded_values[offset:offset + num_rows]
+        counts += padded_counts[offset:offset + num_rows]
+
+    # Windows without any value are NaN
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed_values = np.where(counts > 0, sums / counts, np.nan)
+
+    return smoothed_values[::stride]
 
 @tictoc
 def smoother(station):
@@ -35,15 +71,8 @@ def smoother(station):
     stride = 1
     smoothed_data = data.copy()
 
-    # Smoothed the data using parallelization to speed it up
-    from concurrent.futures import ProcessPoolExecutor
-    with ProcessPoolExecutor() as executor:
-        smoothed_columns = executor.map(smooth_column, 
-                                        [data[col] for col in data.columns[1:-2]],
-                                        [window_size] * (len(data.columns[1:-2])),
-                                        [stride] * (len(data.columns[1:-2])))
-        
-        for col, smoothed_values in zip(data.columns[1:-2], smoothed_columns):
-            smoothed_data[col] = smoothed_values
+    # Smooth all the variables at once
+    columns = data.columns[1:-2]
+    smoothed_data[columns] = centered_mean(data[columns].to_numpy(dtype=float), window_size, stride)
 
     smoothed_data.to_csv(f'data/labeled_{station}_smo.csv', encoding='utf-8', sep=',', index=False)
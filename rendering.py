@@ -0,0 +1,112 @@
+import pickle
+import matplotlib.pyplot as plt
+
+from joblib import effective_n_jobs
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.backends.backend_pdf import PdfPages
+
+"""This file contains the Renderer class which draws the explanation
+figures of the results scripts in a pool of processes. The explanations
+are computed first and each plotter call (event_plotter, attention_plotter,
+threshold_plotter, ...) is sent to a worker as it is, so the figures are
+the same ones the plotters save when called directly."""
+
+def _set_render_state():
+
+    """Initializes a worker: the figures are drawn with the Agg backend,
+    which needs no display, and pyplot and seaborn stay loaded for every
+    figure the worker draws."""
+
+    plt.switch_backend('Agg')
+
+class _PageCollector():
+
+    """Stands in for the PdfPages of a worker: the figures are pickled
+    and sent back, so the main process adds them to the single PDF."""
+
+    def __init__(self) -> None:
+
+        self.pages = []
+
+    def savefig(self, fig, **kwargs):
+
+        self.pages.append((pickle.dumps(fig), kwargs))
+
+def _render(plotter, args, kwargs, collect):
+
+    """Runs a plotter in a worker and closes any figure it leaves open.
+    Returns the pickled pages when the figures go to a multi-page PDF."""
+
+    pages = _PageCollector() if collect else None
+    try:
+        if collect:
+            plotter(*args, pdf=pages, **kwargs)
+        else:
+            plotter(*args, **kwargs)
+    finally:
+        plt.close('all')
+
+    return pages.pages if collect else []
+
+class Renderer():
+
+    def __init__(self, n_jobs=-1, pdf_path=None) -> None:
+
+        """Arguments:
+        n_jobs: the number of worker processes, as in joblib: -1 uses all
+        the CPUs, -2 all but one, and 1 draws the figures in the calling
+        process.
+        pdf_path: the path of a multi-page PDF to put every figure in,
+        e.g. f'results/report_{station}.pdf'. The pages keep the order of
+        the submissions. If None each plotter saves its own file."""
+
+        self.n_jobs = effective_n_jobs(n_jobs)
+        self.pdf = PdfPages(pdf_path) if pdf_path is not None else None
+        self.futures = []
+
+        self._executor = None
+        if self.n_jobs > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_set_render_state)
+
+    def submit(self, plotter, *args, **kwargs):
+
+        """Queues a plotter call. The arguments are sent to a worker, so
+        they should be the computed explanation arrays rather than the
+        whole (memory-mapped) datasets."""
+
+        if self._executor is None:
+            if self.pdf is not None:
+                kwargs['pdf'] = self.pdf
+            plotter(*args, **kwargs)
+            plt.close('all')
+            return
+
+        self.futures.append(self._executor.submit(_render, plotter, args, kwargs, self.pdf is not None))
+
+    def close(self):
+
+        """Waits for every figure and writes the multi-page PDF, if any.
+        Errors raised by the plotters are raised here."""
+
+        try:
+            for future in self.futures:
+                for page, kwargs in future.result():
+                    fig = pickle.loads(page)
+                    self.pdf.savefig(fig, **kwargs)
+                    plt.close(fig)
+        finally:
+            self.futures = []
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self.pdf is not None:
+                self.pdf.close()
+                self.pdf = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
@@ -12,32 +12,14 @@ warnings.filterwarnings('ignore')
 
 from sklearn import tree
 
-from utils import dater, event_plotter, depths, attention, multivariate_attention, thresholds, distances, kl_divergence
+from utils import dater, event_series, window_plotter, depths, forest_structure, attention, multivariate_attention, thresholds, distances, kl_divergence, divergence_matrix
 from utils import attention_plotter, multivariate_attention_plotter, threshold_plotter, distance_plotter, kl_plotter, tree_plotter
+from datastore import load_windows, EventIndex
+from rendering import Renderer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_starts_ends(num_win_high, num_win_med, num_win_low):
-
-    """Extacts the start and end window index for each resolution and save it in a 2D list"""
-
-    starts_ends = []
-    for event_number in range(len(num_win_high)):
-
-        event_start_high = sum(num_win_high[:event_number]) + event_number
-        event_end_high = sum(num_win_high[:event_number + 1]) + 1 + event_number
-
-        event_start_med = sum(num_win_med[:event_number]) + event_number
-        event_end_med = sum(num_win_med[:event_number + 1]) + 1 + event_number
-
-        event_start_low = sum(num_win_low[:event_number]) + event_number
-        event_end_low = sum(num_win_low[:event_number + 1]) + 1 + event_number
-
-        starts_ends.append([[event_start_high, event_end_high], [event_start_med, event_end_med], [event_start_low, event_end_low]])
-
-    return starts_ends
-
 def majority_vote(high, med, low):
     
     vote_high = sum(high) / len(high)
@@ -67,18 +49,18 @@ if __name__ == '__main__':
     filename = f'models/rf_model_low_{iteration}.sav'
     model_low = pickle.load(open(filename, 'rb'))
 
+    # Get the flattened tree structures, cached next to the models
+    structures = [forest_structure(model, f'models/rf_model_{resolution}_{iteration}.sav')
+                  for model, resolution in zip([model_high, model_med, model_low], ['high', 'med', 'low'])]
+
     # # Plot a tree
     # tree_plotter(model_high, 'high', tree_number=0)
 
-    # Load the anomalies data
-    file_anomalies = open(f'pickels/anomaly_data_pred.pkl', 'rb')
-    anomalies_windows = pickle.load(file_anomalies)
-    file_anomalies.close()
+    # Load the anomalies data, memory-mapped
+    anomalies_windows = load_windows('pickels/anomaly_data_pred')
     
-    # Load the background data
-    file_background = open(f'pickels/background_data_pred.pkl', 'rb')
-    background_windows = pickle.load(file_background)
-    file_background.close()
+    # Load the background data, memory-mapped
+    background_windows = load_windows('pickels/background_data_pred')
 
     # Get windowed data and rename it to X_anomalies and X_background
     X_anomalies = anomalies_windows[0]
@@ -88,18 +70,9 @@ if __name__ == '__main__':
     lengths_anomalies = anomalies_windows[-1]
     lengths_background = background_windows[-1]
 
-    # Get the number of windows for each resolution, anomalies and background
-    number_windows_high_anomalies = [i - window_size_high + 1 for i in lengths_anomalies]
-    number_windows_med_anomalies = [i - window_size_med + 1 for i in lengths_anomalies]
-    number_windows_low_anomalies = [i - window_size_low + 1 for i in lengths_anomalies]
-
-    number_windows_high_background = [i - window_size_high + 1 for i in lengths_background]
-    number_windows_med_background = [i - window_size_med + 1 for i in lengths_background]
-    number_windows_low_background = [i - window_size_low + 1 for i in lengths_background]
-
-    # Find the start and end window index for each resolution and save it in a 2D list
-    starts_ends_anomalies = get_starts_ends(number_windows_high_anomalies, number_windows_med_anomalies, number_windows_low_anomalies)
-    starts_ends_background = get_starts_ends(number_windows_high_background, number_windows_med_background, number_windows_low_background)
+    # Load the start and end window index of each event for each resolution, saved with the windows
+    starts_ends_anomalies = EventIndex.load('pickels/anomaly_data_pred')
+    starts_ends_background = EventIndex.load('pickels/background_data_pred')
     
     # Read background results
     y_hats_high = np.load('preds/y_hats_high.npy', allow_pickle=False, fix_imports=False)
@@ -116,10 +89,19 @@ if __name__ == '__main__':
     print('True background:', background_background_events)
 
     # Get the number of actual anomalous events
-    anomalies_events = range(len(number_windows_high_anomalies))
+    anomalies_events = range(len(starts_ends_anomalies))
 
     # Initialize the list to store the multivariate attention maps to get the Kullback-Leibler divergence among them
     attention_multivariate_maps = [[], [], []]
+    attention_events = [[], [], []]
+
+    # Draw the figures in a pool of processes, set multipage to put them all in one PDF per station
+    multipage = False
+    renderer = Renderer(n_jobs=-1, pdf_path=f'results/report_{station}.pdf' if multipage else None)
+
+    # Compare every explained event with all the others through the Kullback-Leibler divergence of their multivariate attention maps
+    compare_events = False
+
     #%% Get the results for the labeled anomalies
     for event_number_main in anomalies_events:
         if event_number_main == 1:
@@ -130,12 +112,14 @@ if __name__ == '__main__':
             starts_ends = starts_ends_anomalies
             X = X_anomalies
 
-            # Plot the event
-            event_plotter(starts_ends, X, event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished event plot')
+            # Plot the event, sending only its series to the renderer
+            event_data = event_series(starts_ends, X, event_number_main, station=station)
+            rows = starts_ends.event_rows(event_number_main) if starts_ends.rows is not None else None
+            renderer.submit(window_plotter, data=event_data, num_variables=6, legend=True, event_number=event_number_main, station=station, type=data_type[:2], rows=rows)
+            logging.info('Queued event plot')
 
             # Get the depths of the variables
-            variables_depths, variables_thresholds, variables_distances, max_depth = depths(starts_ends, X, models=[model_high, model_med, model_low], event_number=event_number_main)
+            variables_depths, variables_thresholds, variables_distances, max_depth = depths(starts_ends, X, models=[model_high, model_med, model_low], event_number=event_number_main, structures=structures)
 
             # Get the attention maps
             attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt = attention(variables_depths, max_depth)
@@ -151,24 +135,25 @@ if __name__ == '__main__':
 
             # Plot the attention
             attention_maps = [attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt]
-            attention_plotter(attention_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            renderer.submit(attention_plotter, attention_maps, event_number=event_number_main, station=station, type=data_type[:2])
 
             # Plot the multivariate attention
-            multivariate_attention_plotter(attention_multivariate, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished attention maps')
+            renderer.submit(multivariate_attention_plotter, attention_multivariate, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued attention maps')
 
             # Plot the threshold
             threshold_maps = [threshold_am, threshold_co, threshold_do, threshold_ph, threshold_tu, threshold_wt]
-            threshold_plotter(threshold_maps, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished threshold maps')
+            renderer.submit(threshold_plotter, threshold_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued threshold maps')
 
             # Plot the distance
             distance_maps = [distance_am, distance_co, distance_do, distance_ph, distance_tu, distance_wt]
-            distance_plotter(distance_maps, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished distance maps')
+            renderer.submit(distance_plotter, distance_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued distance maps')
 
             # Store the multivariate attention map
             attention_multivariate_maps[0].append(attention_multivariate)
+            attention_events[0].append(event_number_main)
     
     #%% Get the results for the detected anomalies
     for event_number_main in background_anomalies_events:
@@ -180,12 +165,14 @@ if __name__ == '__main__':
             starts_ends = starts_ends_background
             X = X_background
 
-            # Plot the event
-            event_plotter(starts_ends, X, event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished event plot')
+            # Plot the event, sending only its series to the renderer
+            event_data = event_series(starts_ends, X, event_number_main, station=station)
+            rows = starts_ends.event_rows(event_number_main) if starts_ends.rows is not None else None
+            renderer.submit(window_plotter, data=event_data, num_variables=6, legend=True, event_number=event_number_main, station=station, type=data_type[:2], rows=rows)
+            logging.info('Queued event plot')
 
             # Get the depths of the variables
-            variables_depths, variables_thresholds, variables_distances, max_depth = depths(starts_ends, X, models=[model_high, model_med, model_low], event_number=event_number_main)
+            variables_depths, variables_thresholds, variables_distances, max_depth = depths(starts_ends, X, models=[model_high, model_med, model_low], event_number=event_number_main, structures=structures)
 
             # Get the attention maps
             attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt = attention(variables_depths, max_depth)
@@ -201,24 +188,25 @@ if __name__ == '__main__':
 
             # Plot the attention
             attention_maps = [attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt]
-            attention_plotter(attention_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            renderer.submit(attention_plotter, attention_maps, event_number=event_number_main, station=station, type=data_type[:2])
 
             # Plot the multivariate attention
-            multivariate_attention_plotter(attention_multivariate, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished attention maps')
+            renderer.submit(multivariate_attention_plotter, attention_multivariate, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued attention maps')
 
             # Plot the threshold
             threshold_maps = [threshold_am, threshold_co, threshold_do, threshold_ph, threshold_tu, threshold_wt]
-            threshold_plotter(threshold_maps, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished threshold maps')
+            renderer.submit(threshold_plotter, threshold_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued threshold maps')
 
             # Plot the distance
             distance_maps = [distance_am, distance_co, distance_do, distance_ph, distance_tu, distance_wt]
-            distance_plotter(distance_maps, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished distance maps')
+            renderer.submit(distance_plotter, distance_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued distance maps')
 
             # Store the multivariate attention map
             attention_multivariate_maps[1].append(attention_multivariate)
+            attention_events[1].append(event_number_main)
 
     #%% Get the results for the true background events
     for event_number_main in background_background_events:
@@ -230,12 +218,14 @@ if __name__ == '__main__':
             starts_ends = starts_ends_background
             X = X_background
 
-            # Plot the event
-            event_plotter(starts_ends, X, event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished event plot')
+            # Plot the event, sending only its series to the renderer
+            event_data = event_series(starts_ends, X, event_number_main, station=station)
+            rows = starts_ends.event_rows(event_number_main) if starts_ends.rows is not None else None
+            renderer.submit(window_plotter, data=event_data, num_variables=6, legend=True, event_number=event_number_main, station=station, type=data_type[:2], rows=rows)
+            logging.info('Queued event plot')
 
             # Get the depths of the variables
-            variables_depths, variables_thresholds, variables_distances, max_depth = depths(starts_ends, X, models=[model_high, model_med, model_low], event_number=event_number_main)
+            variables_depths, variables_thresholds, variables_distances, max_depth = depths(starts_ends, X, models=[model_high, model_med, model_low], event_number=event_number_main, structures=structures)
 
             # Get the attention maps
             attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt = attention(variables_depths, max_depth)
@@ -251,130 +241,49 @@ if __name__ == '__main__':
 
             # Plot the attention
             attention_maps = [attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt]
-            attention_plotter(attention_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            renderer.submit(attention_plotter, attention_maps, event_number=event_number_main, station=station, type=data_type[:2])
 
             # Plot the multivariate attention
-            multivariate_attention_plotter(attention_multivariate, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished attention maps')
+            renderer.submit(multivariate_attention_plotter, attention_multivariate, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued attention maps')
 
             # Plot the threshold
             threshold_maps = [threshold_am, threshold_co, threshold_do, threshold_ph, threshold_tu, threshold_wt]
-            threshold_plotter(threshold_maps, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished threshold maps')
+            renderer.submit(threshold_plotter, threshold_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued threshold maps')
 
             # Plot the distance
             distance_maps = [distance_am, distance_co, distance_do, distance_ph, distance_tu, distance_wt]
-            distance_plotter(distance_maps, event_number=event_number_main, station=station, type=data_type[:2])
-            logging.info('Finished distance maps')
+            renderer.submit(distance_plotter, distance_maps, event_number=event_number_main, station=station, type=data_type[:2])
+            logging.info('Queued distance maps')
 
             # Store the multivariate attention map
             attention_multivariate_maps[2].append(attention_multivariate)
+            attention_events[2].append(event_number_main)
 
-    # # Save the attention maps. This wont work when dealing with all samples, because there are different number of anomalies, detected anomalies and true background events
-    # np.save(f'results/attention_multivariate_maps_{station}.npy', attention_multivariate_maps)
-
-    # # Load the attention maps
-    # # attention_multivariate_maps = np.load(f'results/attention_multivariate_maps_{station}.npy', allow_pickle=True, fix_imports=False).tolist()
-
-    # #%% Get the Kullback-Leibler divergence between each anomaly, detected anomaly and true background with every other event
-    # kl_distances = [[], [], []]
-    # # TODO: the following code can be optimized
-    # # Compare the labeled anomalies
-    # for event_number, event_attention in zip(anomalies_events, attention_multivariate_maps[0]):
-
-    #     data_type = 'anomalies'
-
-    #     # Compare with the labeled anomalies
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[0]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[0].append(kl_distance)
-        
-    #     # Compare with the detected anomalies
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[1]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[1].append(kl_distance)
-        
-    #     # Compare with the true background
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[2]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[2].append(kl_distance)
-
-    #     # Plot the KL divergences
-    #     kl_plotter(kl_distances, event_number, station, data_type[:2])
-
-    #     # Reset the list
-    #     kl_distances = [[], [], []]
-    # logging.info('Finished kl distances with labeled anomalies')
-    
-    # # Compare the detected anomalies
-    # for event_number, event_attention in zip(background_anomalies_events, attention_multivariate_maps[1]):
-        
-    #     data_type = 'background'
-
-    #     # Compare with the labeled anomalies
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[0]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[0].append(kl_distance)
-        
-    #     # Compare with the detected anomalies
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[1]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[1].append(kl_distance)
-        
-    #     # Compare with the true background
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[2]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[2].append(kl_distance)
+    #%% Get the Kullback-Leibler divergence between each explained anomaly, detected anomaly and true background and every other one
+    if compare_events and any(attention_events):
+        # All the pairs are computed at once on the stacked maps of the three groups
+        kl_matrix = divergence_matrix(attention_multivariate_maps[0] + attention_multivariate_maps[1] + attention_multivariate_maps[2], metric='kl')
+        bounds = np.cumsum([0] + [len(maps) for maps in attention_multivariate_maps])
 
-    #     # Plot the KL divergences
-    #     kl_plotter(kl_distances, event_number, station, data_type[:2])
+        for group, data_type in enumerate(['anomalies', 'background', 'background']):
+            for i, event_number in enumerate(attention_events[group]):
 
-    #     # Reset the list
-    #     kl_distances = [[], [], []]
-    # logging.info('Finished kl distances with detected anomalies')
-        
-    # # Compare the true background
-    # for event_number, event_attention in zip(background_background_events, attention_multivariate_maps[2]):
-            
-    #     data_type = 'background'
+                # Split the row of the event by the group being compared to
+                row = kl_matrix[bounds[group] + i]
+                kl_distances = [row[bounds[j]:bounds[j + 1]].tolist() for j in range(3)]
 
-    #     # Compare with the labeled anomalies
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[0]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[0].append(kl_distance)
-        
-    #     # Compare with the detected anomalies
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[1]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[1].append(kl_distance)
-        
-    #     # Compare with the true background
-    #     for compare_event_number, compare_event_attention in enumerate(attention_multivariate_maps[2]):
-    #         kl_distance = kl_divergence(event_attention, compare_event_attention)
-            
-    #         # Append to the corresponding list based on the group being compared to
-    #         kl_distances[2].append(kl_distance)
+                # Plot the KL divergences
+                renderer.submit(kl_plotter, kl_distances, event_number, station, data_type[:2])
+        logging.info('Queued kl distances')
 
-    #     # Plot the KL divergences
-    #     kl_plotter(kl_distances, event_number, station, data_type[:2])
+    # Wait for the figures
+    renderer.close()
+    logging.info('Finished figures')
 
-    #     # Reset the list
-    #     kl_distances = [[], [], []]
+    # # Save the attention maps. This wont work when dealing with all samples, because there are different number of anomalies, detected anomalies and true background events
+    # np.save(f'results/attention_multivariate_maps_{station}.npy', attention_multivariate_maps)
 
-    # logging.info('Finished kl distances with background')
+    # # Load the attention maps
+    # # attention_multivariate_maps = np.load(f'results/attention_multivariate_maps_{station}.npy', allow_pickle=True, fix_imports=False).tolist()
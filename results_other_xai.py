@@ -11,32 +11,13 @@ shap.initjs()
 from treeinterpreter import treeinterpreter as ti
 
 from utils import summarizer
+from datastore import load_windows, EventIndex
 
 """This program is used to explain the predictions of the model on a particuar event using the treeexplainer and SHAP explainer."""
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_starts_ends(num_win_high, num_win_med, num_win_low):
-
-    """Extacts the start and end window index for each resolution and save it in a 2D list"""
-
-    starts_ends = []
-    for event_number in range(len(num_win_high)):
-
-        event_start_high = sum(num_win_high[:event_number]) + event_number
-        event_end_high = sum(num_win_high[:event_number + 1]) + 1 + event_number
-
-        event_start_med = sum(num_win_med[:event_number]) + event_number
-        event_end_med = sum(num_win_med[:event_number + 1]) + 1 + event_number
-
-        event_start_low = sum(num_win_low[:event_number]) + event_number
-        event_end_low = sum(num_win_low[:event_number + 1]) + 1 + event_number
-
-        starts_ends.append([[event_start_high, event_end_high], [event_start_med, event_end_med], [event_start_low, event_end_low]])
-
-    return starts_ends
-
 def majority_vote(high, med, low):
     
     vote_high = sum(high) / len(high)
@@ -345,15 +326,11 @@ if __name__ == '__main__':
     filename = f'models/rf_model_low_{iteration}.sav'
     model_low = pickle.load(open(filename, 'rb'))
 
-    # Load the anomalies data
-    file_anomalies = open(f'pickels/anomaly_data_pred.pkl', 'rb')
-    anomalies_windows = pickle.load(file_anomalies)
-    file_anomalies.close()
+    # Load the anomalies data, memory-mapped
+    anomalies_windows = load_windows('pickels/anomaly_data_pred')
     
-    # Load the background data
-    file_background = open(f'pickels/background_data_pred.pkl', 'rb')
-    background_windows = pickle.load(file_background)
-    file_background.close()
+    # Load the background data, memory-mapped
+    background_windows = load_windows('pickels/background_data_pred')
 
     # Get windowed data and rename it to X_anomalies and X_background
     X_anomalies = anomalies_windows[0]
@@ -363,18 +340,9 @@ if __name__ == '__main__':
     lengths_anomalies = anomalies_windows[-1]
     lengths_background = background_windows[-1]
 
-    # Get the number of windows for each resolution, anomalies and background
-    number_windows_high_anomalies = [i - window_size_high + 1 for i in lengths_anomalies]
-    number_windows_med_anomalies = [i - window_size_med + 1 for i in lengths_anomalies]
-    number_windows_low_anomalies = [i - window_size_low + 1 for i in lengths_anomalies]
-
-    number_windows_high_background = [i - window_size_high + 1 for i in lengths_background]
-    number_windows_med_background = [i - window_size_med + 1 for i in lengths_background]
-    number_windows_low_background = [i - window_size_low + 1 for i in lengths_background]
-
-    # Find the start and end window index for each resolution and save it in a 2D list
-    starts_ends_anomalies = get_starts_ends(number_windows_high_anomalies, number_windows_med_anomalies, number_windows_low_anomalies)
-    starts_ends_background = get_starts_ends(number_windows_high_background, number_windows_med_background, number_windows_low_background)
+    # Load the start and end window index of each event for each resolution, saved with the windows
+    starts_ends_anomalies = EventIndex.load('pickels/anomaly_data_pred')
+    starts_ends_background = EventIndex.load('pickels/background_data_pred')
     
     # Read background results
     y_hats_high = np.load('preds/y_hats_high.npy', allow_pickle=False, fix_imports=False)
@@ -391,7 +359,7 @@ if __name__ == '__main__':
     print('True background:', background_background_events)
 
     # Get the number of actual anomalous events
-    anomalies_events = range(len(number_windows_high_anomalies))
+    anomalies_events = range(len(starts_ends_anomalies))
     
     #%% Get the results for the labeled anomalies
     for event_number_main in anomalies_events:
@@ -11,34 +11,15 @@ import warnings
 warnings.filterwarnings('ignore')
 
 from sklearn import tree
-from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from utils import dater, event_plotter, depths, attention, multivariate_attention, kl_divergence
+from utils import dater, event_plotter, forest_structure, kl_divergence
+from utils import parallel_event_attention, AttentionCache
 from utils import attention_plotter, multivariate_attention_plotter
+from datastore import load_windows, EventIndex
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_starts_ends(num_win_high, num_win_med, num_win_low):
-
-    """Extacts the start and end window index for each resolution and save it in a 2D list"""
-
-    starts_ends = []
-    for event_number in range(len(num_win_high)):
-
-        event_start_high = sum(num_win_high[:event_number]) + event_number
-        event_end_high = sum(num_win_high[:event_number + 1]) + 1 + event_number
-
-        event_start_med = sum(num_win_med[:event_number]) + event_number
-        event_end_med = sum(num_win_med[:event_number + 1]) + 1 + event_number
-
-        event_start_low = sum(num_win_low[:event_number]) + event_number
-        event_end_low = sum(num_win_low[:event_number + 1]) + 1 + event_number
-
-        starts_ends.append([[event_start_high, event_end_high], [event_start_med, event_end_med], [event_start_low, event_end_low]])
-
-    return starts_ends
-
 def majority_vote(high, med, low):
     
     vote_high = sum(high) / len(high)
@@ -50,30 +31,11 @@ def majority_vote(high, med, low):
     elif (1/3 * vote_high + 1/3 * vote_med + 1/3 * vote_low) <= 0.1:
         return 0
 
-# For parallel processing
-def calculate_kl_divergence(starts_ends, X, events, models, attention_multivariate):
-    kl_distances = []
-    for event_number in events:
-        variables_depth, max_depth = depths(starts_ends, X, models=models, event_number=event_number)
-        attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt = attention(variables_depth, max_depth)
-        attention_multivariate_compare = multivariate_attention(attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt)
-        kl_distance = kl_divergence(attention_multivariate, attention_multivariate_compare)
-        kl_distances.append(kl_distance)
-    return kl_distances
-
-def parallel_kl_divergence():
-    with ProcessPoolExecutor() as executor:
-        futures = []
-        # For anomalies
-        futures.append(executor.submit(calculate_kl_divergence, starts_ends_anomalies, X_anomalies, anomalies_events, [model_high, model_med, model_low], attention_multivariate))
-        # For anomalous background
-        futures.append(executor.submit(calculate_kl_divergence, starts_ends_background, X_background, background_anomalies_events, [model_high, model_med, model_low], attention_multivariate))
-        # For true background
-        futures.append(executor.submit(calculate_kl_divergence, starts_ends_background, X_background, background_background_events, [model_high, model_med, model_low], attention_multivariate))
-
-        for i, future in enumerate(as_completed(futures)):
-            kl_distances[i] = future.result()
-            logging.info(f'Finished kl distances with {["anomalies", "anomalous background", "background"][i]}')
+def calculate_kl_divergence(attention_multivariate, attention_maps):
+
+    """Compares the multivariate attention map of an event with the cached maps of a group of events."""
+
+    return [kl_divergence(attention_multivariate, attention_multivariate_compare) for attention_multivariate_compare in attention_maps]
 
 if __name__ == '__main__':
 
@@ -94,15 +56,15 @@ if __name__ == '__main__':
     filename = f'models/rf_model_low_{iteration}.sav'
     model_low = pickle.load(open(filename, 'rb'))
 
-    # Load the anomalies data
-    file_anomalies = open(f'pickels/anomaly_data_pred.pkl', 'rb')
-    anomalies_windows = pickle.load(file_anomalies)
-    file_anomalies.close()
+    # Get the flattened tree structures, cached next to the models
+    structures = [forest_structure(model, f'models/rf_model_{resolution}_{iteration}.sav')
+                  for model, resolution in zip([model_high, model_med, model_low], ['high', 'med', 'low'])]
+
+    # Load the anomalies data, memory-mapped
+    anomalies_windows = load_windows('pickels/anomaly_data_pred')
     
-    # Load the background data
-    file_background = open(f'pickels/background_data_pred.pkl', 'rb')
-    background_windows = pickle.load(file_background)
-    file_background.close()
+    # Load the background data, memory-mapped
+    background_windows = load_windows('pickels/background_data_pred')
 
     # Get windowed data and rename it to X_anomalies and X_background
     X_anomalies = anomalies_windows[0]
@@ -112,18 +74,9 @@ if __name__ == '__main__':
     lengths_anomalies = anomalies_windows[-1]
     lengths_background = background_windows[-1]
 
-    # Get the number of windows for each resolution, anomalies and background
-    number_windows_high_anomalies = [i - window_size_high + 1 for i in lengths_anomalies]
-    number_windows_med_anomalies = [i - window_size_med + 1 for i in lengths_anomalies]
-    number_windows_low_anomalies = [i - window_size_low + 1 for i in lengths_anomalies]
-
-    number_windows_high_background = [i - window_size_high + 1 for i in lengths_background]
-    number_windows_med_background = [i - window_size_med + 1 for i in lengths_background]
-    number_windows_low_background = [i - window_size_low + 1 for i in lengths_background]
-
-    # Find the start and end window index for each resolution and save it in a 2D list
-    starts_ends_anomalies = get_starts_ends(number_windows_high_anomalies, number_windows_med_anomalies, number_windows_low_anomalies)
-    starts_ends_background = get_starts_ends(number_windows_high_background, number_windows_med_background, number_windows_low_background)
+    # Load the start and end window index of each event for each resolution, saved with the windows
+    starts_ends_anomalies = EventIndex.load('pickels/anomaly_data_pred')
+    starts_ends_background = EventIndex.load('pickels/background_data_pred')
     
     # Read background results
     y_hats_high = np.load('preds/y_hats_high.npy', allow_pickle=False, fix_imports=False)
@@ -140,9 +93,32 @@ if __name__ == '__main__':
     print('True background:', background_background_events)
 
     # Get the number of actual anomalous events
-    anomalies_events = range(len(number_windows_high_anomalies))
+    anomalies_events = range(len(starts_ends_anomalies))
+
+    # Get the multivariate attention map of every event once, reusing those saved with the same models
+    models = [model_high, model_med, model_low]
+    attention_cache = AttentionCache(f'results/attention_cache_{station}_{iteration}.npz',
+                                     model_paths=[f'models/rf_model_{resolution}_{iteration}.sav' for resolution in ['high', 'med', 'low']])
+
+    groups = [('anomalies', anomalies_events), ('background', background_anomalies_events), ('background', background_background_events)]
+    datasets = {'anomalies': (starts_ends_anomalies, X_anomalies), 'background': (starts_ends_background, X_background)}
+
+    # The events explained one by one below also need the attention map of each variable
+    main_events = anomalies_events # This has to be changed when switching from anomalies to background
+    main_keys = {(data_type, event_number) for event_number in main_events}
+
+    # Compute the missing maps in parallel, storing them as they arrive
+    keys = {(dataset, event_number) for dataset, events in groups + [(data_type, main_events)] for event_number in events}
+    missing = [key for key in keys if key not in attention_cache or (key in main_keys and key not in attention_cache.variable_maps)]
+    tasks = [(key, *key) for key in sorted(missing)]
+    for key, (attention_map, variable_maps) in parallel_event_attention(tasks, models, datasets, structures=structures, variables=True):
+        attention_cache.put(key, attention_map, variable_maps)
+    attention_cache.save()
+
+    group_attention_maps = [[attention_cache.maps[(dataset, event_number)] for event_number in events] for dataset, events in groups]
+    logging.info('Finished attention maps of all events')
     
-    for event_number_main in anomalies_events: # This has to be changed when switching from anomalies to background
+    for event_number_main in main_events:
         logging.info('Processing event number %d', event_number_main)
 
         if data_type == 'anomalies':
@@ -157,27 +133,19 @@ if __name__ == '__main__':
         event_plotter(starts_ends, X, event_number_main, station=station, type=data_type[:2])
         logging.info('Finished event plot')
 
-        # Get the depths of the variables
-        variables_depth, max_depth = depths(starts_ends, X, models=[model_high, model_med, model_low], event_number=event_number_main)
-
-        # Get the attention maps
-        attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt = attention(variables_depth, max_depth)
-        
-        # Get the multivariate attention map
-        attention_multivariate = multivariate_attention(attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt)
+        # Get the attention maps of each variable and the multivariate attention map from the cache
+        attention_maps = attention_cache.variable_maps[(data_type, event_number_main)]
+        attention_multivariate = attention_cache.maps[(data_type, event_number_main)]
 
         # Plot the attention
-        attention_maps = [attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt]
         attention_plotter(attention_maps, event_number=event_number_main, station=station, type=data_type[:2])
 
         # Plot the multivariate attention
         multivariate_attention_plotter(attention_multivariate, event_number=event_number_main, station=station, type=data_type[:2])
         logging.info('Finished attention maps')
 
-        # Store the Kullback-Leibler divergence between the selected event and the anomalies
-        kl_distances = [[], [], []]
-
-        parallel_kl_divergence()
+        # Get the Kullback-Leibler divergence between the selected event and the cached maps of each group
+        kl_distances = [calculate_kl_divergence(attention_multivariate, group_maps) for group_maps in group_attention_maps]
 
         # Plot the KL divergences
         fig, ax = plt.subplots(figsize=(8, 6))
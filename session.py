@@ -0,0 +1,118 @@
+import os
+import pickle
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+"""This file contains the Session class which keeps the windowed data
+and the models of imRF in memory between iterations. Every object is
+stored under the path of the pickle file it used to be read from, and
+checkpoints are written to that same path, so the files on disk keep the
+format the results scripts expect."""
+
+class Session():
+
+    def __init__(self, checkpoint='sync') -> None:
+
+        """Arguments:
+        checkpoint: when the objects are written to disk. 'sync' writes
+        each one as soon as it is stored, 'async' writes them in order in
+        a background thread and 'end' only writes the objects still held
+        when flush is called, skipping the superseded ones."""
+
+        if checkpoint not in ('sync', 'async', 'end'):
+            raise ValueError(f"checkpoint must be 'sync', 'async' or 'end', got {checkpoint!r}")
+
+        self.checkpoint = checkpoint
+        self.objects = {} # {path: object} held in memory
+        self.pending = {} # {path: future} of the asynchronous writes, or {path: on_write} in 'end' mode
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1) if checkpoint == 'async' else None
+
+    @staticmethod
+    def _write(path, obj, on_write=None):
+
+        """Pickles obj to path. The file is replaced at once, so an
+        interrupted write never leaves a truncated pickle behind. Then
+        calls on_write(obj, path), if given."""
+
+        with open(f'{path}.tmp', 'wb') as file:
+            pickle.dump(obj, file)
+        os.replace(f'{path}.tmp', path)
+
+        if on_write is not None:
+            on_write(obj, path)
+
+    def _wait(self, path):
+
+        """Waits for the pending asynchronous write of path, if any."""
+
+        with self._lock:
+            future = self.pending.get(path)
+        if future is not None:
+            future.result()
+            with self._lock:
+                if self.pending.get(path) is future:
+                    del self.pending[path]
+
+    def put(self, path, obj, on_write=None):
+
+        """Stores obj in memory and checkpoints it to path. The object
+        must not be modified afterwards unless it is taken back with
+        release, as an asynchronous write may still be reading it.
+        on_write(obj, path) is called after each checkpoint, e.g. to save
+        files that depend on the written one."""
+
+        self.objects[path] = obj
+
+        if self.checkpoint == 'sync':
+            self._write(path, obj, on_write)
+        elif self.checkpoint == 'async':
+            with self._lock:
+                self.pending[path] = self._executor.submit(self._write, path, obj, on_write)
+        else:
+            self.pending[path] = on_write
+
+    def get(self, path):
+
+        """Returns the object stored under path, reading it from disk
+        when it is not in memory (e.g. it was written by another run)."""
+
+        if path not in self.objects:
+            with open(path, 'rb') as file:
+                self.objects[path] = pickle.load(file)
+
+        return self.objects[path]
+
+    def release(self, path):
+
+        """Removes the object stored under path from memory and returns
+        it, so it can be modified in place. Its checkpoint is completed
+        first in 'async' mode and dropped in 'end' mode."""
+
+        obj = self.get(path)
+
+        if self.checkpoint == 'async':
+            self._wait(path)
+        elif self.checkpoint == 'end':
+            self.pending.pop(path, None)
+
+        del self.objects[path]
+
+        return obj
+
+    def flush(self):
+
+        """Writes every checkpoint still pending and waits for them to
+        finish. Errors of the asynchronous writes are raised here."""
+
+        if self.checkpoint == 'async':
+            with self._lock:
+                paths = list(self.pending)
+            for path in paths:
+                self._wait(path)
+        elif self.checkpoint == 'end':
+            for path, on_write in self.pending.items():
+                self._write(path, self.objects[path], on_write)
+            self.pending.clear()
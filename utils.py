@@ -1,26 +1,57 @@
+import os
 import pickle
 import numpy as np
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-plt.style.use('ggplot')
-from matplotlib import rcParams
-rcParams['font.family'] = 'monospace'
-from matplotlib.dates import DateFormatter
 
-def dater(station, window):
+from datastore import load_station
+from datastore import station_dates
+from datastore import station_values
+
+# pandas, seaborn and matplotlib are imported by the functions that use them,
+# so windowing, voting and explaining do not pay for loading them
+_pyplot_ready = False
+
+def _pyplot():
+
+    """Imports pyplot and sets the style of the plots the first time a
+    figure is made.
+    ---------
+    Returns:
+    plt: The matplotlib.pyplot module."""
+
+    global _pyplot_ready
+
+    import matplotlib.pyplot as plt
+
+    if not _pyplot_ready:
+        from matplotlib import rcParams
+        plt.style.use('ggplot')
+        rcParams['font.family'] = 'monospace'
+        _pyplot_ready = True
+
+    return plt
+
+def dater(station, window, rows=None):
 
     """This function returns the dates corresponding to a window.
+    When the station rows of the window are known (see EventIndex.window_rows
+    and EventIndex.event_rows) the dates are sliced from the cached date
+    index, otherwise the rows are searched by their values.
     ---------
     Arguments:
     station: The station number.
     window: The window to be converted.
+    rows: The station rows of the window, if known.
     
     Returns:
     date_indices: The dates corresponding to the window."""
 
+    import pandas as pd
+
+    if rows is not None:
+        return pd.DatetimeIndex(station_dates(station)[rows], name='date')
+
     # Read data
-    data = pd.read_csv(f'data/labeled_{station}_smo.csv', sep=',', encoding='utf-8', parse_dates=['date'], index_col=['date'])
+    data = load_station(station).set_index('date')
     data = data.iloc[:, :-2]
 
     # Reshape window and define mask
@@ -36,7 +67,323 @@ def dater(station, window):
 
     return date_indices
 
-def window_plotter(data, num_variables, legend, event_number, station, type):
+def multiresolution_windower(data, num_variables, window_size, stride, copy=True):
+
+    """This function creates the multiresolution sliding windows of a
+    list of flattened multivariate time series with strided views instead
+    of slicing every window. The size of the windows gets halved at each
+    resolution until it reaches 4 data points, which gives the same high,
+    med and low resolutions as the recursive imRF.windower.
+    ---------
+    Arguments:
+    data: list of 1D arrays with the flattened data of each event.
+    num_variables: The number of variables in the data.
+    window_size: The size of the biggest window.
+    stride: The stride of the windows.
+    copy: If True, each resolution is returned as one contiguous 2D array.
+    If False, each resolution is a list with one read-only strided view
+    per event, which avoids copying the data at all.
+
+    Returns:
+    windows: list with the windows of each resolution (high, med, low)."""
+
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    data = [np.asarray(series) for series in data]
+
+    windows = []
+    while window_size > 4: # This way the maximum window would be 8 data points
+
+        window_length = window_size * num_variables
+
+        resolution_windows = []
+        for series in data:
+
+            # Get the number of windows as the original windower does
+            num_windows = (len(series) - window_length) // (stride * num_variables) + 1
+            if num_windows <= 0:
+                continue
+
+            # Each row of the view starts num_variables values after the previous one
+            view = sliding_window_view(series, window_length)
+            resolution_windows.append(view[:num_windows * num_variables:stride * num_variables])
+
+        if not copy:
+            windows.append(resolution_windows)
+        elif resolution_windows:
+            windows.append(np.concatenate(resolution_windows))
+        else:
+            dtype = data[0].dtype if data else float
+            windows.append(np.empty((0, window_length), dtype=dtype))
+
+        window_size = window_size // 2 # Halve window size
+
+    return windows
+
+def _tree_votes(trees, X):
+
+    """Sums the class predicted by each tree for every window."""
+
+    votes = np.zeros(X.shape[0])
+    for tree in trees:
+        proba = tree.predict_proba(X, check_input=False)
+        votes += tree.classes_.take(np.argmax(proba, axis=1))
+
+    return votes
+
+def forest_scores(model, X, n_jobs=None):
+
+    """This function returns the fraction of trees of a Random Forest
+    that classify each window as an anomaly. It gives the same result as
+    np.mean([tree.predict(X) for tree in model.estimators_], axis=0), but
+    validates X once and splits the trees in chunks that are evaluated
+    in parallel threads (the tree predictions release the GIL).
+    ---------
+    Arguments:
+    model: The fitted Random Forest model.
+    X: The windows data (2D).
+    n_jobs: The number of threads, -1 uses all cores. Defaults to model.n_jobs.
+
+    Returns:
+    scores: The averaged vote of all trees for each window."""
+
+    from joblib import Parallel, delayed, effective_n_jobs
+
+    # The trees work with float32, so convert the data only once
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    if X.ndim == 1:
+        X = X.reshape(1, -1)
+
+    trees = model.estimators_
+    if n_jobs is None:
+        n_jobs = model.n_jobs
+    n_chunks = min(effective_n_jobs(n_jobs), len(trees))
+
+    chunks = [trees[i::n_chunks] for i in range(n_chunks)]
+    votes = Parallel(n_jobs=n_chunks, prefer='threads')(delayed(_tree_votes)(chunk, X) for chunk in chunks)
+
+    return np.sum(votes, axis=0) / len(trees)
+
+def split_jobs(n_jobs, widths):
+
+    """Splits a budget of cores among several models in proportion to
+    their number of features (the cost of growing a tree grows with
+    the number of candidate features). Every model gets at least one core;
+    when there are fewer cores than models each model gets one and only
+    n_jobs of them are fitted at once (see fit_resolutions).
+    ---------
+    Arguments:
+    n_jobs: The total number of cores, -1 uses all of them.
+    widths: The number of features of each model.
+
+    Returns:
+    shares: The number of cores of each model, adding up to at most
+    max(n_jobs, len(widths)), e.g. split_jobs(4, [1000, 1, 1]) == [2, 1, 1]."""
+
+    from joblib import effective_n_jobs
+
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs <= len(widths):
+        return [1] * len(widths)
+
+    exact = np.asarray(widths, dtype=float) / np.sum(widths) * n_jobs
+
+    # Round down, but at least one core each, taking those cores back from the largest shares
+    shares = np.maximum(np.floor(exact).astype(int), 1)
+    while shares.sum() > n_jobs:
+        shares[np.argmax(shares)] -= 1
+
+    # Give the remaining cores to the largest remainders
+    for i in np.argsort(shares - exact):
+        if shares.sum() >= n_jobs:
+            break
+        shares[i] += 1
+
+    return shares.tolist()
+
+def fit_resolutions(models, X_train, y_train, n_jobs=-1):
+
+    """This function fits the Random Forest of each resolution at the
+    same time. The cores are split among the models with split_jobs and
+    each model grows its trees with its share of threads. Tree building
+    releases the GIL, so the fits run in parallel without copying the
+    data to other processes. When n_jobs is smaller than the number of
+    models, only n_jobs models are fitted at once with one core each, so
+    the fits never use more cores than the budget. The fitted models are
+    the same as when fitted one after another, because n_jobs does not
+    change the random state, and each model gets its own n_jobs back
+    once all the fits finish.
+    ---------
+    Arguments:
+    models: The Random Forest models at all resolutions (len=3).
+    X_train: The training windows at all resolutions (len=3).
+    y_train: The training labels at all resolutions (len=3).
+    n_jobs: The total number of cores, -1 uses all of them.
+
+    Returns:
+    models: The fitted models."""
+
+    from joblib import effective_n_jobs
+    from concurrent.futures import ThreadPoolExecutor
+
+    shares = split_jobs(n_jobs, [np.shape(X)[1] for X in X_train])
+
+    # The shares only apply to the fits, the models keep their own n_jobs for predicting and explaining
+    original_n_jobs = [model.n_jobs for model in models]
+    try:
+        with ThreadPoolExecutor(max_workers=min(effective_n_jobs(n_jobs), len(models))) as executor:
+            futures = [executor.submit(model.set_params(n_jobs=share).fit, X, y) for model, share, X, y in zip(models, shares, X_train, y_train)]
+            for future in futures:
+                future.result()
+    finally:
+        for model, model_n_jobs in zip(models, original_n_jobs):
+            model.set_params(n_jobs=model_n_jobs)
+
+    return models
+
+def shuffle_classes(anomalies, background, seed):
+
+    """This function joins the anomaly and background windows of one
+    resolution with their labels (1 and 0) and shuffles them. It gives the
+    same rows as shuffling the column_stack of the windows and labels after
+    np.random.seed(seed), but draws a permutation of the row indexes and
+    scatters each class into place, so neither the concatenation nor the
+    combined matrix with the labels is built.
+    ---------
+    Arguments:
+    anomalies: The anomaly windows.
+    background: The background windows.
+    seed: The random seed of the shuffle.
+
+    Returns:
+    X: The shuffled windows.
+    y: The shuffled labels."""
+
+    num_anomalies, num_background = len(anomalies), len(background)
+    num_windows = num_anomalies + num_background
+
+    # Legacy shuffle of the rows: the same draws as np.random.shuffle on a matrix
+    np.random.seed(seed)
+    permutation = np.random.permutation(num_windows)
+
+    # Position of each original row in the shuffled array
+    positions = np.empty(num_windows, dtype=np.intp)
+    positions[permutation] = np.arange(num_windows)
+
+    dtype = np.result_type(anomalies.dtype, background.dtype, np.float64)
+    X = np.empty((num_windows,) + np.shape(anomalies)[1:], dtype=dtype)
+    X[positions[:num_anomalies]] = anomalies
+    X[positions[num_anomalies:]] = background
+
+    y = np.concatenate((np.ones(num_anomalies), np.zeros(num_background)))[permutation]
+
+    return X, y
+
+def _window_means(scores, starts, span):
+
+    """Mean of scores[start:start + span + 1] for every start. The values
+    are added one column at a time, in the same order as Python's sum(),
+    so the results are bitwise equal to the original per-window loop.
+    Windows that run past the end of scores are truncated like a slice."""
+
+    scores = np.asarray(scores, dtype=float)
+    indexes = starts[:, np.newaxis] + np.arange(span + 1)
+    valid = indexes < len(scores)
+    values = np.where(valid, scores[np.minimum(indexes, len(scores) - 1)], 0.0)
+
+    total = values[:, 0].copy()
+    for j in range(1, span + 1):
+        total += values[:, j]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / valid.sum(axis=1)
+
+def multiresolution_vote(scores_high, scores_med, scores_low, span_med, span_low, number_windows=None, stride=1, mode='soft'):
+
+    """This function computes the multiresolution vote of every high
+    resolution window at once. Each high resolution window is combined
+    with the span_med + 1 medium and span_low + 1 low resolution windows
+    it contains: 1/3 * high + 1/3 * mean(med) + 1/3 * mean(low).
+    It replaces the index walk of imRF.RandomForest and gives the same
+    indexes and votes.
+    ---------
+    Arguments:
+    scores_high, scores_med, scores_low: The scores (or labels) of the windows at each resolution.
+    span_med, span_low: window_size - window_size_med and window_size - window_size_low.
+    number_windows: The number of windows of each event minus one (length - window_size + 1).
+    When given, the medium and low windows jump to the next event at each event end, when None
+    the windows are walked continuously (as for the shuffled test sets).
+    stride: The stride of the windows.
+    mode: 'soft' gives 1 for votes >= 0.9, 0 for votes <= 0.1 and -1 for the rest,
+    'hard' gives 1 for votes >= 0.5 and 0 otherwise, and 'score' gives the vote itself.
+
+    Returns:
+    votes: The vote of each high resolution window according to mode.
+    starts_high, starts_med, starts_low: The first window index of each vote at each resolution.
+    """
+
+    num_votes = len(scores_high)
+    steps = np.arange(num_votes)
+
+    if number_windows is None:
+        starts_med = steps * stride
+        starts_low = steps * stride
+
+    else:
+        # Each event gives number_windows + 1 votes
+        number_windows = np.asarray(number_windows, dtype=int)
+        if np.sum(number_windows + 1) < num_votes:
+            raise ValueError('number_windows does not cover all the high resolution windows')
+
+        events = np.repeat(np.arange(len(number_windows)), number_windows + 1)[:num_votes]
+        event_starts = np.concatenate(([0], np.cumsum(number_windows + 1)[:-1]))
+        local_steps = steps - event_starts[events]
+
+        # The medium and low windows start right after the last window of the previous event
+        base_med = np.concatenate(([0], np.cumsum(number_windows * stride + span_med + 1)[:-1]))
+        base_low = np.concatenate(([0], np.cumsum(number_windows * stride + span_low + 1)[:-1]))
+        starts_med = base_med[events] + local_steps * stride
+        starts_low = base_low[events] + local_steps * stride
+
+    starts_high = steps * stride
+
+    # Combine the float result of the high resolution with the mean of the others
+    vote_high = np.asarray(scores_high, dtype=float)[starts_high]
+    vote_med = _window_means(scores_med, starts_med, span_med)
+    vote_low = _window_means(scores_low, starts_low, span_low)
+    votes = 1/3 * vote_high + 1/3 * vote_med + 1/3 * vote_low
+
+    if mode == 'soft':
+        votes = np.where(votes >= 0.90, 1, np.where(votes <= 0.10, 0, -1))
+    elif mode == 'hard':
+        # 0.5 is the same threshold that the individual models use
+        votes = (votes >= 0.5).astype(int)
+
+    return votes, starts_high, starts_med, starts_low
+
+def save_figure(fig, path, pdf=None):
+
+    """This function saves a figure as a PDF file, or as a new page of
+    pdf when given, and closes it so no figure is left open.
+    ---------
+    Arguments:
+    fig: The figure to save.
+    path: The path of the PDF file.
+    pdf: A PdfPages (or any object with its savefig) to add the page to.
+
+    Returns:
+    None."""
+
+    plt = _pyplot()
+
+    if pdf is None:
+        fig.savefig(path, format='pdf', dpi=300, bbox_inches='tight')
+    else:
+        pdf.savefig(fig, dpi=300, bbox_inches='tight')
+
+    plt.close(fig)
+
+def window_plotter(data, num_variables, legend, event_number, station, type, rows=None, pdf=None):
     
     """This function plots the data window passed as a 
     numpy array original data. Hence, the resolution is
@@ -48,18 +395,25 @@ def window_plotter(data, num_variables, legend, event_number, station, type):
     station: the station number.
     legend: Whether to show the legend or not.
     name: The title of the plot.
+    rows: The station rows of the data, if known.
+    pdf: The multi-page PDF to add the figure to, if any.
     
     Returns:
     None"""
 
+    from matplotlib.dates import DateFormatter
+    plt = _pyplot()
+
     variables_names = ["am", "co", "do", "ph", "tu", "wt"]
 
     data_reshaped = data.reshape(-1, num_variables)
+
+    # The dates are the same for every variable
+    x = dater(station, data, rows=rows)
     
     # Plot each variable
     fig, ax = plt.subplots(figsize=(14, 10))  # Set the size of the plot
     for i in range(num_variables):
-        x = dater(station, data)
         # if len(x) != 32: x = range(32)
         ax.plot(x, data_reshaped[:, i], label=f'{variables_names[i]}', linewidth=4)
     
@@ -83,30 +437,79 @@ def window_plotter(data, num_variables, legend, event_number, station, type):
     plt.tight_layout()
     # plt.show()
 
-    # Save figure
-    plt.savefig(f'results/event_{station}_{type}_{event_number}.pdf', format='pdf', dpi=300, bbox_inches='tight')
+    # Save and close figure
+    save_figure(fig, f'results/event_{station}_{type}_{event_number}.pdf', pdf)
 
-    # Close figure
-    plt.close()
+def event_series(starts_ends, X, event_number, num_variables=6, station=None):
 
-def event_plotter(starts_ends, X, event_number, station, type):
+    """This function returns the (time x variable) series of an event.
+    If the station is given and the index knows the contiguous station rows
+    of the event, the series is a zero-copy slice of the station values.
+    Otherwise it is rebuilt from the high resolution windows (stride 1): the
+    first row of every window followed by the rest of the last window.
+    ---------
+    Arguments:
+    starts_ends: The start and end indexes of each event (e.g. an EventIndex).
+    X: The windows of each resolution.
+    event_number: The event number.
+    num_variables: The number of variables in the data.
+    station: The station number, to slice the series from the station data.
+
+    Returns:
+    event_data: 2D array with the value of each variable at each time step."""
+
+    if station is not None and getattr(starts_ends, 'rows', None) is not None:
+        rows = starts_ends.event_rows(event_number)
+        if len(rows) and rows[-1] - rows[0] == len(rows) - 1:
+            return station_values(station)[rows[0]:rows[-1] + 1]
 
     event_start_high = starts_ends[event_number][0][0]
     event_end_high = starts_ends[event_number][0][1]
 
-    event_data = X[0][event_start_high]
-    for i in range(event_start_high + 1, event_end_high):
-        
-        # Get the last row of the anomaly
-        last_row = X[0][i][-6:]
-        
-        # Add the last row to anomaly_data
-        event_data = np.concatenate((event_data, last_row), axis=0)
+    windows = X[0][event_start_high:event_end_high]
+
+    # A single window already holds the whole event
+    if len(windows) == 1:
+        return windows[0].reshape(-1, num_variables)
+
+    return np.concatenate((windows[:, :num_variables], windows[-1, num_variables:].reshape(-1, num_variables)))
+
+def event_plotter(starts_ends, X, event_number, station, type, pdf=None):
 
-    window_plotter(data=event_data, num_variables=6, legend=True, event_number=event_number, station=station, type=type)
+    event_data = event_series(starts_ends, X, event_number, station=station)
+
+    # Take the dates from the provenance of the event when the index has it
+    rows = starts_ends.event_rows(event_number) if getattr(starts_ends, 'rows', None) is not None else None
+
+    window_plotter(data=event_data, num_variables=6, legend=True, event_number=event_number, station=station, type=type, rows=rows, pdf=pdf)
 
 # Depth function
-def depths(starts_ends, X, models: list, event_number: int):
+def _tree_paths(trees, tree_indexes, structure, windows):
+
+    """Returns, for each tree, the window, depth, feature and threshold of
+    the split nodes the windows pass through and the depth of the deepest
+    leaf reached. The decision paths are kept as sparse CSR matrices whose
+    rows list the nodes from the root to the leaf, and the nodes are looked
+    up in the flattened ForestStructure."""
+
+    windows = np.ascontiguousarray(windows, dtype=np.float32)
+
+    paths = []
+    for tree, tree_index in zip(trees, tree_indexes):
+        decision_path = tree.decision_path(windows, check_input=False)
+        rows = np.repeat(np.arange(decision_path.shape[0]), np.diff(decision_path.indptr))
+        nodes = structure.offsets[tree_index] + decision_path.indices
+
+        # Drop the leaves, the last node of each path
+        split = structure.children_left[nodes] != -1
+        max_depth = int(structure.depth[nodes].max(initial=0))
+        rows, nodes = rows[split], nodes[split]
+
+        paths.append((rows, structure.depth[nodes], structure.feature[nodes], structure.threshold[nodes], max_depth))
+
+    return paths
+
+def depths(starts_ends, X, models: list, event_number: int, n_jobs=None, structures=None):
     
     """This function extracts the depths at which each instance of the
     feature vectors (window) that make up given eventa appears from the 
@@ -118,9 +521,14 @@ def depths(starts_ends, X, models: list, event_number: int):
     X: The windows data at all resolutions (len=3).
     models: The Random Forest models at all resolutions (len=3).
     event_number: The event number to be explained.
+    n_jobs: The number of threads over the trees, -1 uses all cores. Defaults to model.n_jobs.
+    structures: The ForestStructure of each model, e.g. from forest_structure(model, model_path)
+    to reuse the cache saved next to the model. Built from the models if None.
 
     Returns:
     variables_depth: The variables and their depth in each path across all trees.
+    variables_thresholds: The thresholds of the variables in each path across all trees.
+    variables_distances: The distance between the value and the threshold of the variables.
     max_depth: The maximum depth of the decision paths.
     """
 
@@ -208,93 +616,56 @@ def depths(starts_ends, X, models: list, event_number: int):
             variables_thresholds[resolution][feature_name] = []
             variables_distances[resolution][feature_name] = []
 
+    from joblib import Parallel, delayed, effective_n_jobs
+
+    if structures is None:
+        structures = [forest_structure(model) for model in models]
+
     # Set the max depth to 0
     max_depth = 0
-    for i, (model, resolution) in enumerate(zip(models, resolutions)):
+    for i, (model, structure, resolution) in enumerate(zip(models, structures, resolutions)):
         
         # Extract the start and end indices for the windows by resolution
-        # i = 2   # When working with a single resolution, i = 0 for high, i = 1 for med, and i = 2 for low
         windows = X[i][starts_ends[event_number][i][0]:starts_ends[event_number][i][1]]
-        
-        # Traverse each window to get the decision paths
-        for window in windows:
-            
-            # Create an empty list to store all of the decision paths for each window
-            decision_paths = []
-
-            # Traverse each tree in the Random Forest to get the decision path across all trees for the given window (data)
-            for tree in model.estimators_:
-                tree_decision_paths = tree.decision_path(window[np.newaxis, :]).toarray()
-                decision_paths.append(tree_decision_paths)
-
-            # Get the indices where the window has passed through
-            passed_nodes_indices = [np.where(decision_path == 1)[1] for decision_path in decision_paths]
-
-            # Get the thresholds and feature values of the nodes in each decision tree in the Random Forest
-            tree_feature_thresholds = [model.estimators_[i].tree_.threshold[e] for i, e in enumerate(passed_nodes_indices)]
-            tree_feature_indices = [model.estimators_[i].tree_.feature[e] for i, e in enumerate(passed_nodes_indices)]
-
-            # Get the feature values of the nodes in each decision tree in the Random Forest
-            tree_feature_values = [window[i] for i in tree_feature_indices]
-
-            # Select the resolution of the feature names
-            feature_names = feature_names_high if resolution == 'high' else feature_names_med if resolution == 'med' else feature_names_low
-
-            # The wt+7 has to be removed at the end of each element because it corresponds to the -2 index of the leaves
-            subset_feature_names = []
-            for i in tree_feature_indices:
-                subset_feature_names.append([feature_names[j] for j in i[:-1].tolist()])
-
-            subset_feature_thresholds = []
-            for i in tree_feature_thresholds:
-                subset_feature_thresholds.append(i[:-1].tolist())
-
-            subset_feature_values = []
-            for i in tree_feature_values:
-                subset_feature_values.append(i[:-1].tolist())
-
-            # Determine if the node conditions (variable, threshold, value) are satisfied
-            conditions_satisfied = []
-            for i, (features, thresholds, values) in enumerate(zip(subset_feature_names, subset_feature_thresholds, subset_feature_values)):
-                conditions_satisfied.append([True if values[j] <= thresholds[j] else False for j in range(len(features))])
-            
-            # # Detailed verbal condition satisfaction printout. I levae it commented out to avoid massive printouts, when dealing with several trees, windows, and resolutions
-            # for i, (features, values, thresholds, satisfied) in enumerate(zip(subset_feature_names, subset_feature_values, subset_feature_thresholds, conditions_satisfied)):
-            #     print(f"Tree {i}")
-            #     for j, (feature, value, threshold, is_satisfied) in enumerate(zip(features, values, thresholds, satisfied)):
-            #         print(f"Node {i}-{j}: Feature '{feature}' with value {value} {'<= ' if is_satisfied else '> '}threshold {threshold}")
-
-            # Extract variable names and their positions
-            for features in subset_feature_names:
-                for i, feature in enumerate(features):
-                    if feature not in variables_depths[resolution]:
-                        variables_depths[resolution][feature] = []
-                    variables_depths[resolution][feature].append(i)
-
-            # Extract the thresholds for each variable 
-            for features, thresholds in zip(subset_feature_names, subset_feature_thresholds):
-                for feature, threshold in zip(features, thresholds):
-                    if feature not in variables_thresholds[resolution]:
-                        variables_thresholds[resolution][feature] = []
-                    variables_thresholds[resolution][feature].append(threshold)
-            
-            # Extract the distance between the threshold and the value for each variable
-            for features, thresholds, values in zip(subset_feature_names, subset_feature_thresholds, subset_feature_values):
-                for feature, threshold, value in zip(features, thresholds, values):
-                    if feature not in variables_distances[resolution]:
-                        variables_distances[resolution][feature] = []
-                    distance = value - threshold
-                    variables_distances[resolution][feature].append(distance)
-            
-            # Calculate the depth and update the value
-            depth = max([len(sublist) for sublist in subset_feature_names])
-            max_depth = max(max_depth, depth)
+        windows = np.asarray(windows).reshape(-1, model.n_features_in_)
+
+        # Get the decision paths of all the windows, one pass per tree with the trees split in contiguous chunks
+        trees = model.estimators_
+        n_chunks = min(effective_n_jobs(model.n_jobs if n_jobs is None else n_jobs), len(trees))
+        chunks = [range(j * len(trees) // n_chunks, (j + 1) * len(trees) // n_chunks) for j in range(n_chunks)]
+        paths = Parallel(n_jobs=n_chunks, prefer='threads')(delayed(_tree_paths)([trees[k] for k in chunk], chunk, structure, windows) for chunk in chunks)
+        paths = [path for chunk in paths for path in chunk]
+        if len(windows) == 0 or len(paths) == 0:
+            continue
+
+        # Concatenate the split nodes of all trees and sort them by window, keeping the tree and depth order
+        rows, node_depths, features, node_thresholds = [np.concatenate(values) for values in zip(*[path[:4] for path in paths])]
+        order = np.argsort(rows, kind='stable')
+        order = order[np.argsort(features[order], kind='stable')]
+        rows, node_depths, features, node_thresholds = rows[order], node_depths[order], features[order], node_thresholds[order]
+        node_distances = windows[rows, features] - node_thresholds
+
+        # Select the resolution of the feature names
+        feature_names = feature_names_high if resolution == 'high' else feature_names_med if resolution == 'med' else feature_names_low
+
+        # Extract the depths, thresholds and distance between the value and the threshold for each variable
+        bounds = np.cumsum(np.bincount(features, minlength=len(feature_names)))
+        for feature, (start, end) in enumerate(zip(np.concatenate(([0], bounds[:-1])), bounds)):
+            if start == end:
+                continue
+            feature_name = feature_names[feature]
+            variables_depths[resolution][feature_name].extend(node_depths[start:end].tolist())
+            variables_thresholds[resolution][feature_name].extend(node_thresholds[start:end].tolist())
+            variables_distances[resolution][feature_name].extend(node_distances[start:end].tolist())
+
+        # Calculate the depth and update the value
+        max_depth = max(max_depth, max(path[4] for path in paths))
 
     return variables_depths, variables_thresholds, variables_distances, max_depth
 
-def normalizer(dictionary):
+def normalizer(counts):
 
-    """This function normalizes the values of a dictionary, so they
+    """This function normalizes the attention counts, so they
     can be added together and weighted.
     The feature vector of all resolutions (high, med, low) share
     the items between -4, and 4. Thefore, if not normalized, the
@@ -303,101 +674,169 @@ def normalizer(dictionary):
     present in both the high and medium resolutions.
     ---------
     Arguments:
-    dictionary: The dictionary to be normalized.
+    counts: The attention counts (resolution x variable x position x depth).
 
     Returns:
-    dictionary: The normalized dictionary.
+    normalized: The counts min-max normalized for each resolution and variable.
+    Those with a constant value are left as they are.
     """
 
-    # Define the resolutions
-    resolutions = ['high', 'med', 'low']
-    
-    # Normalize the values between 0 and 1 for each resolution separately
-    for resolution in resolutions:
+    if counts.size == 0:
+        return counts.astype(float)
 
-        # Initialize the list to store all values
-        am_values, co_values, do_values, ph_values, tu_values, wt_values = [], [], [], [], [], []
-
-        # Extract the values for each variable
-        for key in dictionary[resolution].keys():
-            if key.startswith('am'):
-                am_values.extend(dictionary[resolution][key])
-            elif key.startswith('co'):
-                co_values.extend(dictionary[resolution][key])
-            elif key.startswith('do'):
-                do_values.extend(dictionary[resolution][key])
-            elif key.startswith('ph'):
-                ph_values.extend(dictionary[resolution][key])
-            elif key.startswith('tu'):
-                tu_values.extend(dictionary[resolution][key])
-            elif key.startswith('wt'):
-                wt_values.extend(dictionary[resolution][key])
-        
-        # Find the maximum and minimum values for each variable
-        max_am, min_am = max(am_values), min(am_values)
-        max_co, min_co = max(co_values), min(co_values)
-        max_do, min_do = max(do_values), min(do_values)
-        max_ph, min_ph = max(ph_values), min(ph_values)
-        max_tu, min_tu = max(tu_values), min(tu_values)
-        max_wt, min_wt = max(wt_values), min(wt_values)
-
-        # Normalize the values for each variable
-        for key in dictionary[resolution].keys():
-            if key.startswith('am') and (max_am - min_am) != 0:
-                dictionary[resolution][key] = [(x - min_am) / (max_am - min_am) for x in dictionary[resolution][key]]
-            elif key.startswith('co') and (max_co - min_co) != 0:
-                dictionary[resolution][key] = [(x - min_co) / (max_co - min_co) for x in dictionary[resolution][key]]
-            elif key.startswith('do') and (max_do - min_do) != 0:
-                dictionary[resolution][key] = [(x - min_do) / (max_do - min_do) for x in dictionary[resolution][key]]
-            elif key.startswith('ph') and (max_ph - min_ph) != 0:
-                dictionary[resolution][key] = [(x - min_ph) / (max_ph - min_ph) for x in dictionary[resolution][key]]
-            elif key.startswith('tu') and (max_tu - min_tu) != 0:
-                dictionary[resolution][key] = [(x - min_tu) / (max_tu - min_tu) for x in dictionary[resolution][key]]
-            elif key.startswith('wt') and (max_wt - min_wt) != 0:
-                dictionary[resolution][key] = [(x - min_wt) / (max_wt - min_wt) for x in dictionary[resolution][key]]
-    
-    return dictionary
+    # Normalize the values between 0 and 1 for each resolution and variable separately
+    min_counts = counts.min(axis=(2, 3), keepdims=True)
+    range_counts = counts.max(axis=(2, 3), keepdims=True) - min_counts
+
+    return np.where(range_counts != 0, (counts - min_counts) / np.where(range_counts != 0, range_counts, 1), counts)
 
-def weighter(multiresolution_map):
+def weighter(multiresolution_map, offsets):
     
     """This applies weights to the multiresolution attention map
     in order to normalize the values across all three resolutions.
+    The positions up to 4 are in all three resolutions, those up
+    to 8 in the high and medium ones and the rest only in the high one.
     ---------
     Arguments:
-    multiresolution_map: The multiresolution map.
+    multiresolution_map: The multiresolution map (variable x position x depth).
+    offsets: The position offsets of the map, e.g. -16 to -1 and +1 to +16.
     
     Returns:
     multiresolution_map: The weighted multiresolution attention map."""
 
     # Use weights to normalize the multiresolution map
-    suffixes_low = ['-4', '-3', '-2', '-1', '+1', '+2', '+3', '+4']
-    for key in multiresolution_map.keys():
-        if any(key.endswith(suffix) for suffix in suffixes_low):
-            multiresolution_map[key] = [x / 9 for x in multiresolution_map[key]]
-
-    suffixes_med = ['-8', '-7', '-6', '-5', '+5', '+6', '+7', '+8']
-    for key in multiresolution_map.keys():
-        if any(key.endswith(suffix) for suffix in suffixes_med):
-            multiresolution_map[key] = [x / 6 for x in multiresolution_map[key]]
-    
-    suffixes_high = ['-16', '-15', '-14', '-13', '-12', '-11', '-10', '-9', '+9', '+10', '+11', '+12', '+13', '+14', '+15', '+16']
-    for key in multiresolution_map.keys():
-        if any(key.endswith(suffix) for suffix in suffixes_high):
-            multiresolution_map[key] = [x / 3 for x in multiresolution_map[key]]
-    
-    return multiresolution_map
+    offsets = np.abs(offsets)
+    weights = np.where(offsets <= 4, 9, np.where(offsets <= 8, 6, 3))
+
+    return multiresolution_map / weights[:, np.newaxis]
+
+class FeatureHistogram():
+
+    """Counts of the values recorded for each feature of the windows in
+    the bins given by edges, stored as an array of shape
+    (resolution x variable x position x bin). A value v falls in bin i if
+    edges[i] <= v < edges[i + 1], the rest are not counted. Values can be
+    added in several calls, e.g. window by window or event by event. The
+    normalization, resolution weighting and multivariate reduction are
+    array operations, and the maps can be viewed as the
+    {'am-16': [...], ...} dictionaries used by the plotters."""
+
+    resolutions = ['high', 'med', 'low']
+    variables = ['am', 'co', 'do', 'ph', 'tu', 'wt']
+    offsets = np.concatenate((np.arange(-16, 0), np.arange(1, 17)))
+
+    def __init__(self, edges, counts=None) -> None:
+
+        self.edges = np.asarray(edges)
+        if counts is None:
+            counts = np.zeros((len(self.resolutions), len(self.variables), len(self.offsets), max(len(self.edges) - 1, 0)), dtype=int)
+        self.counts = counts
+
+    def feature_indexes(self, keys):
+
+        """Returns the flat (variable, position) index of feature names such as 'am-16'."""
+
+        positions = {offset: i for i, offset in enumerate(self.offsets.tolist())}
+        variables = {variable: i for i, variable in enumerate(self.variables)}
+
+        return np.array([variables[key[:2]] * len(self.offsets) + positions[int(key[2:])] for key in keys], dtype=np.intp)
+
+    def add(self, resolution, features, values):
+
+        """Counts the values of one resolution.
+        ---------
+        Arguments:
+        resolution: The resolution index (0 high, 1 med, 2 low).
+        features: The flat (variable, position) index of each value, see feature_indexes.
+        values: The values."""
+
+        num_bins = self.counts.shape[-1]
+        bins = np.digitize(values, self.edges) - 1
+        counted = (bins >= 0) & (bins < num_bins)
+
+        flat_indexes = np.asarray(features)[counted] * num_bins + bins[counted]
+        self.counts[resolution] += np.bincount(flat_indexes, minlength=self.counts[resolution].size).reshape(self.counts[resolution].shape)
+
+    def add_values(self, variables_values):
+
+        """Counts the values returned by the depths function,
+        {resolution: {'am-16': [...], ...}}."""
+
+        for r, resolution in enumerate(self.resolutions):
+            keys = [key for key in variables_values[resolution] if len(variables_values[resolution][key])]
+            if not keys:
+                continue
+            features = np.repeat(self.feature_indexes(keys), [len(variables_values[resolution][key]) for key in keys])
+            self.add(r, features, np.concatenate([variables_values[resolution][key] for key in keys]))
+
+    def multiresolution(self):
+
+        """Returns the normalized counts added over the resolutions and
+        weighted (variable x position x bin)."""
+
+        normalized = normalizer(self.counts)
+
+        # Element-wise addition of the resolutions, in order
+        multiresolution_map = normalized[0]
+        for resolution_map in normalized[1:]:
+            multiresolution_map = multiresolution_map + resolution_map
+
+        return weighter(multiresolution_map, self.offsets)
+
+    def multivariate(self):
+
+        """Returns the multiresolution map added over the variables (position x bin)."""
+
+        multiresolution_map = self.multiresolution()
+
+        # Element-wise addition of the variables, in order
+        multivariate_map = multiresolution_map[0]
+        for variable_map in multiresolution_map[1:]:
+            multivariate_map = multivariate_map + variable_map
+
+        return multivariate_map
+
+    def variable_maps(self):
+
+        """Returns the multiresolution map of each variable as a {'am-16': [...], ...} dictionary."""
+
+        multiresolution_map = self.multiresolution()
+
+        return [{f'{variable}{offset:+d}': position.tolist() for offset, position in zip(self.offsets.tolist(), variable_map)}
+                for variable, variable_map in zip(self.variables, multiresolution_map)]
+
+    def multivariate_map(self):
+
+        """Returns the multivariate map as a {'-16': [...], ...} dictionary."""
+
+        return {f'{offset:+d}': position.tolist() for offset, position in zip(self.offsets.tolist(), self.multivariate())}
+
+class AttentionMap(FeatureHistogram):
+
+    """Attention counts of an event: how many times each variable at each
+    position of the window appears at each depth of the decision paths,
+    (resolution x variable x position x depth)."""
+
+    @classmethod
+    def from_depths(cls, variables_depth, max_depth):
+
+        """Counts the depths returned by the depths function."""
+
+        attention_map = cls(np.arange(max_depth + 1))
+        attention_map.add_values(variables_depth)
+
+        return attention_map
 
 # Attention maps
 def attention(variables_depth, max_depth):
 
     """This function calculates the attention maps for each variable
     in each resolution based on the depth at which they appear in the 
-    decision paths.
+    decision paths. See AttentionMap to keep working with the arrays.
     ---------
     Arguments:
     variables_depth: The variables and their depth in each path across all trees.
     max_depth: The maximum depth of the decision paths.
-    normalize: Whether to normalize the attention maps or not.
 
     Returns:
     attention_am: The attention map for the am variable.
@@ -407,55 +846,8 @@ def attention(variables_depth, max_depth):
     attention_tu: The attention map for the tu variable.
     attention_wt: The attention map for the wt variable.
     """
-    
-    # Initialize the resolution names
-    resolutions = ['high', 'med', 'low']
-
-    # Initialize the attention maps
-    attention = {resolution: {} for resolution in resolutions}
-
-    # Get the number of times each variable appears at each depth
-    for resolution in resolutions:
-        frequency_depth = np.zeros((len(variables_depth[resolution]), max_depth))
-        for i, var in enumerate(variables_depth[resolution].keys()):
-            for pos in variables_depth[resolution][var]:
-                frequency_depth[i, pos] += 1
-
-        # Convert data to int
-        frequency_depth = frequency_depth.astype(int) 
-
-        # Assign the data to the dictionary with the same keys
-        for var in variables_depth[resolution].keys():
-            attention[resolution][var] = []
-        
-        for i, var in enumerate(variables_depth[resolution].keys()):
-            for j in range(max_depth):
-                attention[resolution][var].append(frequency_depth[i, j])
-
-    # Normalize the attention maps
-    attention = normalizer(attention)
-
-    # Initialize the multiresolution attention map
-    attention_multiresolution = {}
-    for key in attention['high'].keys():
-        attention_multiresolution[key] = [0] * max_depth
-
-    # Perform element-wise addition of the attention maps to obtain the total attention
-    for resolution in resolutions:
-        for key in attention[resolution]:
-            for i in range(max_depth):
-                attention_multiresolution[key][i] += attention[resolution][key][i]
-
-    # Use weights to normalize the multiresolution attention map
-    attention_multiresolution = weighter(attention_multiresolution)
 
-    # Subset the attention for each variable
-    attention_am = {key: value for key, value in attention_multiresolution.items() if key.startswith('am')}
-    attention_co = {key: value for key, value in attention_multiresolution.items() if key.startswith('co')}
-    attention_do = {key: value for key, value in attention_multiresolution.items() if key.startswith('do')}
-    attention_ph = {key: value for key, value in attention_multiresolution.items() if key.startswith('ph')}
-    attention_tu = {key: value for key, value in attention_multiresolution.items() if key.startswith('tu')}
-    attention_wt = {key: value for key, value in attention_multiresolution.items() if key.startswith('wt')}
+    attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt = AttentionMap.from_depths(variables_depth, max_depth).variable_maps()
 
     return attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt
 
@@ -477,28 +869,27 @@ def multivariate_attention(attention_am, attention_co, attention_do, attention_p
     attention_total: The total attention map for all variables.
     """
 
-    # Replace the keys to be the 2: items
-    attention_am = {key[2:]: value for key, value in attention_am.items()}
-    attention_co = {key[2:]: value for key, value in attention_co.items()}
-    attention_do = {key[2:]: value for key, value in attention_do.items()}
-    attention_ph = {key[2:]: value for key, value in attention_ph.items()}
-    attention_tu = {key[2:]: value for key, value in attention_tu.items()}
-    attention_wt = {key[2:]: value for key, value in attention_wt.items()}
-    
+    # Stack the maps (variable x position x depth), the keys without the variable are the positions
+    keys = [key[2:] for key in attention_am.keys()]
+    attention_maps = [np.array(list(attention_map.values()), dtype=float).reshape(len(keys), -1)
+                      for attention_map in (attention_am, attention_co, attention_do, attention_ph, attention_tu, attention_wt)]
+
     # Perform element-wise addition of the attention maps to obtain the total attention
-    attention_total = {key: [sum(x) for x in zip(attention_am[key], attention_co[key], attention_do[key], attention_ph[key], attention_tu[key], attention_wt[key])] for key in attention_am.keys()}
+    attention_total = attention_maps[0]
+    for attention_map in attention_maps[1:]:
+        attention_total = attention_total + attention_map
 
-    return attention_total
+    return {key: position.tolist() for key, position in zip(keys, attention_total)}
 
 # Thresholds
-def thresholds(variables_thresholds):
+def thresholds(variables_thresholds, edges=None):
 
     """This function calculates the number of times the thresholds are within
     the inervals, for each variable.
     ---------
     Arguments:
     variables_thresholds: The variables and their threshold in each path across all trees.
-    normalize: Whether to normalize the thresholds or not.
+    edges: The edges of the intervals. Defaults to [0, 0.05), [0.05, 0.1), ..., [0.95, 1).
 
     Returns:
     thresholds_am: The thresholds for the am variable.
@@ -508,60 +899,28 @@ def thresholds(variables_thresholds):
     thresholds_tu: The thresholds for the tu variable.
     thresholds_wt: The thresholds for the wt variable.
     """
-    
-    # Initialize the resolution names
-    resolutions = ['high', 'med', 'low']
-
-    # Define the intervals for the thresholds [0, 0.05), [0.05, 0.1), ..., [0.95, 1]
-    intervals_thresholds = [(i / 20, (i + 1) / 20) for i in range(20)]
-
-    # Initialize the dictionary to store the thresholds for each variable
-    variables_thresholds_bins = {resolutions: {} for resolutions in resolutions}
 
-    for resolution in resolutions:
-        variables_thresholds_bins[resolution] = {key: [0] * len(intervals_thresholds) for key in variables_thresholds[resolution].keys()}
-        for i, (start, end) in enumerate(intervals_thresholds):
-            for var in variables_thresholds[resolution].keys():
-                for threshold in variables_thresholds[resolution][var]:
-                    if start <= threshold < end:
-                        variables_thresholds_bins[resolution][var][i] += 1
-    
-    # Normalize the thresholds
-    variables_thresholds_bins = normalizer(variables_thresholds_bins)
-
-    # Initialize the multiresolution threshold maps
-    thresholds_multiresolution = {}
-    for key in variables_thresholds_bins['high'].keys():
-        thresholds_multiresolution[key] = [0] * len(intervals_thresholds)
+    # Define the intervals for the thresholds [0, 0.05), [0.05, 0.1), ..., [0.95, 1)
+    if edges is None:
+        edges = [i / 20 for i in range(21)]
 
-    # Perform element-wise addition of the thresholds to obtain the total thresholds
-    for resolution in resolutions:
-        for key in variables_thresholds_bins[resolution]:
-            for i in range(len(intervals_thresholds)):
-                thresholds_multiresolution[key][i] += variables_thresholds_bins[resolution][key][i]
-    
-    # Use weights to normalize the multiresolution threshold map
-    thresholds_multiresolution = weighter(thresholds_multiresolution)
+    # Count the thresholds in each interval, normalize and weight them
+    thresholds_histogram = FeatureHistogram(edges)
+    thresholds_histogram.add_values(variables_thresholds)
 
-    # Subset the thresholds for each variable
-    thresholds_am = {key: value for key, value in thresholds_multiresolution.items() if key.startswith('am')}
-    thresholds_co = {key: value for key, value in thresholds_multiresolution.items() if key.startswith('co')}
-    thresholds_do = {key: value for key, value in thresholds_multiresolution.items() if key.startswith('do')}
-    thresholds_ph = {key: value for key, value in thresholds_multiresolution.items() if key.startswith('ph')}
-    thresholds_tu = {key: value for key, value in thresholds_multiresolution.items() if key.startswith('tu')}
-    thresholds_wt = {key: value for key, value in thresholds_multiresolution.items() if key.startswith('wt')}
+    thresholds_am, thresholds_co, thresholds_do, thresholds_ph, thresholds_tu, thresholds_wt = thresholds_histogram.variable_maps()
 
     return thresholds_am, thresholds_co, thresholds_do, thresholds_ph, thresholds_tu, thresholds_wt
 
 # Distances
-def distances(variables_distances):
+def distances(variables_distances, edges=None):
 
     """This function calculates the number of times the distances between threshold and value
     are within the inervals, for each variable.
     ---------
     Arguments:
     variables_distances: The variables and their distances in each path across all trees.
-    normalize: Whether to normalize the distances or not.
+    edges: The edges of the intervals. Defaults to [-1, -0.9), [-0.9, -0.8), ..., [0.9, 1).
 
     Returns:
     distances_am: The distances for the am variable.
@@ -572,47 +931,15 @@ def distances(variables_distances):
     distances_wt: The distances for the wt variable.
     """
 
-    # Initialize the resolution names
-    resolutions = ['high', 'med', 'low']
-    
-    # Define the intervals for the distances [-1, -0.9), [-0.9, -0.8), ..., [0.9, 1]
-    intervals_distances = [(i / 10, (i + 1) / 10) for i in range(-10, 10)]
-
-    # Initialize the dictionary to store the distances for each variable
-    variables_distances_bins = {resolutions: {} for resolutions in resolutions}
+    # Define the intervals for the distances [-1, -0.9), [-0.9, -0.8), ..., [0.9, 1)
+    if edges is None:
+        edges = [i / 10 for i in range(-10, 11)]
 
-    for resolution in resolutions:
-        variables_distances_bins[resolution] = {key: [0] * len(intervals_distances) for key in variables_distances[resolution].keys()}
-        for i, (start, end) in enumerate(intervals_distances):
-            for var in variables_distances[resolution].keys():
-                for distance in variables_distances[resolution][var]:
-                    if start <= distance < end:
-                        variables_distances_bins[resolution][var][i] += 1
-    
-    # Normalize the distances
-    variables_distances_bins = normalizer(variables_distances_bins)
+    # Count the distances in each interval, normalize and weight them
+    distances_histogram = FeatureHistogram(edges)
+    distances_histogram.add_values(variables_distances)
 
-    # Initialize the multiresolution distance maps
-    distances_multiresolution = {}
-    for key in variables_distances_bins['high'].keys():
-        distances_multiresolution[key] = [0] * len(intervals_distances)
-    
-    # Perform element-wise addition of the distances to obtain the total distances
-    for resolution in resolutions:
-        for key in variables_distances_bins[resolution]:
-            for i in range(len(intervals_distances)):
-                distances_multiresolution[key][i] += variables_distances_bins[resolution][key][i]
-    
-    # Use weights to normalize the multiresolution distance map
-    distances_multiresolution = weighter(distances_multiresolution)
-    
-    # Subset the distances for each variable
-    distances_am = {key: value for key, value in distances_multiresolution.items() if key.startswith('am')}
-    distances_co = {key: value for key, value in distances_multiresolution.items() if key.startswith('co')}
-    distances_do = {key: value for key, value in distances_multiresolution.items() if key.startswith('do')}
-    distances_ph = {key: value for key, value in distances_multiresolution.items() if key.startswith('ph')}
-    distances_tu = {key: value for key, value in distances_multiresolution.items() if key.startswith('tu')}
-    distances_wt = {key: value for key, value in distances_multiresolution.items() if key.startswith('wt')}
+    distances_am, distances_co, distances_do, distances_ph, distances_tu, distances_wt = distances_histogram.variable_maps()
 
     return distances_am, distances_co, distances_do, distances_ph, distances_tu, distances_wt
 
@@ -657,16 +984,363 @@ def kl_divergence(attention_1, attention_2):
 
     return kl_divergence
 
-def attention_plotter(attention_maps, event_number, station, type):
+def event_attention(starts_ends, X, models, event_number, structures=None, n_jobs=None, variables=False):
+
+    """This function returns the multivariate attention map of an event,
+    the same as multivariate_attention(*attention(...)) on the output of depths,
+    and the attention map of each variable, as attention(...), if variables.
+    ---------
+    Arguments:
+    starts_ends: The start and end indices of each window at all resolutions (len=3).
+    X: The windows data at all resolutions (len=3).
+    models: The Random Forest models at all resolutions (len=3).
+    event_number: The event number to be explained.
+    structures: The ForestStructure of each model, see depths.
+    n_jobs: The number of threads over the trees, see depths.
+    variables: Whether to return the attention map of each variable too.
+
+    Returns:
+    attention_total: The multivariate attention map of the event.
+    attention_maps: The attention map of each variable, only if variables."""
+
+    variables_depth, _, _, max_depth = depths(starts_ends, X, models=models, event_number=event_number, n_jobs=n_jobs, structures=structures)
+    attention_map = AttentionMap.from_depths(variables_depth, max_depth)
+
+    if variables:
+        return attention_map.multivariate_map(), attention_map.variable_maps()
+
+    return attention_map.multivariate_map()
+
+class AttentionCache():
+
+    """Multivariate attention maps of the events, computed once per model
+    version. The maps are kept in memory by key, e.g. ('anomalies', 3), and
+    saved to a .npz file with the signature of the model files, so later
+    runs with the same models read them instead of extracting the depths.
+    The attention maps of each variable, used by attention_plotter, are
+    kept in variable_maps for the events they were put with."""
+
+    def __init__(self, path=None, model_paths=()) -> None:
+
+        self.path = path
+        self.version = np.array([[os.stat(model_path).st_mtime_ns, os.stat(model_path).st_size] for model_path in model_paths], dtype=np.int64)
+        self.maps = {}
+        self.variable_maps = {}
+        self.changed = False
+
+        # Reuse the maps saved with the same models
+        if path is not None and os.path.exists(path):
+            with np.load(path) as arrays:
+                if np.array_equal(arrays['version'], self.version):
+                    offsets = AttentionMap.offsets.tolist()
+                    for name in arrays.files:
+                        if name.endswith('_variables'):
+                            data_type, event_number = name[:-len('_variables')].rsplit('_', 1)
+                            self.variable_maps[(data_type, int(event_number))] = [{f'{variable}{offset:+d}': position.tolist() for offset, position in zip(offsets, variable_map)}
+                                                                                   for variable, variable_map in zip(AttentionMap.variables, arrays[name])]
+                        elif name != 'version':
+                            data_type, event_number = name.rsplit('_', 1)
+                            self.maps[(data_type, int(event_number))] = {f'{offset:+d}': position.tolist() for offset, position in zip(offsets, arrays[name])}
+
+    def __contains__(self, key):
+
+        return key in self.maps
+
+    def get(self, key, compute):
+
+        """Returns the map stored under key, calling compute() to get it the first time."""
+
+        if key not in self.maps:
+            self.maps[key] = compute()
+            self.changed = True
+
+        return self.maps[key]
+
+    def put(self, key, attention_total, attention_maps=None):
+
+        """Stores the multivariate map of key and, if given, the attention map of each variable."""
+
+        self.maps[key] = attention_total
+        if attention_maps is not None:
+            self.variable_maps[key] = attention_maps
+        self.changed = True
+
+    def save(self):
+
+        """Saves the maps to path if any was added."""
+
+        if self.path is None or not self.changed:
+            return
+
+        arrays = {f'{data_type}_{event_number}': np.array(list(attention_map.values()), dtype=float) for (data_type, event_number), attention_map in self.maps.items()}
+        arrays.update({f'{data_type}_{event_number}_variables': np.array([list(attention_map.values()) for attention_map in attention_maps], dtype=float)
+                       for (data_type, event_number), attention_maps in self.variable_maps.items()})
+        with open(f'{self.path}.tmp', 'wb') as file:
+            np.savez(file, version=self.version, **arrays)
+        os.replace(f'{self.path}.tmp', self.path)
+        self.changed = False
+
+def balanced_chunks(costs, num_chunks):
+
+    """This function splits tasks in chunks of similar total cost, giving
+    each task, from the most to the least costly, to the chunk with the
+    lowest cost so far.
+    ---------
+    Arguments:
+    costs: The cost of each task.
+    num_chunks: The number of chunks.
+
+    Returns:
+    chunks: The task indexes of each non-empty chunk, most costly chunks first."""
+
+    import heapq
+
+    loads = [(0, chunk) for chunk in range(max(1, num_chunks))]
+    chunks = [[] for _ in loads]
+    for task in np.argsort(costs, kind='stable')[::-1].tolist():
+        load, chunk = heapq.heappop(loads)
+        chunks[chunk].append(task)
+        heapq.heappush(loads, (load + costs[task], chunk))
+
+    chunks = [chunk for chunk in chunks if chunk]
+    chunks.sort(key=lambda chunk: -sum(costs[task] for task in chunk))
+
+    return chunks
+
+# Models and windows used by the explanation workers, set once in each worker process
+_explanation_state = None
+
+class _MappedWindows():
+
+    """Reference to the file of a memory-mapped window array, e.g. from
+    load_windows. It is pickled instead of the array, so the workers that
+    are not forked map the same file again rather than receiving a copy."""
+
+    def __init__(self, windows) -> None:
+
+        self.filename = windows.filename
+        self.dtype = windows.dtype
+        self.shape = windows.shape
+        self.offset = windows.offset
+
+    @staticmethod
+    def maps_file(windows):
+
+        """Returns True if windows is a whole C-ordered file mapping, as
+        np.load(..., mmap_mode='r') returns, and not a slice of one."""
+
+        return (isinstance(windows, np.memmap) and windows.filename is not None and windows.flags.c_contiguous
+                and windows.offset + windows.nbytes == os.path.getsize(windows.filename))
+
+    def open(self):
+
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+def _share_windows(datasets):
+
+    """Replaces the memory-mapped windows of the datasets by _MappedWindows references."""
+
+    return {name: (starts_ends, [_MappedWindows(windows) if _MappedWindows.maps_file(windows) else windows for windows in X])
+            for name, (starts_ends, X) in datasets.items()}
+
+def _set_explanation_state(models, structures, datasets):
+
+    global _explanation_state
+
+    # Map again the windows sent as references to their files
+    datasets = {name: (starts_ends, [windows.open() if isinstance(windows, _MappedWindows) else windows for windows in X])
+                for name, (starts_ends, X) in datasets.items()}
+
+    _explanation_state = (models, structures, datasets)
+
+def _explain_chunk(tasks, variables=False):
+
+    """Computes the multivariate attention map of each (key, dataset, event_number) task,
+    and the attention map of each variable if variables."""
+
+    models, structures, datasets = _explanation_state
+
+    results = []
+    for key, dataset, event_number in tasks:
+        starts_ends, X = datasets[dataset]
+        results.append((key, event_attention(starts_ends, X, models, event_number, structures=structures, n_jobs=1, variables=variables)))
+
+    return results
+
+def parallel_event_attention(tasks, models, datasets, structures=None, n_jobs=-1, chunks_per_worker=4, variables=False):
+
+    """This function computes the multivariate attention map of many events
+    in parallel processes. The events are split in chunks balanced by their
+    number of windows. The workers are started once with the models and
+    windows, which are inherited without copying where the processes are
+    forked. Otherwise the models are pickled into every worker, and so are
+    the windows unless they are whole memory-mapped files (as load_windows
+    returns), which each worker maps again from disk. The maps are yielded
+    as each chunk finishes.
+    ---------
+    Arguments:
+    tasks: The (key, dataset, event_number) of each event, e.g. (('anomalies', 3), 'anomalies', 3).
+    models: The Random Forest models at all resolutions (len=3).
+    datasets: The (starts_ends, X) of each dataset by name.
+    structures: The ForestStructure of each model, see depths.
+    n_jobs: The number of processes, -1 uses all cores.
+    chunks_per_worker: The number of chunks for each process, more chunks balance better.
+    variables: Whether to compute the attention map of each variable too, see event_attention.
+
+    Yields:
+    (key, attention_total): The key of the task and the multivariate attention map of the event,
+    or (key, (attention_total, attention_maps)) if variables."""
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from joblib import effective_n_jobs
+
+    if structures is None:
+        structures = [forest_structure(model) for model in models]
+
+    # The cost of an event is its number of windows at all resolutions
+    costs = [sum(end - start for start, end in datasets[dataset][0][event_number]) for _, dataset, event_number in tasks]
+
+    n_workers = min(effective_n_jobs(n_jobs), len(tasks))
+    if n_workers <= 1:
+        _set_explanation_state(models, structures, datasets)
+        for result in _explain_chunk(tasks, variables):
+            yield result
+        return
+
+    chunks = balanced_chunks(costs, n_workers * chunks_per_worker)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context, datasets = None, _share_windows(datasets)
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=_set_explanation_state, initargs=(models, structures, datasets)) as executor:
+        futures = [executor.submit(_explain_chunk, [tasks[task] for task in chunk], variables) for chunk in chunks]
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+
+def stack_attention(attention_maps):
+
+    """This function stacks attention maps in an (event x position x depth)
+    array, padding the depth with zeros up to the deepest map, as
+    kl_divergence does for each pair.
+    ---------
+    Arguments:
+    attention_maps: The attention maps, {'-16': [...], ...} dictionaries or arrays.
+
+    Returns:
+    stacked: The stacked attention maps."""
+
+    attention_maps = [np.array(list(attention_map.values()) if isinstance(attention_map, dict) else attention_map, dtype=float)
+                      for attention_map in attention_maps]
+    max_depth = max([attention_map.shape[1] for attention_map in attention_maps], default=0)
+
+    stacked = np.zeros((len(attention_maps), attention_maps[0].shape[0] if attention_maps else 0, max_depth))
+    for i, attention_map in enumerate(attention_maps):
+        stacked[i, :, :attention_map.shape[1]] = attention_map
+
+    return stacked
+
+# Distributions of the attention maps for divergence_matrix, set in each worker process
+_divergence_distributions = None
+
+def _set_divergence_distributions(distributions):
+
+    global _divergence_distributions
+    _divergence_distributions = distributions
+
+def _divergence_block(rows, metric, block_size, distributions=None):
+
+    """Computes the divergence of the distributions in rows against all of
+    them, going through the columns in blocks of block_size. The
+    Jensen-Shannon divergence compares every pair of maps value by value,
+    so it is summed over chunks of the map values, keeping each of its
+    temporary (rows x block_size x chunk) arrays within 2**22 values (32 MiB)."""
+
+    if distributions is None:
+        distributions = _divergence_distributions
+
+    P = distributions[rows]
+    log_P = np.log(P)
+    block = np.empty((len(P), len(distributions)))
+
+    for start in range(0, len(distributions), block_size):
+        Q = distributions[start:start + block_size]
+        log_Q = np.log(Q)
+
+        if metric == 'kl':
+            # sum(p * log(p / q)) = sum(p * log(p)) - p . log(q)
+            block[:, start:start + len(Q)] = np.sum(P * log_P, axis=1)[:, np.newaxis] - P @ log_Q.T
+        else:
+            # Jensen-Shannon: the mean Kullback-Leibler divergence to the mixture m = (p + q) / 2
+            divergences = np.zeros((len(P), len(Q)))
+            chunk = max(1, 2**22 // (len(P) * len(Q)))
+            for first in range(0, P.shape[1], chunk):
+                values = slice(first, first + chunk)
+                P_chunk, Q_chunk = P[:, np.newaxis, values], Q[np.newaxis, :, values]
+                log_M = np.log((P_chunk + Q_chunk) / 2)
+                divergences += np.sum(P_chunk * (log_P[:, np.newaxis, values] - log_M), axis=2)
+                divergences += np.sum(Q_chunk * (log_Q[np.newaxis, :, values] - log_M), axis=2)
+            block[:, start:start + len(Q)] = 0.5 * divergences
+
+    return block
+
+def divergence_matrix(attention_maps, metric='kl', block_size=256, n_jobs=None):
+
+    """This function calculates the divergence between every pair of
+    attention maps. The maps are normalized to sum 1 and shifted by epsilon
+    once, as in kl_divergence, and the matrix is computed in blocks of
+    block_size x block_size maps, so the memory does not grow with the
+    square of the number of maps beyond the result itself.
+    ---------
+    Arguments:
+    attention_maps: The attention maps, a list as taken by stack_attention or its output.
+    metric: 'kl' for Kullback-Leibler divergence or 'js' for Jensen-Shannon divergence.
+    block_size: The number of maps in each block.
+    n_jobs: The number of processes over the row blocks. None or 1 uses the current process.
+
+    Returns:
+    divergences: The (event x event) matrix, divergences[i, j] compares map i with map j."""
+
+    if metric not in ('kl', 'js'):
+        raise ValueError(f"metric must be 'kl' or 'js', got {metric!r}")
+
+    if not isinstance(attention_maps, np.ndarray):
+        attention_maps = stack_attention(attention_maps)
+
+    # Normalize the attention maps (heatmaps) to ensure they sum to 1 and add a small value epsilon to avoid divisions by zero
+    distributions = attention_maps.reshape(len(attention_maps), -1)
+    distributions = distributions / np.sum(distributions, axis=1, keepdims=True) + np.finfo(float).eps
+
+    row_blocks = [range(start, min(start + block_size, len(distributions))) for start in range(0, len(distributions), block_size)]
+
+    if n_jobs is None or n_jobs == 1 or len(row_blocks) <= 1:
+        blocks = [_divergence_block(rows, metric, block_size, distributions) for rows in row_blocks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        from joblib import effective_n_jobs
+
+        with ProcessPoolExecutor(max_workers=effective_n_jobs(n_jobs), initializer=_set_divergence_distributions, initargs=(distributions,)) as executor:
+            blocks = list(executor.map(_divergence_block, row_blocks, [metric] * len(row_blocks), [block_size] * len(row_blocks)))
+
+    return np.vstack(blocks) if blocks else np.zeros((0, 0))
+
+def attention_plotter(attention_maps, event_number, station, type, pdf=None):
 
     """This function plots the attention maps for each variable.
     ---------
     Arguments:
     attention_maps: The attention maps for each variable.
+    pdf: The multi-page PDF to add the figure to, if any.
 
     Returns:
     None."""
 
+    import pandas as pd
+    import seaborn as sns
+    plt = _pyplot()
+
     variables = ['Ammonium', 'Conductivity', 'Dissolved oxygen', 'pH', 'Turbidity', 'Water temperature']
     
     # Define the plot
@@ -691,21 +1365,26 @@ def attention_plotter(attention_maps, event_number, station, type):
     plt.tight_layout()
     # plt.show()
 
-    # Save figure
-    plt.savefig(f'results/attention_maps_{station}_{type}_{event_number}.pdf', format='pdf', dpi=300, bbox_inches='tight')
+    # Save and close figure
+    save_figure(fig, f'results/attention_maps_{station}_{type}_{event_number}.pdf', pdf)
 
-def multivariate_attention_plotter(attention_total, event_number, station, type):
+def multivariate_attention_plotter(attention_total, event_number, station, type, pdf=None):
 
     """This function plots the multivariate attention map for all variables.
     ---------
     Arguments:
     attention_total: The total attention map for all variables.
+    pdf: The multi-page PDF to add the figure to, if any.
 
     Returns:
     None."""
 
+    import pandas as pd
+    import seaborn as sns
+    plt = _pyplot()
+
     # Define the plot
-    plt.figure(figsize=(8, 8))
+    fig = plt.figure(figsize=(8, 8))
     sns.heatmap(pd.DataFrame(attention_total).T, cmap='Reds', cbar=False)
     plt.xlabel('Tree depth', fontsize=21)
     plt.ylabel('Time window index', fontsize=21)
@@ -725,19 +1404,24 @@ def multivariate_attention_plotter(attention_total, event_number, station, type)
     tick_interval = 2
     plt.yticks(np.arange(0.5, len(list(attention_total.keys())), tick_interval), list(attention_total.keys())[::tick_interval])
     
-    # Save figure
-    plt.savefig(f'results/multivariate_attention_map_{station}_{type}_{event_number}.pdf', format='pdf', dpi=300, bbox_inches='tight')
+    # Save and close figure
+    save_figure(fig, f'results/multivariate_attention_map_{station}_{type}_{event_number}.pdf', pdf)
 
-def threshold_plotter(threshold_maps, event_number, station, type):
+def threshold_plotter(threshold_maps, event_number, station, type, pdf=None):
     
     """This function plots the thresholds for each variable.
     ---------
     Arguments:
     threshold_maps: The thresholds for each variable.
+    pdf: The multi-page PDF to add the figure to, if any.
 
     Returns:
     None."""
 
+    import pandas as pd
+    import seaborn as sns
+    plt = _pyplot()
+
     variables = ['Ammonium', 'Conductivity', 'Dissolved oxygen', 'pH', 'Turbidity', 'Water temperature']
 
     # Define the plot
@@ -764,19 +1448,24 @@ def threshold_plotter(threshold_maps, event_number, station, type):
     plt.tight_layout()
     # plt.show()
 
-    # Save figure
-    plt.savefig(f'results/threshold_maps_{station}_{type}_{event_number}.pdf', format='pdf', dpi=300, bbox_inches='tight')
+    # Save and close figure
+    save_figure(fig, f'results/threshold_maps_{station}_{type}_{event_number}.pdf', pdf)
 
-def distance_plotter(distance_maps, event_number, station, type):
+def distance_plotter(distance_maps, event_number, station, type, pdf=None):
 
     """This function plots the distances for each variable.
     ---------
     Arguments:
     distance_maps: The distances for each variable.
+    pdf: The multi-page PDF to add the figure to, if any.
 
     Returns:
     None."""
 
+    import pandas as pd
+    import seaborn as sns
+    plt = _pyplot()
+
     variables = ['Ammonium', 'Conductivity', 'Dissolved oxygen', 'pH', 'Turbidity', 'Water temperature']
 
     # Define the plot
@@ -803,10 +1492,10 @@ def distance_plotter(distance_maps, event_number, station, type):
     plt.tight_layout()
     # plt.show()
 
-    # Save figure
-    plt.savefig(f'results/distance_maps_{station}_{type}_{event_number}.pdf', format='pdf', dpi=300, bbox_inches='tight')
+    # Save and close figure
+    save_figure(fig, f'results/distance_maps_{station}_{type}_{event_number}.pdf', pdf)
 
-def kl_plotter(kl_distances, event_number, station, data_type):
+def kl_plotter(kl_distances, event_number, station, data_type, pdf=None):
 
     """This function plots the Kullback-Leibler divergence distributions.
     ---------
@@ -815,10 +1504,14 @@ def kl_plotter(kl_distances, event_number, station, data_type):
     event_number: The event number.
     station: The station name.
     data_type: The data type.
+    pdf: The multi-page PDF to add the figure to, if any.
 
     Returns:
     None."""
 
+    import seaborn as sns
+    plt = _pyplot()
+
     # Plot the KL divergences
     fig, ax = plt.subplots(figsize=(8, 6))
     sns.kdeplot(kl_distances[0], color='lightcoral', label='Labeled anomalies', linewidth=1, fill=True, ax=ax)
@@ -832,10 +1525,10 @@ def kl_plotter(kl_distances, event_number, station, data_type):
     ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.15), shadow=False, ncol=3, fontsize=19)
     # plt.show()
 
-    plt.savefig(f'results/kl_divergence_{station}_{data_type[:2]}_{event_number}.pdf', format='pdf', dpi=300, bbox_inches='tight')    
+    save_figure(fig, f'results/kl_divergence_{station}_{data_type[:2]}_{event_number}.pdf', pdf)
 
 # Decision paths plot
-def dp_plotter(data, model, resolution, station, name):
+def dp_plotter(data, model, resolution, station, name, structure=None):
 
     """NOT CURRENTLY USED.
     This function explains the decision of a Random Forest model
@@ -846,24 +1539,39 @@ def dp_plotter(data, model, resolution, station, name):
     model: The Random Forest model to be explained.
     resolution: The resolution of the model.
     name: The title of the plot.
+    structure: The ForestStructure of the model, e.g. from forest_structure(model, model_path)
+    to reuse the cache saved next to the model. Built from the model if None.
     
     Returns:
     None."""
 
-    # Create an empty list to store decision path for each window and all of the decision paths
-    decision_paths = []
-
-    # Traverse each tree in the Random Forest to get the decision path across all trees for the given window (data)
-    for tree in model.estimators_:
-        tree_decision_paths = tree.decision_path(data[np.newaxis, :]).toarray()
-        decision_paths.append(tree_decision_paths)
-
-    # Get the indices where the window has passed through
-    passed_nodes_indices = [np.where(decision_path == 1)[1] for decision_path in decision_paths]
+    import seaborn as sns
+    plt = _pyplot()
+
+    if structure is None:
+        structure = forest_structure(model)
+
+    # Send the window down all the trees at once in the flattened forest, one level at a time.
+    # The window is compared in float32, as the trees do
+    window = np.asarray(data, dtype=np.float32).ravel()
+    trees, nodes = np.arange(len(structure.offsets) - 1), structure.offsets[:-1]
+    path_trees, path_nodes = [trees], [nodes]
+    while len(nodes):
+        split = structure.children_left[nodes] != -1
+        trees, nodes = trees[split], nodes[split]
+        go_left = window[structure.feature[nodes]] <= structure.threshold[nodes]
+        nodes = np.where(go_left, structure.children_left[nodes], structure.children_right[nodes])
+        path_trees.append(trees)
+        path_nodes.append(nodes)
+
+    # Get the indices where the window has passed through for each tree, from the root to the leaf
+    path_trees, path_nodes = np.concatenate(path_trees), np.concatenate(path_nodes)
+    path_nodes = path_nodes[np.argsort(path_trees, kind='stable')]
+    passed_nodes_indices = np.split(path_nodes, np.cumsum(np.bincount(path_trees, minlength=len(structure.offsets) - 1))[:-1])
 
     # Get the thresholds and feature values of the nodes in each decision tree in the Random Forest
-    tree_feature_thresholds = [model.estimators_[i].tree_.threshold[e] for i, e in enumerate(passed_nodes_indices)]
-    tree_feature_indices = [model.estimators_[i].tree_.feature[e] for i, e in enumerate(passed_nodes_indices)]
+    tree_feature_thresholds = [structure.threshold[e] for e in passed_nodes_indices]
+    tree_feature_indices = [structure.feature[e] for e in passed_nodes_indices]
 
     # Define feature names for all resolution levels
     feature_names_high = [
@@ -980,7 +1688,7 @@ def dp_plotter(data, model, resolution, station, name):
 
     # Variable-threshold plot
     # Read the data and get the mean for each variable
-    df = pd.read_csv(f'data/labeled_{station}_smo.csv', sep=',', encoding='utf-8', parse_dates=['date'])
+    df = load_station(station)
     
     stats_dict = {}
     var_names = ['am', 'co', 'do', 'ph', 'tu', 'wt']
@@ -1075,9 +1783,12 @@ def mean_plotter(data, resolution, num_variables, station, name):
     Returns:
     None.
     """
+
+    import seaborn as sns
+    plt = _pyplot()
     
     # Read the data and get the mean for each variable
-    df = pd.read_csv(f'data/labeled_{station}_smo.csv', sep=',', encoding='utf-8', parse_dates=['date'])
+    df = load_station(station)
 
     stats_dict = {}
     var_names = ['am', 'co', 'do', 'ph', 'tu', 'wt']
@@ -1237,3 +1948,339 @@ def summarizer(data, num_variables):
         data_summarized.append(i.mean(axis=0))
     
     return np.array(data_summarized)
+
+class SegmentIndex():
+
+    """Occupancy index of the [start, end] row segments (both included) that
+    have already been extracted, used to draw new segments from the free
+    gaps between them.
+
+    The free gaps are bucketed by their length, and two Fenwick trees over
+    the lengths (longest first) hold the number of gaps and the total number
+    of rows of each length. A gap of length L has L - span valid starts for a
+    segment of end - start = span, so the number of valid starts of all the
+    gaps at least span + 1 rows long is a prefix sum of sums - span * counts.
+    Drawing a segment descends the trees and splits one gap, so both take
+    O(log num_rows) time."""
+
+    def __init__(self, segments=()) -> None:
+
+        self.segments = [] # Segments added, before merging
+        self.num_segments = 0
+        self.num_rows = None # Rows the free gaps were built for
+
+        for start, end in segments:
+            self.add(start, end)
+
+    def add(self, start, end):
+
+        """Marks [start, end] as occupied. The free gaps are rebuilt on the
+        next draw; the segments drawn by sample do not need it."""
+
+        self.segments.append((start, end))
+        self.num_segments += 1
+        self.num_rows = None
+
+    def _build(self, num_rows):
+
+        """Builds the free gaps within [0, num_rows - 1] and the Fenwick
+        trees of their lengths from the occupied segments."""
+
+        self.num_rows = num_rows
+        self.gap_starts = []
+        self.gap_ends = []
+        self.buckets = {} # Length -> ids of the gaps of that length
+        self.bucket_positions = [] # Position of each gap id in its bucket
+        self.counts = [0] * (num_rows + 1)
+        self.sums = [0] * (num_rows + 1)
+
+        # Walk the occupied segments in order, the rows between them are free
+        free_start = 0
+        for start, end in sorted(self.segments):
+            if start > free_start:
+                self._insert_gap(free_start, min(start, num_rows) - 1, update=False)
+            free_start = max(free_start, end + 1)
+            if free_start >= num_rows:
+                break
+        self._insert_gap(free_start, num_rows - 1, update=False)
+
+        # Turn the counts and sums of each length into Fenwick trees in linear time
+        for i in range(1, num_rows + 1):
+            parent = i + (i & -i)
+            if parent <= num_rows:
+                self.counts[parent] += self.counts[i]
+                self.sums[parent] += self.sums[i]
+
+    def _update(self, length, count):
+
+        """Adds count gaps of the given length to the Fenwick trees."""
+
+        i = self.num_rows - length + 1
+        while i <= self.num_rows:
+            self.counts[i] += count
+            self.sums[i] += count * length
+            i += i & -i
+
+    def _insert_gap(self, start, end, gap=None, update=True):
+
+        """Adds the free gap [start, end], reusing the id gap if given."""
+
+        length = end - start + 1
+        if length <= 0:
+            return
+
+        if gap is None:
+            gap = len(self.gap_starts)
+            self.gap_starts.append(start)
+            self.gap_ends.append(end)
+            self.bucket_positions.append(0)
+        else:
+            self.gap_starts[gap] = start
+            self.gap_ends[gap] = end
+
+        bucket = self.buckets.setdefault(length, [])
+        self.bucket_positions[gap] = len(bucket)
+        bucket.append(gap)
+
+        if update:
+            self._update(length, 1)
+        else:
+            self.counts[self.num_rows - length + 1] += 1
+            self.sums[self.num_rows - length + 1] += length
+
+    def _remove_gap(self, gap):
+
+        """Removes the free gap gap from its bucket and the Fenwick trees."""
+
+        length = self.gap_ends[gap] - self.gap_starts[gap] + 1
+
+        # Move the last gap of the bucket to the place of the removed one
+        bucket = self.buckets[length]
+        last = bucket.pop()
+        if last != gap:
+            position = self.bucket_positions[gap]
+            bucket[position] = last
+            self.bucket_positions[last] = position
+
+        self._update(length, -1)
+
+    def sample(self, span, num_rows, rng):
+
+        """Draws a segment [start, start + span] uniformly among all the
+        positions within [0, num_rows - 1] that do not overlap the occupied
+        segments, and marks it as occupied.
+        ----------
+        Arguments:
+        span (int): end - start of the new segment.
+        num_rows (int): number of rows available.
+        rng (random.Random or module): source of random numbers, needs randrange.
+
+        Returns:
+        (start, end) of the new segment, or None if there is no free gap wide enough."""
+
+        if self.num_rows != num_rows:
+            self._build(num_rows)
+
+        # The gaps at least span + 1 rows long are the first num_rows - span lengths of the trees
+        limit = num_rows - span
+        if limit <= 0:
+            return None
+
+        # Number of valid starts in those gaps
+        i, total_counts, total_sums = limit, 0, 0
+        while i > 0:
+            total_counts += self.counts[i]
+            total_sums += self.sums[i]
+            i -= i & -i
+        total = total_sums - span * total_counts
+        if total <= 0:
+            return None
+
+        # Pick one of all the valid starts and descend the trees to the length of its gap
+        draw = rng.randrange(total)
+        position, below_counts, below_sums = 0, 0, 0
+        step = 1 << (num_rows.bit_length() - 1)
+        while step:
+            i = position + step
+            if i <= limit:
+                counts, sums = below_counts + self.counts[i], below_sums + self.sums[i]
+                if sums - span * counts <= draw:
+                    position, below_counts, below_sums = i, counts, sums
+            step >>= 1
+
+        # Every gap of that length has the same number of valid starts
+        length = num_rows - position
+        draw -= below_sums - span * below_counts
+        gap = self.buckets[length][draw // (length - span)]
+        start = self.gap_starts[gap] + draw % (length - span)
+        end = start + span
+
+        # Split the gap around the new segment
+        gap_start, gap_end = self.gap_starts[gap], self.gap_ends[gap]
+        self._remove_gap(gap)
+        self._insert_gap(gap_start, start - 1, gap=gap)
+        self._insert_gap(end + 1, gap_end)
+
+        self.segments.append((start, end))
+        self.num_segments += 1
+
+        return start, end
+
+class WindowBuffer():
+
+    """Growable array of windows of one resolution and class. The windows
+    are kept in a preallocated array whose capacity doubles when it runs
+    out, so appending only copies the new windows. The rows already in the
+    buffer are never written again, so the views returned by windows stay
+    valid after later appends."""
+
+    def __init__(self, windows) -> None:
+
+        windows = np.asarray(windows)
+
+        self.size = len(windows)
+        self.data = np.empty((max(self.size, 1),) + windows.shape[1:], dtype=windows.dtype)
+        self.data[:self.size] = windows
+
+    @property
+    def windows(self):
+
+        """Returns a view of the windows in the buffer."""
+
+        return self.data[:self.size]
+
+    def holds(self, windows):
+
+        """Returns True if windows is the current view of the buffer."""
+
+        return isinstance(windows, np.ndarray) and windows.base is self.data and len(windows) == self.size
+
+    def append(self, windows):
+
+        """Adds the windows at the end of the buffer."""
+
+        size = self.size + len(windows)
+
+        # Double the capacity when needed, the old array stays alive for the views taken before
+        if size > len(self.data):
+            data = np.empty((max(size, 2 * len(self.data)),) + self.data.shape[1:], dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+        self.data[self.size:size] = windows
+        self.size = size
+
+class ForestStructure():
+
+    """Structure of all the trees of a Random Forest flattened into
+    contiguous arrays, so the nodes can be looked up with array indexing
+    instead of going through each estimator. The nodes of tree t are
+    offsets[t]:offsets[t + 1], and the children are global node indexes
+    (-1 for the leaves). value holds the class distribution of each node."""
+
+    fields = ('feature', 'threshold', 'children_left', 'children_right', 'depth', 'value', 'offsets')
+
+    def __init__(self, feature, threshold, children_left, children_right, depth, value, offsets) -> None:
+
+        self.feature = feature
+        self.threshold = threshold
+        self.children_left = children_left
+        self.children_right = children_right
+        self.depth = depth
+        self.value = value
+        self.offsets = offsets
+
+    @classmethod
+    def from_model(cls, model):
+
+        """Flattens the trees of a fitted Random Forest model."""
+
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        offsets = np.concatenate(([0], np.cumsum([tree.node_count for tree in trees]))).astype(np.int64)
+
+        # Move the children to global indexes, keeping -1 for the leaves
+        tree_offsets = np.repeat(offsets[:-1], np.diff(offsets))
+        children = []
+        for side in ('children_left', 'children_right'):
+            side_children = np.concatenate([getattr(tree, side) for tree in trees]).astype(np.int64)
+            children.append(np.where(side_children == -1, -1, side_children + tree_offsets))
+        children_left, children_right = children
+
+        # Depth of every node, going down from the roots one level at a time
+        depth = np.zeros(offsets[-1], dtype=np.int64)
+        level, nodes = 0, offsets[:-1]
+        while len(nodes):
+            depth[nodes] = level
+            nodes = np.concatenate((children_left[nodes], children_right[nodes]))
+            nodes = nodes[nodes != -1]
+            level += 1
+
+        return cls(feature=np.concatenate([tree.feature for tree in trees]).astype(np.int64),
+                   threshold=np.concatenate([tree.threshold for tree in trees]),
+                   children_left=children_left,
+                   children_right=children_right,
+                   depth=depth,
+                   value=np.concatenate([tree.value[:, 0, :] for tree in trees]),
+                   offsets=offsets)
+
+    def matches(self, model):
+
+        """Returns True if the structure has the same trees and nodes as model."""
+
+        node_counts = [estimator.tree_.node_count for estimator in model.estimators_]
+
+        return np.array_equal(np.diff(self.offsets), node_counts)
+
+    def save(self, path, signature=None):
+
+        """Saves the arrays to a .npz file, with the signature of the model file if given."""
+
+        arrays = {field: getattr(self, field) for field in self.fields}
+        if signature is not None:
+            arrays['signature'] = np.array(signature, dtype=np.int64)
+
+        with open(f'{path}.tmp', 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+
+        """Loads the arrays saved with save and the signature of the model file (None if missing)."""
+
+        with np.load(path) as arrays:
+            structure = cls(**{field: arrays[field] for field in cls.fields})
+            signature = arrays['signature'].tolist() if 'signature' in arrays else None
+
+        return structure, signature
+
+def forest_structure(model, model_path=None):
+
+    """This function returns the ForestStructure of a Random Forest model.
+    When the path of the model file is given, e.g. 'models/rf_model_high_9.sav',
+    the structure is cached next to it ('models/rf_model_high_9_structure.npz')
+    and only rebuilt when the model file changes.
+    ---------
+    Arguments:
+    model: The fitted Random Forest model.
+    model_path: The path of the pickled model, or None to skip the cache.
+
+    Returns:
+    structure: The ForestStructure of the model."""
+
+    if model_path is None:
+        return ForestStructure.from_model(model)
+
+    stat = os.stat(model_path)
+    signature = [stat.st_mtime_ns, stat.st_size]
+    structure_path = f'{os.path.splitext(model_path)[0]}_structure.npz'
+
+    if os.path.exists(structure_path):
+        structure, saved_signature = ForestStructure.load(structure_path)
+        if saved_signature == signature and structure.matches(model):
+            return structure
+
+    structure = ForestStructure.from_model(model)
+    structure.save(structure_path, signature)
+
+    return structure